@@ -0,0 +1,508 @@
+"""Benchmark harness for compare-stays-xlsx-vs-supabase.py.
+
+Generates synthetic Stays exports, serves matching fake /rest/v1/reservations pages from a local
+PostgREST stand-in with configurable latency, times each comparer phase and appends the timings
+to a history file so regressions show up before a month-end close.
+
+    python bench-compare-stays-xlsx-vs-supabase.py --sizes 10k,100k --latency-ms 40
+"""
+
+import argparse
+import csv
+import gzip
+import importlib.util
+import io
+import json
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import islice
+from pathlib import Path
+from types import ModuleType
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+from openpyxl import Workbook
+
+REPO_ROOT = Path(__file__).resolve().parent
+COMPARER_PATH = REPO_ROOT / "compare-stays-xlsx-vs-supabase.py"
+BENCH_DIR = REPO_ROOT / ".cache" / "stays-reconciliation" / "bench"
+DEFAULT_HISTORY = BENCH_DIR / "history.jsonl"
+
+WINDOW_FROM = date(2025, 1, 1)
+WINDOW_TO = date(2025, 12, 31)
+STATUSES = ("confirmed", "confirmed", "confirmed", "cancelled", "pending")
+STATUS_PT = {"confirmed": "Confirmada", "cancelled": "Cancelada", "pending": "Pendente"}
+CODE_ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ0123456789"
+
+
+def load_comparer() -> ModuleType:
+    """Import the hyphen-named comparer script as a module (registered so process pools can pickle it)."""
+    spec = importlib.util.spec_from_file_location("compare_stays_xlsx_vs_supabase", COMPARER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def parse_size(value: str) -> int:
+    m = re.fullmatch(r"(\d+)([km]?)", value.strip().lower())
+    if not m:
+        raise argparse.ArgumentTypeError(f"Invalid size: {value!r} (use e.g. 10000, 10k, 1m)")
+    return int(m.group(1)) * {"": 1, "k": 1_000, "m": 1_000_000}[m.group(2)]
+
+
+# ---------------------------------------------------------------------------
+# Synthetic data
+# ---------------------------------------------------------------------------
+
+
+def synthetic_reservations(rows: int, seed: int) -> List[dict]:
+    """Supabase-side rows; codes are unique so the expected diff is exactly the injected drift."""
+    rng = random.Random(seed)
+    days = (WINDOW_TO - WINDOW_FROM).days + 1
+    codes: set = set()
+    out: List[dict] = []
+    for i in range(rows):
+        code = "".join(rng.choice(CODE_ALPHABET) for _ in range(6))
+        while code in codes:
+            code = "".join(rng.choice(CODE_ALPHABET) for _ in range(6))
+        codes.add(code)
+        check_in = WINDOW_FROM + timedelta(days=rng.randrange(days))
+        nights = rng.randint(1, 14)
+        out.append(
+            {
+                "id": f"res_{i:08d}",
+                "organization_id": "00000000-0000-0000-0000-00000000bench",
+                "check_in": check_in.isoformat(),
+                "check_out": (check_in + timedelta(days=nights)).isoformat(),
+                "nights": nights,
+                "guests_total": rng.randint(1, 8),
+                "pricing_total": round(rng.uniform(150, 9000), 2),
+                "status": rng.choice(STATUSES),
+                "external_id": f"{rng.getrandbits(96):024x}",
+                "external_url": f"https://stays.net/i/reservation?reserve={code}",
+                "updated_at": f"{check_in.isoformat()}T{rng.randrange(24):02d}:{rng.randrange(60):02d}:00+00:00",
+            }
+        )
+    return out
+
+
+def write_synthetic_workbook(path: Path, reservations: Sequence[dict], seed: int, drift: float) -> None:
+    """Stays-like export of `reservations`: `drift` of the rows are dropped, replaced or edited."""
+    rng = random.Random(seed + 1)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Reservas")
+    ws.append(["Reserva", "ID", "Imóvel", "Entrada", "Saída", "Noites", "Hóspedes", "Total", "Situação"])
+    for row in reservations:
+        roll = rng.random()
+        if roll < drift:
+            continue  # only in Supabase
+        code = row["external_url"].rsplit("=", 1)[-1]
+        if roll < 2 * drift:
+            code = "X" + code[1:]  # only in the export
+        total = row["pricing_total"] + (10 if roll < 3 * drift else 0)
+        ws.append(
+            [
+                code,
+                row["external_id"],
+                f"Apartamento {rng.randint(1, 400)}",
+                datetime.fromisoformat(row["check_in"]),
+                datetime.fromisoformat(row["check_out"]),
+                row["nights"],
+                row["guests_total"],
+                f"R$ {total:,.2f}".replace(",", "_").replace(".", ",").replace("_", "."),
+                STATUS_PT[row["status"]],
+            ]
+        )
+    wb.save(str(path))
+
+
+# ---------------------------------------------------------------------------
+# PostgREST stand-in
+# ---------------------------------------------------------------------------
+
+
+_MAX_TEXT = "\U0010ffff"
+_CURSOR_RE = re.compile(r'^\((\w+)\.gt\."(.*?)",and\(\1\.eq\."\2",(\w+)\.gt\."(.*?)"\)\)$')
+
+
+class FakeTable:
+    """In-memory table answering the PostgREST subset the comparer uses.
+
+    Rows are kept sorted per requested order, and range filters on the leading order key plus
+    keyset cursors are resolved by bisection, so a page costs O(log n + offset + limit) even at
+    millions of rows.
+    """
+
+    def __init__(self, rows: List[dict]):
+        self.rows = rows
+        self._sorted: Dict[Tuple[str, ...], Tuple[List[dict], List[tuple]]] = {}
+        self._lock = threading.Lock()
+
+    def _ordered(self, keys: Tuple[str, ...]) -> Tuple[List[dict], List[tuple]]:
+        with self._lock:
+            if keys not in self._sorted:
+                ordered = sorted(self.rows, key=lambda r: tuple(str(r.get(k) or "") for k in keys))
+                self._sorted[keys] = (ordered, [tuple(str(r.get(k) or "") for k in keys) for r in ordered])
+            return self._sorted[keys]
+
+    def query(self, params: List[Tuple[str, str]], count: bool = False) -> Tuple[List[dict], Optional[int]]:
+        """Return (page, totalMatching); the total is only computed when `count` is set."""
+        select: Optional[List[str]] = None
+        keys: Tuple[str, ...] = ("id",)
+        limit: Optional[int] = None
+        offset = 0
+        predicates: List[Callable[[dict], bool]] = []
+        cursor: Optional[Tuple[str, str]] = None
+
+        for name, value in params:
+            if name == "select":
+                select = value.split(",")
+            elif name == "order":
+                keys = tuple(part.split(".")[0] for part in value.split(","))
+            elif name == "limit":
+                limit = int(value)
+            elif name == "offset":
+                offset = int(value)
+            elif name == "or":
+                m = _CURSOR_RE.match(value)
+                if not m:
+                    raise ValueError(f"Unsupported or= filter: {value}")
+                cursor = (m.group(2), m.group(4))
+            else:
+                predicates.append(_predicate(name, value))
+
+        # Narrow the scan with bisection; the predicates below stay authoritative.
+        ordered, sort_keys = self._ordered(keys)
+        lo, hi = 0, len(ordered)
+        for name, value in params:
+            op, _, operand = value.partition(".")
+            if name != keys[0]:
+                continue
+            if op == "gte":
+                lo = max(lo, bisect_left(sort_keys, (operand,)))
+            elif op == "gt":
+                lo = max(lo, bisect_right(sort_keys, (operand, _MAX_TEXT)))
+            elif op == "lte":
+                hi = min(hi, bisect_right(sort_keys, (operand, _MAX_TEXT)))
+        if cursor and len(keys) == 2:
+            lo = max(lo, bisect_right(sort_keys, cursor))
+
+        matching = (r for r in islice(ordered, lo, hi) if all(p(r) for p in predicates))
+        if count:
+            everything = list(matching)
+            total: Optional[int] = len(everything)
+            matching = iter(everything)
+        else:
+            total = None
+        page = list(islice(matching, offset, offset + limit if limit is not None else None))
+        if select and select != ["*"]:
+            page = [{c: r.get(c) for c in select} for r in page]
+        return page, total
+
+
+def _predicate(column: str, expr: str) -> Callable[[dict], bool]:
+    negate = expr.startswith("not.")
+    if negate:
+        expr = expr[4:]
+    op, _, operand = expr.partition(".")
+
+    def check(row: dict) -> bool:
+        value = row.get(column)
+        if op == "is":
+            hit = value is None if operand == "null" else value == (operand == "true")
+        elif value is None:
+            hit = False
+        else:
+            text = str(value)
+            hit = {
+                "eq": text == operand,
+                "neq": text != operand,
+                "gt": text > operand,
+                "gte": text >= operand,
+                "lt": text < operand,
+                "lte": text <= operand,
+            }[op]
+        return not hit if negate else hit
+
+    return check
+
+
+def _csv_body(page: List[dict], columns: Optional[List[str]]) -> bytes:
+    """PostgREST's text/csv: a header row, then NULL as an empty cell."""
+    columns = columns or (list(page[0]) if page else [])
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    writer.writerows(["" if row.get(c) is None else row.get(c) for c in columns] for row in page)
+    return buf.getvalue().encode("utf-8")
+
+
+class FakePostgrest:
+    """ThreadingHTTPServer on 127.0.0.1 serving `tables` under /rest/v1/<table>."""
+
+    def __init__(self, tables: Dict[str, List[dict]], latency_s: float = 0.0):
+        self.tables = {name: FakeTable(rows) for name, rows in tables.items()}
+        self.latency_s = latency_s
+        self.requests = 0
+        self.bytes_sent = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args: object) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                self._respond(head=False)
+
+            def do_HEAD(self) -> None:
+                # plan_supabase_pages sizes a read with body-less HEADs carrying Prefer: count=...
+                self._respond(head=True)
+
+            def _respond(self, head: bool) -> None:
+                server.requests += 1
+                time.sleep(server.latency_s)
+                parts = urlsplit(self.path)
+                table = server.tables.get(parts.path.rsplit("/", 1)[-1])
+                if table is None:
+                    self._send(404, b'{"message":"relation does not exist"}', {}, head)
+                    return
+                params = parse_qsl(parts.query, keep_blank_values=True)
+                page, total = table.query(params, count="count=" in (self.headers.get("Prefer") or ""))
+                start = next((int(v) for k, v in params if k == "offset"), 0)
+                span = f"{start}-{start + len(page) - 1}" if page else "*"
+                headers = {"Content-Range": f"{span}/{'*' if total is None else total}"}
+                if "text/csv" in (self.headers.get("Accept") or ""):
+                    columns = next((v.split(",") for k, v in params if k == "select"), None)
+                    headers["Content-Type"] = "text/csv"
+                    body = _csv_body(page, columns)
+                else:
+                    body = json.dumps(page).encode("utf-8")
+                # Like the Supabase edge, compress whatever the client accepts gzip for.
+                if "gzip" in (self.headers.get("Accept-Encoding") or ""):
+                    body = gzip.compress(body, compresslevel=6)
+                    headers["Content-Encoding"] = "gzip"
+                if not head:
+                    server.bytes_sent += len(body)
+                self._send(200, body, headers, head)
+
+            def _send(self, status: int, body: bytes, headers: Dict[str, str], head: bool = False) -> None:
+                self.send_response(status)
+                self.send_header("Content-Type", headers.pop("Content-Type", "application/json"))
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                if not head:
+                    self.wfile.write(body)
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._httpd.server_port}"
+
+    def __enter__(self) -> "FakePostgrest":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+# ---------------------------------------------------------------------------
+# Timing
+# ---------------------------------------------------------------------------
+
+
+@dataclass
+class PhaseTiming:
+    phase: str
+    seconds: float
+    detail: str = ""
+
+
+def timed(phase: str, fn: Callable[[], object], detail: str = "") -> Tuple[object, PhaseTiming]:
+    started = time.perf_counter()
+    result = fn()
+    return result, PhaseTiming(phase, time.perf_counter() - started, detail)
+
+
+def bench_size(
+    cmp: ModuleType,
+    rows: int,
+    seed: int,
+    latency_s: float,
+    fetch_workers: int,
+    drift: float,
+) -> List[PhaseTiming]:
+    reservations = synthetic_reservations(rows, seed)
+    xlsx = BENCH_DIR / f"stays-export-{rows}-seed{seed}-drift{drift}.xlsx"
+    timings: List[PhaseTiming] = []
+    if not xlsx.exists():
+        _, t = timed("generate_workbook", lambda: write_synthetic_workbook(xlsx, reservations, seed, drift))
+        timings.append(t)
+
+    # The --fields columns are collected in the same pass, as reconcile_period does.
+    index, t = timed("workbook_index", lambda: cmp.build_workbook_index(xlsx, rules=cmp.FIELD_RULES))
+    timings.append(t)
+    external_ids = {row["external_id"] for row in reservations}
+    (_, picked), t = timed("detect_id_column", lambda: cmp.pick_best_column(index, external_ids))
+    t.detail = picked
+    timings.append(t)
+
+    window = (WINDOW_FROM.isoformat(), WINDOW_TO.isoformat())
+    with FakePostgrest({"reservations": reservations}, latency_s) as api:
+        cfg = cmp.SupabaseConfig(url=api.url, anon_key="bench")
+        fetched = None
+        runs = [(p, "json") for p in cmp.PAGINATION_MODES] + [("keyset", "csv")]
+        for pagination, transfer in runs:
+            for workers in sorted({1, fetch_workers}):
+                before, sent = api.requests, api.bytes_sent
+                suffix = "" if transfer == "json" else f"_{transfer}"
+                fetched, t = timed(
+                    f"fetch_{pagination}{suffix}_w{workers}",
+                    lambda: cmp.fetch_supabase_reservation_rows(
+                        cfg,
+                        *window,
+                        workers=workers,
+                        pagination=pagination,
+                        extra_columns=[rule.column for rule in cmp.FIELD_RULES],
+                        transfer=transfer,
+                    ),
+                )
+                t.detail = f"requests={api.requests - before} wire_bytes={api.bytes_sent - sent}"
+                timings.append(t)
+
+    def diff_codes() -> Tuple[int, int]:
+        xlsx_codes = index.reserva_codes()
+        _, supa_codes = cmp.reserve_codes_from_rows(fetched)
+        return len(supa_codes - xlsx_codes), len(xlsx_codes - supa_codes)
+
+    (only_supabase, only_xlsx), t = timed("diff_codes", diff_codes)
+    t.detail = f"only_in_supabase={only_supabase} only_in_xlsx={only_xlsx}"
+    timings.append(t)
+    _, t = timed("diff_fields", lambda: cmp.diff_fields(index, fetched, cmp.FIELD_RULES))
+    timings.append(t)
+    return timings
+
+
+# ---------------------------------------------------------------------------
+# History
+# ---------------------------------------------------------------------------
+
+
+def git_revision() -> Optional[str]:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, timeout=10
+        )
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def load_history(path: Path) -> List[dict]:
+    if not path.exists():
+        return []
+    out = []
+    for line in path.read_text(encoding="utf-8").splitlines():
+        if line.strip():
+            out.append(json.loads(line))
+    return out
+
+
+def find_regressions(history: List[dict], entry: dict, window: int, threshold: float) -> List[str]:
+    """Phases slower than `threshold` x the median of the last `window` comparable runs."""
+    comparable = [
+        h
+        for h in history
+        if h["rows"] == entry["rows"]
+        and h["latency_ms"] == entry["latency_ms"]
+        and h["fetch_workers"] == entry["fetch_workers"]
+    ][-window:]
+    out = []
+    for phase, seconds in entry["phases"].items():
+        previous = [h["phases"][phase] for h in comparable if phase in h["phases"]]
+        if not previous or phase == "generate_workbook":
+            continue
+        baseline = statistics.median(previous)
+        if baseline > 0 and seconds > baseline * threshold:
+            out.append(f"{phase}: {seconds:.3f}s vs median {baseline:.3f}s over {len(previous)} runs")
+    return out
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark compare-stays-xlsx-vs-supabase.py on synthetic data.")
+    parser.add_argument(
+        "--sizes",
+        default="10k,100k,1m",
+        help="Comma list of reservation counts (e.g. 10k,100k,1m).",
+    )
+    parser.add_argument("--latency-ms", type=float, default=30.0, help="Latency added to every fake page request.")
+    parser.add_argument("--fetch-workers", type=int, default=8, help="Worker count for the concurrent fetch phases.")
+    parser.add_argument("--drift", type=float, default=0.01, help="Share of rows dropped/renamed/edited per side.")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--history", type=Path, default=DEFAULT_HISTORY, help="JSONL file runs are appended to.")
+    parser.add_argument("--window", type=int, default=5, help="Past runs the regression check compares against.")
+    parser.add_argument("--threshold", type=float, default=1.25, help="Slowdown ratio reported as a regression.")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit 1 when any phase regresses.")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    sizes = [parse_size(s) for s in args.sizes.split(",") if s.strip()]
+    cmp = load_comparer()
+    history = load_history(args.history)
+    revision = git_revision()
+    regressions: List[str] = []
+
+    for rows in sizes:
+        print(f"\n=== {rows} reservations (latency {args.latency_ms:.0f} ms) ===")
+        timings = bench_size(cmp, rows, args.seed, args.latency_ms / 1000, args.fetch_workers, args.drift)
+        for t in timings:
+            suffix = f"  {t.detail}" if t.detail else ""
+            print(f"{t.phase:<24} {t.seconds:>9.3f}s{suffix}")
+
+        entry = {
+            "recorded_at": datetime.now(timezone.utc).isoformat(),
+            "revision": revision,
+            "python": platform.python_version(),
+            "rows": rows,
+            "latency_ms": args.latency_ms,
+            "fetch_workers": args.fetch_workers,
+            "phases": {t.phase: round(t.seconds, 4) for t in timings},
+        }
+        found = find_regressions(history, entry, args.window, args.threshold)
+        for line in found:
+            print(f"REGRESSION {line}")
+        regressions.extend(found)
+
+        args.history.parent.mkdir(parents=True, exist_ok=True)
+        with args.history.open("a", encoding="utf-8") as fh:
+            fh.write(json.dumps(entry) + "\n")
+        history.append(entry)
+
+    print(f"\nHISTORY={args.history}")
+    return 1 if regressions and args.fail_on_regression else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
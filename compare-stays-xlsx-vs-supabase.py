@@ -1,45 +1,80 @@
+import abc
+import argparse
+import cProfile
+import csv
+import hashlib
+import heapq
+import io
+import json
+import math
 import os
+import queue
+import random
 import re
+import sqlite3
 import sys
-from dataclasses import dataclass
+import tempfile
+import threading
+import time
+import unicodedata
+import uuid
+import zipfile
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import ExitStack, contextmanager, nullcontext
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta, timezone
 from pathlib import Path
-from typing import Dict, Iterable, List, Optional, Set, Tuple
-from urllib.parse import parse_qs, urlparse
+from typing import (
+    Callable,
+    ContextManager,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+from urllib.parse import parse_qs, quote, urlparse
+from xml.etree import ElementTree
 
 import requests
 from openpyxl import load_workbook
 
+from supabase_client import (
+    REFERENCE_TTL,
+    ReferenceCache,
+    SupabaseClient,
+    SupabaseConfig,
+    build_session,
+    configure_limiters,
+    iter_json_array,
+    limiter_stats,
+    load_supabase_config,
+    send_with_retry,
+    supabase_headers,
+)
 
-@dataclass(frozen=True)
-class SupabaseConfig:
-    url: str
-    anon_key: str
-
-
-def read_env_value(env_path: Path, key: str) -> Optional[str]:
-    if not env_path.exists():
-        return None
-    for line in env_path.read_text(encoding="utf-8", errors="ignore").splitlines():
-        if not line or line.lstrip().startswith("#"):
-            continue
-        if not line.startswith(key + "="):
-            continue
-        val = line.split("=", 1)[1].strip()
-        if (val.startswith('"') and val.endswith('"')) or (val.startswith("'") and val.endswith("'")):
-            val = val[1:-1]
-        return val.strip()
-    return None
-
+try:
+    import numpy as np
+except ImportError:  # optional: vectorizes the field diff when installed
+    np = None
 
-def load_supabase_config(repo_root: Path) -> SupabaseConfig:
-    env_path = repo_root / ".env.local"
-    supabase_url = read_env_value(env_path, "VITE_SUPABASE_URL") or read_env_value(env_path, "SUPABASE_URL")
-    anon_key = read_env_value(env_path, "VITE_SUPABASE_ANON_KEY") or read_env_value(env_path, "SUPABASE_ANON_KEY")
+try:
+    import resource
+except ImportError:  # Windows has no getrusage; peak RSS is reported as null there
+    resource = None
 
-    if not supabase_url or not anon_key:
-        raise RuntimeError(f"Missing VITE_SUPABASE_URL/VITE_SUPABASE_ANON_KEY in {env_path}")
-
-    return SupabaseConfig(url=supabase_url.rstrip("/"), anon_key=anon_key)
+DEFAULT_SNAPSHOT_PATH = Path(__file__).resolve().parent / ".cache" / "stays-reconciliation" / "reservations.sqlite"
+DEFAULT_AUDIT_DIR = Path(__file__).resolve().parents[1] / "planilhas auditoria"
+DEFAULT_HTTP_CACHE_PATH = Path(__file__).resolve().parent / ".cache" / "stays-reconciliation" / "http-cache.sqlite"
+DEFAULT_PROFILE_DIR = Path(__file__).resolve().parent / ".cache" / "stays-reconciliation" / "profiles"
 
 
 def normalize_id(value: object) -> Optional[str]:
@@ -74,139 +109,405 @@ def normalize_reserve_code(value: object) -> Optional[str]:
     return None
 
 
-def extract_xlsx_reserva_codes(xlsx_path: Path) -> Set[str]:
-    wb = load_workbook(filename=str(xlsx_path), read_only=True, data_only=True)
-    out: Set[str] = set()
+HEX_ID_RE = re.compile(r"\b[0-9a-fA-F]{24}\b")
+RESERVE_CODE_RE = re.compile(r"[A-Z0-9]{3,12}")
+NULL_TOKENS = {"NAN", "NONE", "NULL"}
+# Reservoir size per column for the 24-hex id detector; estimates are exact below this many cells.
+HEX_SAMPLE_SIZE = 512
+
+
+@dataclass
+class ColumnIndex:
+    sheet: str
+    header: str
+    position: int
+    codes: Set[str]
+    non_empty: int = 0
+    # Cells holding a 24-hex id, and a uniform reservoir sample of those ids (see pick_best_column).
+    hex_cells: int = 0
+    hex_sample: List[str] = field(default_factory=list)
+    # Full id set: collected during the scan for id-named headers, else read by WorkbookIndex.hex_ids.
+    hex_ids: Optional[Set[str]] = None
+
+
+@dataclass
+class FieldColumns:
+    """--fields columns of a sheet with a Reserva header, gathered while it is indexed.
+
+    `codes` holds each reserve code once, from its first row (like the Supabase side), and
+    `values[column][i]` is that row's cell under the export header of FieldRule `column`.
+    `requested` lists every rule column asked for, found in the export or not.
+    """
 
-    for sheet_name in wb.sheetnames:
-        ws = wb[sheet_name]
-        rows = ws.iter_rows(values_only=True)
+    requested: Tuple[str, ...]
+    codes: List[str]
+    values: Dict[str, List[object]]
+
+
+@dataclass
+class SheetIndex:
+    name: str
+    headers: List[str]
+    header_map: Dict[str, int]
+    rows: int
+    columns: List[ColumnIndex]
+    fields: Optional[FieldColumns] = None
+
+
+@dataclass
+class WorkbookIndex:
+    """Per-column view of a Stays export, built in one streaming pass over every sheet.
+
+    Each column keeps the values that normalize_reserve_code accepts (`codes`), so every
+    reconciliation mode queries this index instead of re-reading the workbook. 24-hex ids are
+    sampled per column; only columns whose header names an id keep their full set during the
+    pass, and hex_ids() reads any other column on demand.
+    """
+
+    path: Path
+    sheets: List[SheetIndex]
+
+    def column(self, sheet: str, header: str) -> Optional[ColumnIndex]:
+        for sh in self.sheets:
+            if sh.name == sheet and header in sh.header_map:
+                return sh.columns[sh.header_map[header]]
+        return None
+
+    def reserva_sheet(self, header: str = "Reserva") -> Optional[SheetIndex]:
+        for sh in self.sheets:
+            # Typically only one sheet matters; stop once found.
+            if header in sh.header_map and sh.columns[sh.header_map[header]].codes:
+                return sh
+        return None
+
+    def reserva_codes(self, header: str = "Reserva") -> Set[str]:
+        sh = self.reserva_sheet(header)
+        return set(sh.columns[sh.header_map[header]].codes) if sh else set()
+
+    def hex_ids(self, column: ColumnIndex) -> Set[str]:
+        """Every 24-hex id in `column` (lower-cased), read from the workbook once if not kept."""
+        if column.hex_ids is None:
+            self._materialize_hex_ids(column.sheet, [column])
+        return column.hex_ids
+
+    def _materialize_hex_ids(self, sheet: str, columns: Sequence[ColumnIndex]) -> None:
+        found: Dict[int, Set[str]] = {col.position: set() for col in columns}
+        hex_search = HEX_ID_RE.search
+        wb = load_workbook(filename=str(self.path), read_only=True, data_only=True)
         try:
-            header = next(rows)
-        except StopIteration:
-            continue
+            for row in wb[sheet].iter_rows(min_row=2, values_only=True):
+                for pos, ids in found.items():
+                    cell = row[pos] if pos < len(row) else None
+                    if cell is None:
+                        continue
+                    m = hex_search(cell if isinstance(cell, str) else str(cell))
+                    if m:
+                        ids.add(m.group(0).lower())
+        finally:
+            wb.close()
+        for col in columns:
+            col.hex_ids = found[col.position]
 
-        headers = [str(h).strip() if h is not None else f"col_{i+1}" for i, h in enumerate(header)]
-        if "Reserva" not in headers:
-            continue
-        col_idx = headers.index("Reserva")
-        for row in rows:
-            if col_idx >= len(row):
+    def ids_by_column(self) -> Dict[Tuple[str, str], Set[str]]:
+        """Materializes every id column (one read per sheet); prefer pick_best_column to find one."""
+        for sh in self.sheets:
+            missing = [col for col in sh.columns if col.hex_cells and col.hex_ids is None]
+            if missing:
+                self._materialize_hex_ids(sh.name, missing)
+        return {(col.sheet, col.header): col.hex_ids for sh in self.sheets for col in sh.columns if col.hex_cells}
+
+
+def index_sheet(sheet_name: str, rows: Iterator[tuple], rules: Sequence["FieldRule"] = ()) -> Optional[SheetIndex]:
+    """Index one sheet's rows (header first); None for an empty sheet.
+
+    Cells are classified by length once: reserve codes are 3-12 chars and 24-hex ids need at
+    least 24, so each cell runs at most one precompiled regex. Hex ids are kept as a fixed-size
+    reservoir sample per column (Algorithm R, seeded by sheet name so runs are repeatable), plus
+    the full set for columns whose header_id_score says they hold the reservation id. With
+    `rules`, a sheet with a Reserva header also collects their columns (SheetIndex.fields).
+    """
+    try:
+        header = next(rows)
+    except StopIteration:
+        return None
+
+    headers = [str(h).strip() if h is not None else f"col_{i+1}" for i, h in enumerate(header)]
+    width = len(headers)
+    code_sets: List[Set[str]] = [set() for _ in headers]
+    hex_samples: List[List[str]] = [[] for _ in headers]
+    hex_cells = [0] * width
+    hex_full: List[Optional[Set[str]]] = [set() if header_id_score(h) > 0 else None for h in headers]
+    non_empty = [0] * width
+    rng = random.Random(sheet_name)
+    code_match = RESERVE_CODE_RE.fullmatch
+    hex_search = HEX_ID_RE.search
+    row_count = 0
+
+    fields: Optional[FieldColumns] = None
+    field_positions: List[Tuple[List[object], int]] = []
+    if rules and "Reserva" in headers:
+        code_pos = headers.index("Reserva")
+        normalized: Dict[str, int] = {}
+        for i, h in enumerate(headers):
+            normalized.setdefault(normalize_header(h), i)
+        fields = FieldColumns(tuple(rule.column for rule in rules), [], {})
+        for rule in rules:
+            pos = next((normalized[h] for h in rule.headers if h in normalized), None)
+            if pos is not None:
+                field_positions.append((fields.values.setdefault(rule.column, []), pos))
+        field_codes: Set[str] = set()
+
+    for row in rows:
+        row_count += 1
+        if field_positions:
+            code = normalize_reserve_code(row[code_pos]) if code_pos < len(row) else None
+            if code and code not in field_codes:
+                field_codes.add(code)
+                fields.codes.append(code)
+                for values, pos in field_positions:
+                    values.append(row[pos] if pos < len(row) else None)
+        for i, cell in enumerate(row[:width]):
+            if cell is None:
                 continue
-            code = normalize_reserve_code(row[col_idx])
-            if code:
-                out.add(code)
-        # Typically only one sheet matters; stop once found.
-        if out:
-            break
+            s = cell.strip() if isinstance(cell, str) else str(cell).strip()
+            n = len(s)
+            if not n:
+                continue
+            non_empty[i] += 1
+            if n >= 24:
+                m = hex_search(s)
+                if m:
+                    hex_id = m.group(0).lower()
+                    hex_cells[i] += 1
+                    sample = hex_samples[i]
+                    if len(sample) < HEX_SAMPLE_SIZE:
+                        sample.append(hex_id)
+                    else:
+                        j = rng.randrange(hex_cells[i])
+                        if j < HEX_SAMPLE_SIZE:
+                            sample[j] = hex_id
+                    if hex_full[i] is not None:
+                        hex_full[i].add(hex_id)
+            elif 3 <= n <= 12:
+                u = s.upper()
+                if u not in NULL_TOKENS and code_match(u):
+                    code_sets[i].add(u)
+
+    header_map: Dict[str, int] = {}
+    for i, h in enumerate(headers):
+        header_map.setdefault(h, i)
+
+    columns = [
+        ColumnIndex(sheet_name, h, i, code_sets[i], non_empty[i], hex_cells[i], hex_samples[i], hex_full[i])
+        for i, h in enumerate(headers)
+    ]
+    return SheetIndex(sheet_name, headers, header_map, row_count, columns, fields)
+
 
+_XLSX_MAIN_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_XLSX_REL_ID = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id"
+_XLSX_PKG_REL = "{http://schemas.openxmlformats.org/package/2006/relationships}Relationship"
+
+
+def sheet_fingerprints(xlsx_path: Path) -> Dict[str, Tuple[int, ...]]:
+    """Sheet name -> CRC-32 and size of its worksheet part plus the shared strings and styles parts
+    its cells are read through, straight from the zip directory (nothing is decompressed)."""
+    with zipfile.ZipFile(xlsx_path) as zf:
+        infos = {info.filename: info for info in zf.infolist()}
+        rels = {
+            rel.get("Id"): rel.get("Target", "")
+            for rel in ElementTree.fromstring(zf.read("xl/_rels/workbook.xml.rels")).iter(_XLSX_PKG_REL)
+        }
+        shared = tuple(infos[name].CRC if name in infos else 0 for name in ("xl/sharedStrings.xml", "xl/styles.xml"))
+        out: Dict[str, Tuple[int, ...]] = {}
+        for sheet in ElementTree.fromstring(zf.read("xl/workbook.xml")).iter(f"{_XLSX_MAIN_NS}sheet"):
+            target = rels.get(sheet.get(_XLSX_REL_ID), "")
+            info = infos.get(target.lstrip("/") if target.startswith("/") else f"xl/{target}")
+            out[sheet.get("name")] = (info.CRC, info.file_size, *shared) if info else (0, 0, *shared)
     return out
 
 
-def extract_ids_by_column(xlsx_path: Path) -> Dict[Tuple[str, str], Set[str]]:
-    """Return {(sheetName, columnHeader): set(ids)} for every column.
+def index_sheet_hashed(
+    sheet_name: str, rows: Iterator[tuple], rules: Sequence["FieldRule"] = ()
+) -> Tuple[Optional[SheetIndex], str]:
+    """index_sheet plus a digest of the sheet's cell values, computed in the same pass."""
+    digest = hashlib.blake2b(digest_size=16)
 
-    We intentionally extract per-column so we can auto-detect which column represents reservation IDs.
+    def hashed() -> Iterator[tuple]:
+        for row in rows:
+            digest.update(repr(row).encode("utf-8"))
+            yield row
+
+    index = index_sheet(sheet_name, hashed(), rules)
+    return index, digest.hexdigest()
+
+
+# Worksheet XML (uncompressed) per worker below which a process costs more than it saves: each one
+# re-opens the workbook, parsing its shared strings again, and pickles its SheetIndexes back.
+PARALLEL_SHEETS_MIN_BYTES = 4 * 2**20
+
+
+def build_workbook_index(xlsx_path: Path, workers: int = 1, rules: Sequence["FieldRule"] = ()) -> WorkbookIndex:
+    """Index every sheet; with workers > 1 a large multi-sheet workbook is parsed by index_sheets.
+
+    `rules` are the --fields to collect in the same pass (see index_sheet).
     """
+    if workers > 1:
+        sizes = {name: fp[1] for name, fp in sheet_fingerprints(xlsx_path).items()}
+        if len(sizes) > 1 and sum(sizes.values()) >= 2 * PARALLEL_SHEETS_MIN_BYTES:
+            indexed = index_sheets(xlsx_path, sizes, workers, rules=rules)
+            return WorkbookIndex(path=xlsx_path, sheets=[indexed[name][0] for name in sizes if indexed[name][0]])
+
     wb = load_workbook(filename=str(xlsx_path), read_only=True, data_only=True)
-    out: Dict[Tuple[str, str], Set[str]] = {}
+    try:
+        sheets: List[SheetIndex] = []
+        for sheet_name in wb.sheetnames:
+            sheet = index_sheet(sheet_name, wb[sheet_name].iter_rows(values_only=True), rules)
+            if sheet:
+                sheets.append(sheet)
+    finally:
+        wb.close()
+    return WorkbookIndex(path=xlsx_path, sheets=sheets)
 
-    for sheet_name in wb.sheetnames:
-        ws = wb[sheet_name]
-        rows = ws.iter_rows(values_only=True)
-        try:
-            header = next(rows)
-        except StopIteration:
-            continue
 
-        headers = [str(h).strip() if h is not None else f"col_{i+1}" for i, h in enumerate(header)]
-        col_sets: List[Set[str]] = [set() for _ in headers]
+def _index_sheet_group(
+    xlsx_path: Path, names: Sequence[str], hashed: bool, rules: Sequence["FieldRule"] = ()
+) -> List[Tuple[str, Optional[SheetIndex], Optional[str]]]:
+    """Process-pool task: open the workbook once and index (and optionally hash) `names`."""
+    wb = load_workbook(filename=str(xlsx_path), read_only=True, data_only=True)
+    try:
+        out: List[Tuple[str, Optional[SheetIndex], Optional[str]]] = []
+        for name in names:
+            rows = wb[name].iter_rows(values_only=True)
+            if hashed:
+                out.append((name, *index_sheet_hashed(name, rows, rules)))
+            else:
+                out.append((name, index_sheet(name, rows, rules), None))
+        return out
+    finally:
+        wb.close()
+
 
-        for row in rows:
-            for i, cell in enumerate(row[: len(headers)]):
-                nid = normalize_id(cell)
-                if nid and re.fullmatch(r"[0-9a-f]{24}", nid):
-                    col_sets[i].add(nid)
+def index_sheets(
+    xlsx_path: Path,
+    sizes: Dict[str, int],
+    workers: int,
+    hashed: bool = False,
+    rules: Sequence["FieldRule"] = (),
+) -> Dict[str, Tuple[Optional[SheetIndex], Optional[str]]]:
+    """Index the sheets named in `sizes` (name -> uncompressed part bytes) across worker processes.
 
-        for i, ids in enumerate(col_sets):
-            if ids:
-                out[(sheet_name, headers[i])] = ids
+    Sheets are packed into one group per worker, largest first onto the lightest group, so each
+    worker opens the workbook (and parses its shared strings) once. Workers are capped by the CPU
+    count and by PARALLEL_SHEETS_MIN_BYTES of XML each. Returns name -> (SheetIndex or None,
+    content hash when `hashed`).
+    """
+    workers = min(workers, os.cpu_count() or 1, len(sizes), sum(sizes.values()) // PARALLEL_SHEETS_MIN_BYTES)
+    groups: List[List[str]] = [[] for _ in range(max(1, workers))]
+    loads = [(0, i) for i in range(len(groups))]
+    for name in sorted(sizes, key=sizes.get, reverse=True):
+        load, i = heapq.heappop(loads)
+        groups[i].append(name)
+        heapq.heappush(loads, (load + sizes[name], i))
+    if len(groups) == 1:
+        return {
+            name: (index, digest) for name, index, digest in _index_sheet_group(xlsx_path, groups[0], hashed, rules)
+        }
+    with ProcessPoolExecutor(max_workers=len(groups)) as pool:
+        n = len(groups)
+        done = pool.map(_index_sheet_group, [xlsx_path] * n, groups, [hashed] * n, [tuple(rules)] * n)
+        return {name: (index, digest) for group in done for name, index, digest in group}
 
-    return out
 
+def _as_index(source: Union[Path, WorkbookIndex]) -> WorkbookIndex:
+    return source if isinstance(source, WorkbookIndex) else build_workbook_index(source)
 
-def pick_best_column(xlsx_path: Path, supabase_ids: Set[str]) -> Tuple[Set[str], str]:
-    cols = extract_ids_by_column(xlsx_path)
-    best_ids: Set[str] = set()
-    best_key: Optional[Tuple[str, str]] = None
-    best_overlap = -1
 
-    for key, ids in cols.items():
-        overlap = len(ids & supabase_ids)
-        # Prefer higher overlap; tie-breaker: closer to 498-ish.
-        if overlap > best_overlap or (overlap == best_overlap and abs(len(ids) - 498) < abs(len(best_ids) - 498)):
-            best_overlap = overlap
-            best_ids = ids
-            best_key = key
+def extract_xlsx_reserva_codes(source: Union[Path, WorkbookIndex]) -> Set[str]:
+    return _as_index(source).reserva_codes()
 
-    if not best_key:
-        return set(), "<no columns with 24-hex ids found>"
 
-    sheet, col = best_key
-    return best_ids, f"{sheet}::{col} (overlapWithSupabase={best_overlap}, idsInColumn={len(best_ids)})"
+def extract_ids_by_column(source: Union[Path, WorkbookIndex]) -> Dict[Tuple[str, str], Set[str]]:
+    """Return {(sheetName, columnHeader): set(ids)} for every column.
 
+    We intentionally extract per-column so we can auto-detect which column represents reservation IDs.
+    """
+    return _as_index(source).ids_by_column()
 
-def fetch_supabase_external_ids(
-    cfg: SupabaseConfig,
-    check_in_from: str,
-    check_in_to: str,
-    only_imported: bool = True,
-) -> List[str]:
-    headers = {
-        "apikey": cfg.anon_key,
-        "Authorization": f"Bearer {cfg.anon_key}",
-    }
 
-    filters = [
-        f"check_in=gte.{check_in_from}",
-        f"check_in=lte.{check_in_to}",
-    ]
-    if only_imported:
-        filters.append("external_id=not.is.null")
+# Header tokens (after normalize_header) that name the reservation's own id vs another entity's.
+RESERVATION_ID_TOKENS = {"reserva", "reservation", "booking"}
+OTHER_ENTITY_TOKENS = {
+    "imovel", "listing", "propriedade", "property", "proprietario", "owner", "hospede", "guest", "cliente", "client"
+}
+# Two-sided 95% normal quantile: candidates within this many standard errors of the leader tie.
+Z_95 = 1.96
 
-    select = "external_id"
-    page_size = 1000
-    offset = 0
-    out: List[str] = []
 
-    while True:
-        qs_parts = [
-            f"select={select}",
-            f"order=external_id.asc",
-            f"limit={page_size}",
-            f"offset={offset}",
-            *filters,
-        ]
-        uri = f"{cfg.url}/rest/v1/reservations?" + "&".join(qs_parts)
-        resp = requests.get(uri, headers=headers, timeout=60)
-        resp.raise_for_status()
-        data = resp.json()
-        if not isinstance(data, list):
-            raise RuntimeError(f"Unexpected response type: {type(data)}")
+@dataclass(frozen=True)
+class ColumnCandidate:
+    column: ColumnIndex
+    sampled: int
+    sample_hits: int
+    estimated_overlap: float
+    margin: float
+    header_score: int
 
-        got = 0
-        for row in data:
-            ext = normalize_id(row.get("external_id"))
-            if ext and re.fullmatch(r"[0-9a-f]{24}", ext.lower()):
-                out.append(ext.lower())
-                got += 1
 
-        if len(data) < page_size:
-            break
-        offset += page_size
+def header_id_score(header: str) -> int:
+    """2: names the reservation id, 1: a bare id, 0: anything else, -1: another entity's id."""
+    tokens = set(normalize_header(header).split("_"))
+    if tokens & OTHER_ENTITY_TOKENS:
+        return -1
+    if "id" in tokens:
+        return 2 if tokens & RESERVATION_ID_TOKENS else 1
+    return 0
 
-    # De-dup (should already be unique, but keep stable)
-    return sorted(set(out))
+
+def rank_id_columns(index: WorkbookIndex, supabase_ids: Set[str]) -> List[ColumnCandidate]:
+    """Rank columns holding 24-hex ids by how many of them Supabase knows, estimated from samples.
+
+    Each column's overlap is estimated as (sample hit rate) x (cells with an id), with a 95%
+    margin from the finite-population standard error (zero when the sample is the whole column).
+    Columns whose estimates are statistically tied with the leader are ordered by header_id_score.
+    """
+    candidates: List[ColumnCandidate] = []
+    for sh in index.sheets:
+        for col in sh.columns:
+            if not col.hex_cells:
+                continue
+            n, population = len(col.hex_sample), col.hex_cells
+            hits = sum(1 for value in col.hex_sample if value in supabase_ids)
+            rate = hits / n
+            fpc = (population - n) / (population - 1) if population > 1 else 0.0
+            margin = Z_95 * population * math.sqrt(rate * (1 - rate) / n * fpc)
+            candidates.append(ColumnCandidate(col, n, hits, rate * population, margin, header_id_score(col.header)))
+    if not candidates:
+        return []
+
+    leader = max(candidates, key=lambda c: c.estimated_overlap)
+    floor = leader.estimated_overlap - leader.margin
+    return sorted(
+        candidates,
+        key=lambda c: (c.estimated_overlap + c.margin >= floor, c.header_score, c.estimated_overlap),
+        reverse=True,
+    )
+
+
+def pick_best_column(source: Union[Path, WorkbookIndex], supabase_ids: Set[str]) -> Tuple[Set[str], str]:
+    """Ids of the column that best matches `supabase_ids`; only that column is read in full."""
+    index = _as_index(source)
+    ranked = rank_id_columns(index, supabase_ids)
+    if not ranked:
+        return set(), "<no columns with 24-hex ids found>"
+
+    best = ranked[0]
+    ids = index.hex_ids(best.column)
+    overlap = len(ids & supabase_ids)
+    return ids, (
+        f"{best.column.sheet}::{best.column.header} (overlapWithSupabase={overlap}, idsInColumn={len(ids)}, "
+        f"sampled={best.sampled}/{best.column.hex_cells}, candidates={len(ranked)})"
+    )
 
 
 def extract_reserve_code_from_url(url: Optional[str]) -> Optional[str]:
@@ -221,96 +522,3129 @@ def extract_reserve_code_from_url(url: Optional[str]) -> Optional[str]:
         return None
 
 
-def fetch_supabase_reserve_codes(
+def peak_rss_bytes() -> Optional[int]:
+    """High-water resident set size of this process (ru_maxrss is KiB on Linux, bytes on macOS)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+@dataclass
+class PhaseTiming:
+    wall_s: float = 0.0
+    cpu_s: float = 0.0
+    calls: int = 0
+    peak_rss_bytes: Optional[int] = None
+
+    def add(self, wall_s: float, cpu_s: float, calls: int, peak: Optional[int]) -> None:
+        self.wall_s += wall_s
+        self.cpu_s += cpu_s
+        self.calls += calls
+        if peak is not None:
+            self.peak_rss_bytes = max(self.peak_rss_bytes or 0, peak)
+
+
+class PhaseProfiler:
+    """Wall/CPU time and peak RSS per named phase, plus one record per PostgREST page.
+
+    A disabled profiler costs one attribute check per phase or page. Phase CPU time is
+    process-wide (a phase may fan out to a thread pool); page CPU time is the fetching thread's.
+    Peak RSS is the process high-water mark when the phase ended, so the first phase that
+    reports the overall peak is the one that grew memory.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        self.phases: Dict[str, PhaseTiming] = {}
+        self.pages: List[dict] = []
+        self.periods: List[dict] = []
+        self.organizations: List[dict] = []
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+        wall0, cpu0 = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self._add(name, time.perf_counter() - wall0, time.process_time() - cpu0, 1, peak_rss_bytes())
+
+    def _add(self, name: str, wall_s: float, cpu_s: float, calls: int, peak: Optional[int]) -> None:
+        with self._lock:
+            self.phases.setdefault(name, PhaseTiming()).add(wall_s, cpu_s, calls, peak)
+
+    def record_page(self, table: str, rows: int, nbytes: int, wall_s: float, cpu_s: float) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self.pages.append({"table": table, "rows": rows, "bytes": nbytes, "wall_s": wall_s, "cpu_s": cpu_s})
+
+    def merge(self, phases: Dict[str, dict], pages: Iterable[dict] = ()) -> None:
+        """Fold in a phase_summary() and page records recorded elsewhere (a worker process)."""
+        for name, t in phases.items():
+            self._add(name, t["wall_s"], t["cpu_s"], t["calls"], t["peak_rss_bytes"])
+        with self._lock:
+            self.pages.extend(pages)
+
+    def phase_summary(self) -> Dict[str, dict]:
+        return {
+            name: {
+                "wall_s": round(t.wall_s, 4),
+                "cpu_s": round(t.cpu_s, 4),
+                "calls": t.calls,
+                "peak_rss_bytes": t.peak_rss_bytes,
+            }
+            for name, t in self.phases.items()
+        }
+
+    def page_summary(self) -> Dict[str, dict]:
+        """Per table: page count, rows, bytes and the wall-time distribution of single pages."""
+        out: Dict[str, dict] = {}
+        for table in sorted({page["table"] for page in self.pages}):
+            pages = [page for page in self.pages if page["table"] == table]
+            walls = sorted(page["wall_s"] for page in pages)
+            out[table] = {
+                "pages": len(pages),
+                "rows": sum(page["rows"] for page in pages),
+                "bytes": sum(page["bytes"] for page in pages),
+                "wall_s": round(sum(walls), 4),
+                "cpu_s": round(sum(page["cpu_s"] for page in pages), 4),
+                "page_wall_s_p50": round(walls[len(walls) // 2], 4),
+                "page_wall_s_p95": round(walls[min(len(walls) - 1, int(len(walls) * 0.95))], 4),
+                "page_wall_s_max": round(walls[-1], 4),
+            }
+        return out
+
+    def summary(self) -> dict:
+        out: dict = {"phases": self.phase_summary(), "pages": self.page_summary()}
+        if self.periods:
+            out["periods"] = self.periods
+        if self.organizations:
+            out["organizations"] = self.organizations
+        return out
+
+
+# Process-wide profiler; main() enables it for --profile, fleet workers via their initializer.
+PROFILER = PhaseProfiler()
+
+
+PAGINATION_MODES = ("keyset", "offset")
+TRANSFER_FORMATS = ("json", "csv")
+
+
+HTTP_CACHE_VERSION = 1
+HTTP_CACHE_MAX_AGE_DAYS = 30
+HTTP_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    cache_key TEXT PRIMARY KEY,  -- sha256 of method, URI, Accept and Authorization
+    etag TEXT NOT NULL,
+    content_range TEXT,
+    body BLOB NOT NULL,          -- zlib-compressed decoded body
+    stored_at REAL NOT NULL
+);
+"""
+
+
+class HttpBody(NamedTuple):
+    body: bytes
+    content_range: Optional[str]
+    wire_bytes: int  # bytes off the socket: the compressed body, or ~0 for a 304
+    revalidated: bool
+
+
+class HttpCache:
+    """ETag store for repeated PostgREST page reads.
+
+    A stored body is only ever reused after the server answers `If-None-Match` with 304, so a
+    cached page can never be stale; unchanged windows cost one empty response per page. Only
+    responses that carry an ETag are stored, and stock PostgREST sends none, so the cache needs
+    a proxy in front of it that adds ETags and answers conditional GETs (otherwise it only
+    costs a buffered body per page). Disabled (plain GETs) until open() is called, which the
+    CLI does only for --http-cache.
+    """
+
+    def __init__(self) -> None:
+        self.conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self.revalidated = 0
+        self.fetched = 0
+        self.bytes_saved = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.conn is not None
+
+    def open(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Page fetches run on worker threads and fleet processes share the file.
+        self.conn = sqlite3.connect(str(path), timeout=60, check_same_thread=False, isolation_level=None)
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != HTTP_CACHE_VERSION:
+            self.conn.executescript("DROP TABLE IF EXISTS responses;")
+            self.conn.execute(f"PRAGMA user_version = {HTTP_CACHE_VERSION}")
+        self.conn.executescript(HTTP_CACHE_SCHEMA)
+        self.conn.execute("DELETE FROM responses WHERE stored_at < ?", (time.time() - HTTP_CACHE_MAX_AGE_DAYS * 86400,))
+
+    def close(self) -> None:
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    @staticmethod
+    def _key(uri: str, headers: Dict[str, str]) -> str:
+        parts = ("GET", uri, headers.get("Accept", ""), headers.get("Authorization", ""))
+        return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+    def get(self, session: requests.Session, uri: str, headers: Dict[str, str], timeout: float = 60) -> HttpBody:
+        """GET `uri`, revalidating a stored copy; raises for non-2xx like raise_for_status."""
+        cached = None
+        # A Prefer: count=... total is not covered by the body's ETag, so counted reads skip the cache.
+        cacheable = self.enabled and "count=" not in headers.get("Prefer", "")
+        if cacheable:
+            key = self._key(uri, headers)
+            with self._lock:
+                cached = self.conn.execute(
+                    "SELECT etag, content_range, body FROM responses WHERE cache_key = ?", (key,)
+                ).fetchone()
+            if cached:
+                headers["If-None-Match"] = cached[0]
+
+        resp = send_with_retry(session, "GET", uri, headers, timeout=timeout, raise_for_status=False)
+        wire_bytes = resp.raw.tell()
+        if cached and resp.status_code == 304:
+            body = zlib.decompress(cached[2])
+            with self._lock:
+                self.revalidated += 1
+                self.bytes_saved += len(body)
+            return HttpBody(body, cached[1], wire_bytes, True)
+        resp.raise_for_status()
+        body = resp.content
+        etag = resp.headers.get("ETag")
+        content_range = resp.headers.get("Content-Range")
+        with self._lock:
+            self.fetched += 1
+            if cacheable and etag:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO responses (cache_key, etag, content_range, body, stored_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, etag, content_range, zlib.compress(body, 1), time.time()),
+                )
+        return HttpBody(body, content_range, wire_bytes, False)
+
+
+HTTP_CACHE = HttpCache()
+
+
+def print_http_stats() -> None:
+    if HTTP_CACHE.enabled and (HTTP_CACHE.revalidated or HTTP_CACHE.fetched):
+        print(
+            f"HTTP_CACHE_REVALIDATED={HTTP_CACHE.revalidated} HTTP_CACHE_FETCHED={HTTP_CACHE.fetched} "
+            f"HTTP_CACHE_BYTES_SAVED={HTTP_CACHE.bytes_saved}"
+        )
+    for name, limiter in limiter_stats().items():
+        if limiter.throttled:
+            print(
+                f"LIMITER[{name}] limit={limiter.limit:.1f}/{limiter.max_limit} "
+                f"throttled={limiter.throttled} decreases={limiter.decreases}"
+            )
+
+
+class CsvPage:
+    """One text/csv page kept as the reader's string rows; PostgREST writes NULL as an empty cell.
+
+    Quacks like a page of dicts where iter_supabase_pages needs it (len, truthiness, data[-1]
+    for the keyset cursor) without building a dict per row.
+    """
+
+    __slots__ = ("columns", "rows")
+
+    def __init__(self, columns: List[str], rows: List[List[str]]):
+        self.columns = columns
+        self.rows = rows
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, i: int) -> dict:
+        return {col: cell if cell != "" else None for col, cell in zip(self.columns, self.rows[i])}
+
+    def position(self, column: str) -> int:
+        return self.columns.index(column)
+
+
+def count_supabase_rows(
+    session: requests.Session,
+    cfg: SupabaseConfig,
+    table: str,
+    filters: List[str],
+    count: str = "exact",
+) -> int:
+    """Size a filtered result set from a HEAD's Content-Range total (e.g. `0-0/1234` or `*/0`).
+
+    count="estimated" lets PostgREST answer from the planner's statistics once the result
+    exceeds its max-rows, instead of counting every row.
+    """
+    uri = f"{cfg.url}/rest/v1/{table}?" + "&".join(["limit=1", *filters])
+    headers = {**supabase_headers(cfg), "Prefer": f"count={count}"}
+    resp = send_with_retry(session, "HEAD", uri, headers)
+    content_range = resp.headers.get("Content-Range", "")
+    total = content_range.rsplit("/", 1)[-1]
+    if not total.isdigit():
+        raise RuntimeError(f"Unexpected Content-Range header: {content_range!r}")
+    return int(total)
+
+
+class PagePlan(NamedTuple):
+    """How many rows a paged read should find and how it splits into pages.
+
+    `total` is PostgREST's count=estimated: exact up to the server's max-rows, the planner's
+    estimate past it, so a walk over a large result may end a little off the plan.
+    """
+
+    total: int
+    page_size: int
+
+    @property
+    def pages(self) -> int:
+        return -(-self.total // self.page_size)
+
+    def offsets(self) -> range:
+        return range(0, self.pages * self.page_size, self.page_size)
+
+
+def plan_supabase_pages(
+    session: requests.Session,
     cfg: SupabaseConfig,
+    table: str,
+    filters: List[str],
+    page_size: int = 1000,
+) -> PagePlan:
+    """Size a paged read up front with a single body-less HEAD (Prefer: count=estimated)."""
+    return PagePlan(count_supabase_rows(session, cfg, table, filters, "estimated"), page_size)
+
+
+class FetchProgress:
+    """Page-fetch progress line on stderr, against a PagePlan when the fetch has one.
+
+    Silent unless stderr is a terminal.
+    """
+
+    def __init__(self) -> None:
+        self.quiet = False  # fleet workers share the terminal
+        self.plans: Dict[str, Optional[PagePlan]] = {}
+        self.rows: Dict[str, int] = {}
+        self.pages: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return not self.quiet and sys.stderr.isatty()
+
+    def start(self, table: str, plan: Optional[PagePlan] = None) -> None:
+        with self._lock:
+            self.plans[table] = plan
+            self.rows[table] = self.pages[table] = 0
+
+    def page(self, table: str, rows: int) -> None:
+        with self._lock:
+            if table not in self.plans or not rows:
+                return
+            plan = self.plans[table]
+            self.rows[table] += rows
+            self.pages[table] += 1
+            if self.enabled:
+                of_rows, of_pages = (f"/~{plan.total}", f"/~{plan.pages}") if plan else ("", "")
+                sys.stderr.write(
+                    f"\rfetch {table}: {self.rows[table]}{of_rows} rows, {self.pages[table]}{of_pages} pages"
+                )
+                sys.stderr.flush()
+
+    def finish(self, table: str) -> None:
+        with self._lock:
+            if table in self.plans and self.enabled and self.pages[table]:
+                sys.stderr.write("\n")
+            self.plans.pop(table, None)
+
+
+PROGRESS = FetchProgress()
+
+
+def _reservation_filters(
     check_in_from: str,
     check_in_to: str,
-    only_imported: bool = True,
-) -> Tuple[Dict[str, str], Set[str]]:
-    """Return (reserveCode -> reservationId, set(reserveCodes))."""
-    headers = {
-        "apikey": cfg.anon_key,
-        "Authorization": f"Bearer {cfg.anon_key}",
-    }
-
+    only_imported: bool,
+    organization_id: Optional[str] = None,
+) -> List[str]:
     filters = [
         f"check_in=gte.{check_in_from}",
         f"check_in=lte.{check_in_to}",
     ]
     if only_imported:
         filters.append("external_id=not.is.null")
+    if organization_id:
+        filters.append(f"organization_id=eq.{organization_id}")
+    return filters
 
-    select = "id,external_url"
-    page_size = 1000
-    offset = 0
-    mapping: Dict[str, str] = {}
-    codes: Set[str] = set()
 
-    while True:
-        qs_parts = [
-            f"select={select}",
-            f"order=check_in.asc",
-            f"limit={page_size}",
-            f"offset={offset}",
-            *filters,
-        ]
-        uri = f"{cfg.url}/rest/v1/reservations?" + "&".join(qs_parts)
-        resp = requests.get(uri, headers=headers, timeout=60)
-        resp.raise_for_status()
-        data = resp.json()
+def _quote_cursor_value(value: object) -> str:
+    """Double-quote a value for a PostgREST logic tree (or=/and=), then URL-encode it."""
+    s = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return quote(f'"{s}"', safe="")
+
+
+def _keyset_filter(keys: Sequence[str], last_row: dict) -> str:
+    """Filter selecting rows whose key tuple sorts after `last_row` (WHERE (k1, k2) > (v1, v2))."""
+    if len(keys) == 1:
+        return f"{keys[0]}=gt.{quote(str(last_row[keys[0]]), safe='')}"
+
+    def tree(i: int) -> str:
+        key = keys[i]
+        val = _quote_cursor_value(last_row[key])
+        if i == len(keys) - 1:
+            return f"{key}.gt.{val}"
+        return f"or({key}.gt.{val},and({key}.eq.{val},{tree(i + 1)}))"
+
+    return "or=" + tree(0)[len("or"):]
+
+
+def _fetch_page(
+    session: requests.Session,
+    cfg: SupabaseConfig,
+    table: str,
+    select: str,
+    order: str,
+    filters: List[str],
+    page_size: int,
+    offset: Optional[int] = None,
+    transfer: str = "json",
+) -> Union[List[dict], CsvPage]:
+    """One page of `table`, revalidated through HTTP_CACHE when it is open.
+
+    transfer="csv" asks for text/csv; with the cache off it is streamed through csv.reader.
+    """
+    qs_parts = [
+        f"select={select}",
+        f"order={order}",
+        f"limit={page_size}",
+        *filters,
+    ]
+    if offset is not None:
+        qs_parts.append(f"offset={offset}")
+    uri = f"{cfg.url}/rest/v1/{table}?" + "&".join(qs_parts)
+    wall0, cpu0 = time.perf_counter(), time.thread_time()
+    if transfer == "csv" and not HTTP_CACHE.enabled:
+        headers = {**supabase_headers(cfg), "Accept": "text/csv"}
+        with send_with_retry(session, "GET", uri, headers, stream=True) as resp:
+            resp.raw.decode_content = True
+            # Let TextIOWrapper see EOF instead of urllib3 closing the stream under it.
+            resp.raw.auto_close = False
+            reader = csv.reader(io.TextIOWrapper(resp.raw, encoding="utf-8", newline=""))
+            data = CsvPage(next(reader, []), list(reader))
+            nbytes = resp.raw.tell()
+    elif transfer == "csv":
+        # The cache needs the whole body to store it, so the page is parsed once it has arrived.
+        page = HTTP_CACHE.get(session, uri, {**supabase_headers(cfg), "Accept": "text/csv"})
+        reader = csv.reader(io.StringIO(page.body.decode("utf-8"), newline=""))
+        data = CsvPage(next(reader, []), list(reader))
+        nbytes = page.wire_bytes
+    else:
+        page = HTTP_CACHE.get(session, uri, supabase_headers(cfg))
+        data = json.loads(page.body)
         if not isinstance(data, list):
             raise RuntimeError(f"Unexpected response type: {type(data)}")
+        nbytes = page.wire_bytes
+    # nbytes is what came off the socket, i.e. the compressed size.
+    PROFILER.record_page(table, len(data), nbytes, time.perf_counter() - wall0, time.thread_time() - cpu0)
+    PROGRESS.page(table, len(data))
+    return data
 
-        for row in data:
-            rid = row.get("id")
-            code = extract_reserve_code_from_url(row.get("external_url"))
-            if rid and code:
-                codes.add(code)
-                # If duplicates happen, keep the first and still collect codes.
-                mapping.setdefault(code, str(rid))
 
+def iter_supabase_pages(
+    session: requests.Session,
+    cfg: SupabaseConfig,
+    table: str,
+    select: str,
+    keys: Sequence[str],
+    filters: List[str],
+    page_size: int = 1000,
+    pagination: str = "keyset",
+    transfer: str = "json",
+) -> Iterator[Union[List[dict], CsvPage]]:
+    """Yield pages of `table` ordered by `keys` (which must be unique and non-null together).
+
+    keyset: each page resumes strictly after the last key seen, so every request is an index
+    range scan and rows written by the Stays webhooks mid-walk cannot shift later pages.
+    offset: limit/offset fallback; Postgres re-skips every earlier row on each page.
+    transfer="csv" yields CsvPage objects instead of lists of dicts.
+    """
+    if pagination not in PAGINATION_MODES:
+        raise ValueError(f"Unknown pagination mode: {pagination!r}")
+    if transfer not in TRANSFER_FORMATS:
+        raise ValueError(f"Unknown transfer format: {transfer!r}")
+
+    order = ",".join(f"{key}.asc" for key in keys)
+    offset = 0
+    cursor: List[str] = []
+
+    while True:
+        if pagination == "keyset":
+            data = _fetch_page(
+                session, cfg, table, select, order, [*filters, *cursor], page_size, transfer=transfer
+            )
+        else:
+            data = _fetch_page(session, cfg, table, select, order, filters, page_size, offset=offset, transfer=transfer)
+        if data:
+            yield data
         if len(data) < page_size:
             break
         offset += page_size
+        cursor = [_keyset_filter(keys, data[-1])]
 
-    return mapping, codes
 
+def iter_supabase_rows_streamed(
+    session: requests.Session,
+    cfg: SupabaseConfig,
+    table: str,
+    select: str,
+    keys: Sequence[str],
+    filters: List[str],
+    page_size: int = 1000,
+) -> Iterator[dict]:
+    """Keyset walk like iter_supabase_pages, yielding rows as they are decoded off the socket.
 
-def main() -> int:
-    workspace_root = Path(__file__).resolve().parents[1]
-    repo_root = Path(__file__).resolve().parent
+    For wide rows (JSONB payloads): neither a page body nor a page of dicts is ever held, only
+    the row being decoded, so memory does not grow with page_size. Pages bypass HTTP_CACHE.
+    """
+    order = ",".join(f"{key}.asc" for key in keys)
+    cursor: List[str] = []
+    while True:
+        qs_parts = [f"select={select}", f"order={order}", f"limit={page_size}", *filters, *cursor]
+        uri = f"{cfg.url}/rest/v1/{table}?" + "&".join(qs_parts)
+        headers = supabase_headers(cfg)
+        wall0, cpu0 = time.perf_counter(), time.thread_time()
+        rows = 0
+        last: Optional[dict] = None
+        with send_with_retry(session, "GET", uri, headers, stream=True) as resp:
+            resp.raw.decode_content = True
+            for row in iter_json_array(resp.raw):
+                rows += 1
+                last = {key: row[key] for key in keys}
+                yield row
+            nbytes = resp.raw.tell()
+        PROFILER.record_page(table, rows, nbytes, time.perf_counter() - wall0, time.thread_time() - cpu0)
+        if rows < page_size:
+            return
+        cursor = [_keyset_filter(keys, last)]
 
-    xlsx = workspace_root / "planilhas auditoria" / "2025-12-01_2025-12-31_propX_ownerX.xlsx"
-    if not xlsx.exists():
-        print(f"ERROR: XLSX not found: {xlsx}")
-        return 2
 
-    cfg = load_supabase_config(repo_root)
+def _split_check_in_range(check_in_from: str, check_in_to: str, parts: int) -> List[Tuple[str, str]]:
+    """Split an inclusive check_in window into up to `parts` contiguous, ascending day ranges."""
+    start = date.fromisoformat(check_in_from)
+    end = date.fromisoformat(check_in_to)
+    days = (end - start).days + 1
+    parts = max(1, min(parts, days))
+    out: List[Tuple[str, str]] = []
+    for i in range(parts):
+        lo = start + timedelta(days=(days * i) // parts)
+        hi = start + timedelta(days=(days * (i + 1)) // parts - 1)
+        out.append((lo.isoformat(), hi.isoformat()))
+    return out
+
+
+def fetch_supabase_external_ids(
+    cfg: SupabaseConfig,
+    check_in_from: str,
+    check_in_to: str,
+    only_imported: bool = True,
+    pagination: str = "keyset",
+    organization_id: Optional[str] = None,
+    session: Optional[requests.Session] = None,
+) -> List[str]:
+    filters = _reservation_filters(check_in_from, check_in_to, only_imported, organization_id)
+    session = session or build_session(pool_size=1)
+    out: List[str] = []
+
+    # external_id is neither unique nor (without only_imported) non-null, so id breaks ties in
+    # the keyset, and alone orders the walk when NULLs may come back.
+    keys = ("external_id", "id") if only_imported else ("id",)
+    for data in iter_supabase_pages(
+        session, cfg, "reservations", "external_id,id", keys, filters, pagination=pagination
+    ):
+        for row in data:
+            ext = normalize_id(row.get("external_id"))
+            if ext and re.fullmatch(r"[0-9a-f]{24}", ext.lower()):
+                out.append(ext.lower())
+
+    # De-dup (should already be unique, but keep stable)
+    return sorted(set(out))
+
+
+RESERVATION_COLUMNS = ("id", "check_in", "external_url")
 
-    xlsx_reserva = extract_xlsx_reserva_codes(xlsx)
-    mapping, supa_reserva = fetch_supabase_reserve_codes(cfg, "2025-12-01", "2025-12-31", only_imported=True)
 
-    only_in_supabase = sorted(supa_reserva - xlsx_reserva)
-    only_in_xlsx = sorted(xlsx_reserva - supa_reserva)
+class ReservationRow(NamedTuple):
+    id: str
+    check_in: str
+    reserve_code: Optional[str]
+    # Values of the `extra_columns` requested from the fetch, in request order.
+    fields: Tuple[object, ...] = ()
+
+
+def reserve_codes_from_rows(rows: Iterable[ReservationRow]) -> Tuple[Dict[str, str], Set[str]]:
+    mapping: Dict[str, str] = {}
+    codes: Set[str] = set()
+    for row in rows:
+        if row.reserve_code:
+            codes.add(row.reserve_code)
+            # If duplicates happen, keep the first and still collect codes.
+            mapping.setdefault(row.reserve_code, row.id)
+    return mapping, codes
+
+
+def _csv_cell(cell: str, numeric: bool) -> object:
+    if cell == "":
+        return None
+    if numeric:
+        return int(cell) if cell.lstrip("-").isdigit() else float(cell)
+    return cell
+
+
+def reservation_rows_from_page(
+    data: Union[List[dict], CsvPage], extra_columns: Sequence[str] = ()
+) -> Iterator[ReservationRow]:
+    """Normalize one page; CSV pages go straight from the reader's string rows, skipping dicts.
+
+    CSV cells are text, so numeric field columns are parsed here to match what JSON would carry.
+    """
+    if not isinstance(data, CsvPage):
+        for row in data:
+            if row.get("id"):
+                yield ReservationRow(
+                    str(row["id"]),
+                    row["check_in"],
+                    extract_reserve_code_from_url(row.get("external_url")),
+                    tuple(row.get(col) for col in extra_columns),
+                )
+        return
+
+    id_pos, check_in_pos, url_pos = (data.position(col) for col in ("id", "check_in", "external_url"))
+    extras = [(data.position(col), col in NUMERIC_FIELD_COLUMNS) for col in extra_columns]
+    for row in data.rows:
+        if row[id_pos]:
+            yield ReservationRow(
+                row[id_pos],
+                row[check_in_pos],
+                extract_reserve_code_from_url(row[url_pos]),
+                tuple(_csv_cell(row[pos], numeric) for pos, numeric in extras),
+            )
+
+
+def fetch_supabase_reservation_rows(
+    cfg: SupabaseConfig,
+    check_in_from: str,
+    check_in_to: str,
+    only_imported: bool = True,
+    workers: int = 1,
+    page_size: int = 1000,
+    pagination: str = "keyset",
+    organization_id: Optional[str] = None,
+    extra_columns: Sequence[str] = (),
+    session: Optional[requests.Session] = None,
+    transfer: str = "json",
+) -> List[ReservationRow]:
+    """Return the window's reservations in (check_in, id) order.
+
+    With workers > 1, a PagePlan (one count=estimated HEAD) sizes the window first. Keyset paging
+    then splits it into up to one contiguous check_in slice per planned page, walked in parallel;
+    offset paging fetches the planned page windows in parallel and walks on from there while pages
+    come back full (the count may be an estimate, or rows may have arrived since). Either way
+    pages are merged in walk order, so the output matches the serial walk.
+    The projection is only id, check_in, external_url and `extra_columns`, in either transfer format.
+    """
+    filters = _reservation_filters(check_in_from, check_in_to, only_imported, organization_id)
+    select = ",".join([*RESERVATION_COLUMNS, *extra_columns])
+    keys = ("check_in", "id")
+    session = session or build_session(pool_size=max(workers, 1))
+    pages: List[Union[List[dict], CsvPage]] = []
+
+    with PROFILER.phase("fetch"):
+        plan = plan_supabase_pages(session, cfg, "reservations", filters, page_size) if workers > 1 else None
+        PROGRESS.start("reservations", plan)
+        if workers > 1 and pagination == "keyset":
+            slices = _split_check_in_range(check_in_from, check_in_to, min(workers, max(plan.pages, 1)))
+
+            def walk_slice(bounds: Tuple[str, str]) -> List[Union[List[dict], CsvPage]]:
+                slice_filters = _reservation_filters(bounds[0], bounds[1], only_imported, organization_id)
+                return list(
+                    iter_supabase_pages(
+                        session, cfg, "reservations", select, keys, slice_filters, page_size, transfer=transfer
+                    )
+                )
+
+            with ThreadPoolExecutor(max_workers=len(slices)) as pool:
+                for slice_pages in pool.map(walk_slice, slices):
+                    pages.extend(slice_pages)
+        elif workers > 1:
+            order = ",".join(f"{key}.asc" for key in keys)
+
+            def fetch_at(offset: int) -> Union[List[dict], CsvPage]:
+                return _fetch_page(
+                    session, cfg, "reservations", select, order, filters, page_size, offset=offset, transfer=transfer
+                )
+
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                pages = list(pool.map(fetch_at, plan.offsets()))
+            offset = plan.pages * page_size
+            while not pages or len(pages[-1]) == page_size:
+                pages.append(fetch_at(offset))
+                offset += page_size
+            pages = [data for data in pages if data]
+        else:
+            pages = list(
+                iter_supabase_pages(
+                    session, cfg, "reservations", select, keys, filters, page_size, pagination, transfer
+                )
+            )
+        PROGRESS.finish("reservations")
+
+    with PROFILER.phase("normalize"):
+        return [row for data in pages for row in reservation_rows_from_page(data, extra_columns)]
+
+
+def iter_supabase_reservation_rows(
+    cfg: SupabaseConfig,
+    check_in_from: str,
+    check_in_to: str,
+    only_imported: bool = True,
+    page_size: int = 1000,
+    pagination: str = "keyset",
+    organization_id: Optional[str] = None,
+    session: Optional[requests.Session] = None,
+    transfer: str = "json",
+) -> Iterator[ReservationRow]:
+    """Serial walk yielding rows page by page, so at most one page is held at a time."""
+    filters = _reservation_filters(check_in_from, check_in_to, only_imported, organization_id)
+    session = session or build_session(pool_size=1)
+    select = ",".join(RESERVATION_COLUMNS)
+    keys = ("check_in", "id")
+    for data in iter_supabase_pages(
+        session, cfg, "reservations", select, keys, filters, page_size, pagination, transfer
+    ):
+        yield from reservation_rows_from_page(data)
+
+
+def fetch_supabase_reserve_codes(
+    cfg: SupabaseConfig,
+    check_in_from: str,
+    check_in_to: str,
+    only_imported: bool = True,
+    workers: int = 1,
+    page_size: int = 1000,
+    pagination: str = "keyset",
+    organization_id: Optional[str] = None,
+    session: Optional[requests.Session] = None,
+) -> Tuple[Dict[str, str], Set[str]]:
+    """Return (reserveCode -> reservationId, set(reserveCodes))."""
+    rows = fetch_supabase_reservation_rows(
+        cfg,
+        check_in_from,
+        check_in_to,
+        only_imported=only_imported,
+        workers=workers,
+        page_size=page_size,
+        pagination=pagination,
+        organization_id=organization_id,
+        session=session,
+    )
+    return reserve_codes_from_rows(rows)
+
+
+SNAPSHOT_VERSION = 2
+SNAPSHOT_FIELD_COLUMNS = ("check_out", "nights", "guests_total", "pricing_total", "status")
+SNAPSHOT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS reservations (
+    org_key TEXT NOT NULL,
+    id TEXT NOT NULL,
+    check_in TEXT NOT NULL,
+    external_id TEXT,
+    external_url TEXT,
+    reserve_code TEXT,
+    updated_at TEXT NOT NULL,
+    check_out TEXT,
+    nights INTEGER,
+    guests_total INTEGER,
+    pricing_total REAL,
+    status TEXT,
+    PRIMARY KEY (org_key, id)
+);
+CREATE INDEX IF NOT EXISTS reservations_check_in_idx ON reservations (org_key, check_in, id);
+CREATE INDEX IF NOT EXISTS reservations_external_id_idx ON reservations (org_key, external_id);
+CREATE INDEX IF NOT EXISTS reservations_reserve_code_idx ON reservations (org_key, reserve_code);
+CREATE TABLE IF NOT EXISTS sync_state (
+    org_key TEXT PRIMARY KEY,
+    high_water TEXT,
+    refreshed_at TEXT NOT NULL
+);
+"""
+
+
+class ReservationSnapshot:
+    """Local SQLite copy of Supabase reservations, partitioned by organization.
+
+    refresh() pulls only rows whose updated_at is at or after the last high-water mark (the
+    trigger update_reservations_updated_at bumps it on every write). Hard deletes are invisible
+    to that walk; use refresh(full=True) to rebuild a partition from scratch.
+    """
+
+    ALL_ORGS = "*"
+    _COLUMNS = ("org_key", "id", "check_in", "external_id", "external_url", "reserve_code", "updated_at")
+    _COLUMNS += SNAPSHOT_FIELD_COLUMNS
+    _UPSERT_SQL = (
+        f"INSERT INTO reservations ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' for _ in _COLUMNS)}) "
+        "ON CONFLICT (org_key, id) DO UPDATE SET "
+        + ", ".join(f"{col} = excluded.{col}" for col in _COLUMNS[2:])
+    )
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        # Fleet workers share one file; wait for each other's page commits instead of failing.
+        self.conn = sqlite3.connect(str(path), timeout=60)
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != SNAPSHOT_VERSION:
+            # Older layout: it is only a cache, so drop it and let the next refresh re-pull.
+            self.conn.executescript("DROP TABLE IF EXISTS reservations; DROP TABLE IF EXISTS sync_state;")
+            self.conn.execute(f"PRAGMA user_version = {SNAPSHOT_VERSION}")
+        self.conn.executescript(SNAPSHOT_SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def _org_key(self, organization_id: Optional[str]) -> str:
+        return organization_id or self.ALL_ORGS
+
+    def high_water(self, organization_id: Optional[str]) -> Optional[str]:
+        row = self.conn.execute(
+            "SELECT high_water FROM sync_state WHERE org_key = ?", (self._org_key(organization_id),)
+        ).fetchone()
+        return row[0] if row else None
+
+    def refresh(
+        self,
+        cfg: SupabaseConfig,
+        organization_id: Optional[str] = None,
+        full: bool = False,
+        page_size: int = 1000,
+        session: Optional[requests.Session] = None,
+    ) -> int:
+        """Upsert rows changed since the last refresh; returns how many rows were pulled."""
+        org_key = self._org_key(organization_id)
+        session = session or build_session(pool_size=1)
+        if full:
+            with self.conn:
+                self.conn.execute("DELETE FROM reservations WHERE org_key = ?", (org_key,))
+                self.conn.execute("DELETE FROM sync_state WHERE org_key = ?", (org_key,))
+
+        high_water = self.high_water(organization_id)
+        filters: List[str] = []
+        if organization_id:
+            filters.append(f"organization_id=eq.{organization_id}")
+        if high_water:
+            # gte, not gt: rows sharing the high-water timestamp may not all have been seen.
+            filters.append(f"updated_at=gte.{quote(high_water, safe='')}")
+
+        pulled = 0
+        for data in iter_supabase_pages(
+            session,
+            cfg,
+            "reservations",
+            ",".join(["id", "check_in", "external_id", "external_url", "updated_at", *SNAPSHOT_FIELD_COLUMNS]),
+            ("updated_at", "id"),
+            filters,
+            page_size,
+        ):
+            rows = [
+                (
+                    org_key,
+                    str(row["id"]),
+                    row["check_in"],
+                    row.get("external_id"),
+                    row.get("external_url"),
+                    extract_reserve_code_from_url(row.get("external_url")),
+                    row["updated_at"],
+                    *(row.get(col) for col in SNAPSHOT_FIELD_COLUMNS),
+                )
+                for row in data
+            ]
+            # Commit each page with its high-water mark so an interrupted refresh resumes.
+            with self.conn:
+                self.conn.executemany(self._UPSERT_SQL, rows)
+                self._mark(org_key, data[-1]["updated_at"])
+            pulled += len(rows)
+
+        if not pulled:
+            with self.conn:
+                self._mark(org_key, high_water)
+        return pulled
+
+    def _mark(self, org_key: str, high_water: Optional[str]) -> None:
+        self.conn.execute(
+            "INSERT INTO sync_state (org_key, high_water, refreshed_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (org_key) DO UPDATE SET high_water = excluded.high_water, "
+            "refreshed_at = excluded.refreshed_at",
+            (org_key, high_water, datetime.now(timezone.utc).isoformat()),
+        )
+
+    def reservation_rows(
+        self,
+        check_in_from: str,
+        check_in_to: str,
+        only_imported: bool = True,
+        organization_id: Optional[str] = None,
+        extra_columns: Sequence[str] = (),
+    ) -> List[ReservationRow]:
+        """Same contract as fetch_supabase_reservation_rows, answered from the snapshot."""
+        return list(
+            self.iter_reservation_rows(check_in_from, check_in_to, only_imported, organization_id, extra_columns)
+        )
+
+    def iter_reservation_rows(
+        self,
+        check_in_from: str,
+        check_in_to: str,
+        only_imported: bool = True,
+        organization_id: Optional[str] = None,
+        extra_columns: Sequence[str] = (),
+    ) -> Iterator[ReservationRow]:
+        unknown = set(extra_columns) - set(SNAPSHOT_FIELD_COLUMNS)
+        if unknown:
+            raise ValueError(f"Snapshot does not store columns: {sorted(unknown)}")
+        columns = ", ".join(["id", "check_in", "reserve_code", *extra_columns])
+        sql = f"SELECT {columns} FROM reservations WHERE org_key = ? AND check_in >= ? AND check_in <= ?"
+        if only_imported:
+            sql += " AND external_id IS NOT NULL"
+        sql += " ORDER BY check_in, id"
+        cursor = self.conn.execute(sql, (self._org_key(organization_id), check_in_from, check_in_to))
+        for row in cursor:
+            yield ReservationRow(row[0], row[1], row[2], tuple(row[3:]))
+
+    def reserve_codes(
+        self,
+        check_in_from: str,
+        check_in_to: str,
+        only_imported: bool = True,
+        organization_id: Optional[str] = None,
+    ) -> Tuple[Dict[str, str], Set[str]]:
+        """Same contract as fetch_supabase_reserve_codes, answered from the snapshot."""
+        return reserve_codes_from_rows(
+            self.reservation_rows(check_in_from, check_in_to, only_imported, organization_id)
+        )
+
+
+RAW_OBJECTS_PATH = Path(__file__).resolve().parent / ".cache" / "stays-reconciliation" / "raw-objects.sqlite"
+RAW_OBJECTS_VERSION = 1
+RAW_OBJECTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS raw_versions (
+    org_key TEXT NOT NULL,
+    external_id TEXT NOT NULL,
+    payload_hash TEXT NOT NULL,
+    external_code TEXT,
+    fetched_at TEXT NOT NULL,
+    PRIMARY KEY (org_key, external_id, payload_hash)
+);
+CREATE INDEX IF NOT EXISTS raw_versions_latest_idx ON raw_versions (org_key, external_id, fetched_at);
+CREATE TABLE IF NOT EXISTS payloads (
+    payload_hash TEXT PRIMARY KEY,
+    code TEXT,
+    check_in TEXT,
+    check_out TEXT,
+    body BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    org_key TEXT PRIMARY KEY,
+    high_water TEXT,
+    refreshed_at TEXT NOT NULL
+);
+"""
+
+
+class RawReservation(NamedTuple):
+    """Latest stored Stays payload of one reservation, reduced to what the stage diff needs."""
+
+    external_id: str
+    code: Optional[str]
+    check_in: str
+    check_out: Optional[str]
+    payload_hash: str
+    fetched_at: str
+
+
+def _payload_day(value: object) -> Optional[str]:
+    s = str(value or "").strip()
+    return s[:10] if re.match(r"\d{4}-\d{2}-\d{2}", s) else None
+
+
+class PayloadRecord(NamedTuple):
+    payload_hash: str
+    code: Optional[str]
+    check_in: Optional[str]
+    check_out: Optional[str]
+    body: bytes  # zlib-compressed JSON
+
+
+def _payload_record(payload_hash: str, payload: object) -> PayloadRecord:
+    fields = payload if isinstance(payload, dict) else {}
+    code = next(
+        (fields.get(k) for k in ("id", "reservationId", "confirmationCode") if fields.get(k) is not None), None
+    )
+    return PayloadRecord(
+        payload_hash,
+        normalize_reserve_code(code),
+        _payload_day(fields.get("checkInDate")),
+        _payload_day(fields.get("checkOutDate")),
+        zlib.compress(json.dumps(payload, ensure_ascii=False).encode("utf-8")),
+    )
+
+
+class RawObjectStore:
+    """Local cache of staysnet_raw_objects (domain 'reservations').
+
+    storeStaysnetRawObject upserts one row per (organization, Stays _id, payload_hash) and bumps
+    fetched_at on every re-import. refresh() walks only rows fetched since the last high-water
+    mark, selecting the small metadata columns; payloads are downloaded only for hashes the local
+    cache has never seen, stored zlib-compressed and keyed by hash. Identical payloads are
+    identical by construction (SHA-256 of the JSON), so a hash is never downloaded twice.
+    """
+
+    ALL_ORGS = "*"
+    DOMAIN = "reservations"
+    # payload_hash=in.(...) batch size; 64-char hashes keep the query string around 7 KB.
+    PAYLOAD_BATCH = 100
+    # Compressed payloads decoded ahead of the SQLite writer.
+    PAYLOAD_QUEUE = 256
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(str(path), timeout=60)
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != RAW_OBJECTS_VERSION:
+            self.conn.executescript(
+                "DROP TABLE IF EXISTS raw_versions; DROP TABLE IF EXISTS payloads; DROP TABLE IF EXISTS sync_state;"
+            )
+            self.conn.execute(f"PRAGMA user_version = {RAW_OBJECTS_VERSION}")
+        self.conn.executescript(RAW_OBJECTS_SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def _org_key(self, organization_id: Optional[str]) -> str:
+        return organization_id or self.ALL_ORGS
+
+    def refresh(
+        self,
+        cfg: SupabaseConfig,
+        organization_id: Optional[str] = None,
+        full: bool = False,
+        page_size: int = 1000,
+        workers: int = 1,
+        session: Optional[requests.Session] = None,
+    ) -> Tuple[int, int]:
+        """Pull version metadata changed since the last refresh, then any unseen payloads.
+
+        Returns (versionsPulled, payloadsDownloaded).
+        """
+        org_key = self._org_key(organization_id)
+        session = session or build_session(pool_size=max(workers, 1))
+        if full:
+            with self.conn:
+                self.conn.execute("DELETE FROM raw_versions WHERE org_key = ?", (org_key,))
+                self.conn.execute("DELETE FROM sync_state WHERE org_key = ?", (org_key,))
+
+        row = self.conn.execute("SELECT high_water FROM sync_state WHERE org_key = ?", (org_key,)).fetchone()
+        high_water = row[0] if row else None
+        scope = [f"domain=eq.{self.DOMAIN}"]
+        if organization_id:
+            scope.append(f"organization_id=eq.{organization_id}")
+        filters = list(scope)
+        if high_water:
+            # gte, not gt: versions sharing the high-water timestamp may not all have been seen.
+            filters.append(f"fetched_at=gte.{quote(high_water, safe='')}")
+
+        pulled = 0
+        for data in iter_supabase_pages(
+            session,
+            cfg,
+            "staysnet_raw_objects",
+            "id,external_id,external_code,payload_hash,fetched_at",
+            ("fetched_at", "id"),
+            filters,
+            page_size,
+        ):
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT INTO raw_versions (org_key, external_id, payload_hash, external_code, fetched_at) "
+                    "VALUES (?, ?, ?, ?, ?) ON CONFLICT (org_key, external_id, payload_hash) DO UPDATE SET "
+                    "external_code = excluded.external_code, fetched_at = excluded.fetched_at",
+                    [
+                        (org_key, row["external_id"], row["payload_hash"], row.get("external_code"), row["fetched_at"])
+                        for row in data
+                        if row.get("external_id") and row.get("payload_hash")
+                    ],
+                )
+                self._mark(org_key, data[-1]["fetched_at"])
+            pulled += len(data)
+        if not pulled:
+            with self.conn:
+                self._mark(org_key, high_water)
+
+        missing = [
+            h
+            for (h,) in self.conn.execute(
+                "SELECT DISTINCT v.payload_hash FROM raw_versions v "
+                "LEFT JOIN payloads p ON p.payload_hash = v.payload_hash "
+                "WHERE v.org_key = ? AND p.payload_hash IS NULL",
+                (org_key,),
+            )
+        ]
+        batches = [missing[i : i + self.PAYLOAD_BATCH] for i in range(0, len(missing), self.PAYLOAD_BATCH)]
+        # Workers stream-decode and compress payloads; only compressed records wait for this
+        # thread's SQLite writes, and at most PAYLOAD_QUEUE of them at a time.
+        records: "queue.Queue[Optional[PayloadRecord]]" = queue.Queue(maxsize=self.PAYLOAD_QUEUE)
+        stop = threading.Event()
+
+        def download(hashes: List[str]) -> None:
+            batch_filters = [*scope, f"payload_hash=in.({','.join(hashes)})"]
+            try:
+                for row in iter_supabase_rows_streamed(
+                    session, cfg, "staysnet_raw_objects", "id,payload_hash,payload", ("id",), batch_filters, page_size
+                ):
+                    if stop.is_set():
+                        break
+                    records.put(_payload_record(row["payload_hash"], row["payload"]))
+            finally:
+                records.put(None)  # one end marker per batch, even on failure
+
+        downloaded = 0
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            futures = [pool.submit(download, hashes) for hashes in batches]
+            finished = 0
+            try:
+                while finished < len(futures):
+                    record = records.get()
+                    if record is None:
+                        finished += 1
+                        self.conn.commit()  # payloads are keyed by hash, so any prefix is a valid cache
+                        continue
+                    downloaded += self._store_payload(record)
+            except BaseException:
+                # Unblock the workers (they may be waiting on a full queue) before the pool joins them.
+                stop.set()
+                while finished < len(futures):
+                    finished += records.get() is None
+                raise
+            for future in futures:
+                future.result()
+        return pulled, downloaded
+
+    def _store_payload(self, record: PayloadRecord) -> int:
+        cur = self.conn.execute(
+            "INSERT OR IGNORE INTO payloads (payload_hash, code, check_in, check_out, body) VALUES (?, ?, ?, ?, ?)",
+            record,
+        )
+        return cur.rowcount
+
+    def _mark(self, org_key: str, high_water: Optional[str]) -> None:
+        self.conn.execute(
+            "INSERT INTO sync_state (org_key, high_water, refreshed_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (org_key) DO UPDATE SET high_water = excluded.high_water, "
+            "refreshed_at = excluded.refreshed_at",
+            (org_key, high_water, datetime.now(timezone.utc).isoformat()),
+        )
+
+    def payload(self, payload_hash: str) -> Optional[object]:
+        row = self.conn.execute("SELECT body FROM payloads WHERE payload_hash = ?", (payload_hash,)).fetchone()
+        return json.loads(zlib.decompress(row[0])) if row else None
+
+    def latest_reservations(
+        self, check_in_from: str, check_in_to: str, organization_id: Optional[str] = None
+    ) -> List[RawReservation]:
+        """Newest payload per Stays reservation whose checkInDate falls in the window, in check_in order."""
+        sql = """
+            SELECT v.external_id, COALESCE(p.code, v.external_code), p.check_in, p.check_out, v.payload_hash,
+                   MAX(v.fetched_at)
+            FROM raw_versions v JOIN payloads p ON p.payload_hash = v.payload_hash
+            WHERE v.org_key = ?
+            GROUP BY v.external_id
+        """
+        # SQLite returns the bare columns of the row holding MAX(fetched_at) in each group.
+        latest = [
+            RawReservation(row[0], normalize_reserve_code(row[1]), row[2], row[3], row[4], row[5])
+            for row in self.conn.execute(sql, (self._org_key(organization_id),))
+        ]
+        return sorted(
+            (r for r in latest if r.check_in and check_in_from <= r.check_in <= check_in_to),
+            key=lambda r: (r.check_in, r.external_id),
+        )
+
+
+@dataclass(frozen=True)
+class FieldRule:
+    """How one Supabase reservations column lines up with a Stays export column.
+
+    `headers` are candidate export headers in normalize_header form, tried in order.
+    """
+
+    column: str
+    headers: Tuple[str, ...]
+    kind: str  # "number", "date" or "text"
+    tolerance: float = 0.0
+    # reconciliation_items.issue_type a mismatch on this field maps to (None: no matching type).
+    issue_type: Optional[str] = None
+
+
+FIELD_RULES: Tuple[FieldRule, ...] = (
+    FieldRule(
+        "check_out",
+        ("check_out", "checkout", "saida", "data_de_saida", "partida"),
+        "date",
+        issue_type="dates_changed",
+    ),
+    FieldRule("nights", ("noites", "nights", "diarias", "numero_de_noites"), "number", issue_type="dates_changed"),
+    FieldRule(
+        "guests_total",
+        ("hospedes", "guests", "total_de_hospedes", "numero_de_hospedes"),
+        "number",
+        issue_type="guest_changed",
+    ),
+    FieldRule(
+        "pricing_total",
+        ("total", "valor_total", "total_da_reserva", "preco_total", "valor_da_reserva", "valor"),
+        "number",
+        tolerance=0.01,
+    ),
+    FieldRule("status", ("status", "situacao", "estado"), "text", issue_type="status_changed"),
+)
+
+# CSV transfers carry every cell as text; these columns are parsed back into numbers.
+NUMERIC_FIELD_COLUMNS = frozenset(rule.column for rule in FIELD_RULES if rule.kind == "number")
+
+STATUS_ALIASES = {
+    "confirmada": "confirmed",
+    "reservada": "confirmed",
+    "reserved": "confirmed",
+    "booked": "confirmed",
+    "cancelada": "cancelled",
+    "canceled": "cancelled",
+    "pendente": "pending",
+    "no-show": "no_show",
+    "noshow": "no_show",
+}
+
+
+def normalize_header(value: object) -> str:
+    """Same normalization as normalizeHeader in scripts/analyze-valores-nao-batem.mjs."""
+    s = unicodedata.normalize("NFD", str(value or "").strip().lower())
+    s = "".join(ch for ch in s if not unicodedata.combining(ch))
+    return re.sub(r"[^a-z0-9]+", "_", s).strip("_")
+
+
+def to_number(value: object) -> float:
+    """Parse numbers the way Stays exports write them (`R$ 1.234,56`); NaN when missing."""
+    if value is None or isinstance(value, bool):
+        return math.nan
+    if isinstance(value, (int, float)):
+        return float(value)
+    s = re.sub(r"\s", "", str(value)).replace("R$", "")
+    if not s:
+        return math.nan
+    s = re.sub(r"\.(?=\d{3}(\D|$))", "", s).replace(",", ".")
+    s = re.sub(r"[^0-9.-]", "", s)
+    try:
+        return float(s)
+    except ValueError:
+        return math.nan
+
+
+def to_day_number(value: object) -> float:
+    """Date as a proleptic ordinal (float so NaN can mark missing); accepts ISO and dd/mm/yyyy."""
+    if isinstance(value, datetime):
+        return float(value.date().toordinal())
+    if isinstance(value, date):
+        return float(value.toordinal())
+    if value is None:
+        return math.nan
+    s = str(value).strip()
+    m = re.match(r"(\d{4})-(\d{2})-(\d{2})", s)
+    if m:
+        return float(date(int(m.group(1)), int(m.group(2)), int(m.group(3))).toordinal())
+    m = re.match(r"(\d{1,2})/(\d{1,2})/(\d{4})", s)
+    if m:
+        return float(date(int(m.group(3)), int(m.group(2)), int(m.group(1))).toordinal())
+    return math.nan
+
+
+def to_text(value: object) -> str:
+    s = str(value).strip().lower() if value is not None else ""
+    return STATUS_ALIASES.get(s, s)
+
+
+def typed_column(values: Sequence[object], kind: str) -> Union[array, List[str]]:
+    """Pack one field's values into a float64 array (numbers, dates) or a list of strings.
+
+    The column is dictionary-encoded: each distinct cell (exports repeat statuses, dates and
+    prices) is parsed once, and cells that are already numbers skip parsing altogether.
+    """
+    if kind == "text":
+        texts = {v: to_text(v) for v in set(values)}
+        return [texts[v] for v in values]
+    convert = to_day_number if kind == "date" else to_number
+    if kind == "number":
+        # bool is an int subclass but to_number treats it as missing, so match exact types.
+        parsed = {v: convert(v) for v in set(values) if type(v) not in (int, float)}
+        return array("d", [float(v) if type(v) in (int, float) else parsed[v] for v in values])
+    parsed = {v: convert(v) for v in set(values)}
+    return array("d", [parsed[v] for v in values])
+
+
+def mismatch_positions(left: Union[array, List[str]], right: Union[array, List[str]], rule: FieldRule) -> List[int]:
+    """Positions where two aligned columns disagree; missing on one side only counts as a mismatch."""
+    if rule.kind == "text":
+        return [i for i, (a, b) in enumerate(zip(left, right)) if a != b]
+    if np is not None:
+        a = np.frombuffer(left, dtype=np.float64)
+        b = np.frombuffer(right, dtype=np.float64)
+        both_missing = np.isnan(a) & np.isnan(b)
+        # NaN on one side makes the comparison False, so it is reported.
+        return np.flatnonzero(~(np.abs(a - b) <= rule.tolerance) & ~both_missing).tolist()
+    tol = rule.tolerance
+    return [
+        i
+        for i, (a, b) in enumerate(zip(left, right))
+        if not (abs(a - b) <= tol or (math.isnan(a) and math.isnan(b)))
+    ]
+
+
+@dataclass
+class FieldMismatch:
+    code: str
+    field: str
+    xlsx_value: object
+    supabase_value: object
+    reservation_id: str
+    issue_type: Optional[str] = None
+
+
+def diff_fields(
+    index: WorkbookIndex,
+    rows: Sequence[ReservationRow],
+    rules: Sequence[FieldRule],
+) -> Dict[str, List[FieldMismatch]]:
+    """Compare every rule's column across the codes present on both sides, one column at a time.
+
+    The export side comes from the Reserva sheet's FieldColumns, so `index` must have been built
+    with these rules. `rows` must carry `fields` fetched with extra_columns=[r.column for r in rules].
+    """
+    sheet = index.reserva_sheet()
+    if not sheet:
+        return {}
+    columns = sheet.fields
+    if columns is None or not {rule.column for rule in rules} <= set(columns.requested):
+        raise ValueError(f"{index.path.name} was indexed without these field rules; pass them to build_workbook_index")
+    found = [rule for rule in rules if rule.column in columns.values]
+    if not found:
+        return {}
+
+    positions = {rule.column: i for i, rule in enumerate(rules)}
+    supa_values: Dict[str, Tuple[str, Tuple[object, ...]]] = {}
+    for row in rows:
+        if row.reserve_code and row.reserve_code not in supa_values:
+            supa_values[row.reserve_code] = (row.id, row.fields)
+
+    xlsx_pos = {code: i for i, code in enumerate(columns.codes)}
+    codes = sorted(xlsx_pos.keys() & supa_values.keys())
+    aligned = [xlsx_pos[c] for c in codes]
+    out: Dict[str, List[FieldMismatch]] = {}
+    for rule in found:
+        column = columns.values[rule.column]
+        left_raw = [column[i] for i in aligned]
+        right_raw = [supa_values[c][1][positions[rule.column]] for c in codes]
+        hits = mismatch_positions(typed_column(left_raw, rule.kind), typed_column(right_raw, rule.kind), rule)
+        out[rule.column] = [
+            FieldMismatch(
+                codes[j], rule.column, left_raw[j], right_raw[j], supa_values[codes[j]][0], rule.issue_type
+            )
+            for j in hits
+        ]
+    return out
+
+
+def select_field_rules(spec: Optional[str]) -> Tuple[FieldRule, ...]:
+    if not spec:
+        return ()
+    if spec == "all":
+        return FIELD_RULES
+    wanted = [name.strip() for name in spec.split(",") if name.strip()]
+    by_column = {rule.column: rule for rule in FIELD_RULES}
+    unknown = [name for name in wanted if name not in by_column]
+    if unknown:
+        raise ValueError(f"Unknown fields {unknown}; choose from {sorted(by_column)}")
+    return tuple(by_column[name] for name in wanted)
+
+
+# Stage of a code by which sources hold it: (in the XLSX, in a raw payload, in reservations).
+RAW_STAGE_BY_PRESENCE = {
+    (True, False, False): "missing_in_raw",  # exported by Stays, its payload was never stored
+    (True, True, False): "lost_in_import",  # payload stored, normalization produced no reservation
+    (True, False, True): "imported_without_raw",  # imported, but no payload (store failed or predates it)
+    (False, False, True): "imported_without_raw",
+    (False, True, True): "not_in_export",  # both import stages have it, the export does not
+    (False, True, False): "raw_only",
+}
+
+
+@dataclass
+class RawMismatch:
+    code: str
+    field: str
+    raw_value: object
+    supabase_value: object
+    reservation_id: str
+
+
+@dataclass
+class RawStageDiff:
+    raw_codes: int
+    stages: Dict[str, List[Tuple[str, Optional[str]]]]  # stage -> [(code, reservationId)]
+    mismatches: List[RawMismatch]
+
+    @property
+    def issues(self) -> int:
+        return sum(len(codes) for codes in self.stages.values()) + len(self.mismatches)
+
+
+def diff_raw_stages(
+    xlsx_codes: Set[str],
+    raw: Sequence[RawReservation],
+    rows: Sequence[ReservationRow],
+    rules: Sequence[FieldRule] = (),
+) -> RawStageDiff:
+    """Three-way diff of XLSX codes, the latest raw payloads and the normalized reservations.
+
+    Codes on all three sides are also checked for dates the import changed: check_in always,
+    check_out when it was fetched for --fields. Each side is windowed by its own check_in, so a
+    reservation whose check_in moved across a period boundary shows as a stage miss on both.
+    """
+    raw_by_code: Dict[str, RawReservation] = {}
+    for r in raw:
+        if r.code:
+            raw_by_code.setdefault(r.code, r)
+    supa_by_code: Dict[str, ReservationRow] = {}
+    for row in rows:
+        if row.reserve_code:
+            supa_by_code.setdefault(row.reserve_code, row)
+
+    stages: Dict[str, List[Tuple[str, Optional[str]]]] = {}
+    for code in sorted(xlsx_codes | raw_by_code.keys() | supa_by_code.keys()):
+        presence = (code in xlsx_codes, code in raw_by_code, code in supa_by_code)
+        stage = RAW_STAGE_BY_PRESENCE.get(presence)
+        if stage:
+            row = supa_by_code.get(code)
+            stages.setdefault(stage, []).append((code, row.id if row else None))
+
+    check_out_pos = next((i for i, rule in enumerate(rules) if rule.column == "check_out"), None)
+    mismatches: List[RawMismatch] = []
+    for code in sorted(raw_by_code.keys() & supa_by_code.keys()):
+        r, row = raw_by_code[code], supa_by_code[code]
+        if r.check_in != row.check_in:
+            mismatches.append(RawMismatch(code, "check_in", r.check_in, row.check_in, row.id))
+        if check_out_pos is not None:
+            check_out = _payload_day(row.fields[check_out_pos])
+            if r.check_out != check_out:
+                mismatches.append(RawMismatch(code, "check_out", r.check_out, check_out, row.id))
+    return RawStageDiff(len(raw_by_code), stages, mismatches)
+
+
+# Stays codes mix letters and digits, so typed or OCR'd codes confuse O/0 and I/L/1.
+CONFUSABLE_CODE_CHARS = str.maketrans("OIL", "011")
+SUGGEST_MAX_DISTANCE = 2
+SUGGEST_MIN_PREFIX = 4
+SUGGEST_MIN_SCORE = 0.6
+
+
+def canonical_code(code: str) -> str:
+    return code.translate(CONFUSABLE_CODE_CHARS)
+
+
+def edit_distance(a: str, b: str) -> int:
+    """Levenshtein distance (two-row DP; codes are at most 12 chars)."""
+    if len(a) < len(b):
+        a, b = b, a
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        prev = cur
+    return prev[-1]
+
+
+def _deletion_variants(word: str, depth: int) -> Set[str]:
+    variants = frontier = {word}
+    for _ in range(depth):
+        frontier = {w[:i] + w[i + 1 :] for w in frontier for i in range(len(w))}
+        variants = variants | frontier
+    return variants
+
+
+class DeletionIndex:
+    """Symmetric-deletion index for edit-distance lookups.
+
+    Two codes within distance d share a variant reachable by at most d deletions from each, so a
+    search probes the query's variants (<= 79 for a 12-char code at d=2) instead of every code.
+    A BK-tree prunes poorly here: short random codes sit at near-uniform distances from each other.
+    """
+
+    def __init__(self, words: Iterable[str], max_distance: int):
+        self.max_distance = max_distance
+        self.variants: Dict[str, List[str]] = {}
+        for word in words:
+            for variant in _deletion_variants(word, max_distance):
+                self.variants.setdefault(variant, []).append(word)
+
+    def search(self, word: str) -> List[Tuple[int, str]]:
+        """(distance, word) for every indexed word within max_distance of `word`."""
+        seen: Set[str] = set()
+        found: List[Tuple[int, str]] = []
+        for variant in _deletion_variants(word, self.max_distance):
+            for candidate in self.variants.get(variant, ()):
+                if candidate not in seen:
+                    seen.add(candidate)
+                    d = edit_distance(word, candidate)
+                    if d <= self.max_distance:
+                        found.append((d, candidate))
+        return found
+
+
+@dataclass
+class CodeSuggestion:
+    xlsx_code: str
+    supabase_code: str
+    reservation_id: Optional[str]
+    score: float
+    reason: str  # confusable (O/0, I/L/1), truncated (one code is a prefix of the other) or edit:<distance>
+
+
+def suggest_code_matches(
+    only_in_xlsx: Sequence[str],
+    only_in_supabase: Sequence[Tuple[str, Optional[str]]],
+    max_distance: int = SUGGEST_MAX_DISTANCE,
+    min_score: float = SUGGEST_MIN_SCORE,
+) -> List[CodeSuggestion]:
+    """Likely pairs between the two orphan lists, best score first, each code used at most once.
+
+    Candidates come from three indexes over the canonical (confusable-folded) Supabase codes: an
+    exact lookup, prefixes in both directions (a dict probe per XLSX prefix plus a bisect over the
+    sorted codes, for a truncated `reserve` param), and a DeletionIndex search. Pairs are then
+    assigned greedily by score, so no pair is ever compared outside its index neighbourhood.
+    """
+    if not only_in_xlsx or not only_in_supabase:
+        return []
+    by_canonical: Dict[str, List[Tuple[str, Optional[str]]]] = {}
+    for code, rid in only_in_supabase:
+        by_canonical.setdefault(canonical_code(code), []).append((code, rid))
+    sorted_canonical = sorted(by_canonical)
+    near = DeletionIndex(sorted_canonical, max_distance)
+
+    candidates: List[Tuple[float, str, str, Optional[str], str]] = []
+    for x in only_in_xlsx:
+        cx = canonical_code(x)
+        scored: Dict[str, Tuple[float, str]] = {}
+
+        def offer(canonical: str, score: float, reason: str) -> None:
+            if score >= min_score and scored.get(canonical, (0.0,))[0] < score:
+                scored[canonical] = (score, reason)
+
+        if cx in by_canonical:
+            offer(cx, 0.95, "confusable")
+        for k in range(SUGGEST_MIN_PREFIX, len(cx)):
+            if cx[:k] in by_canonical:
+                offer(cx[:k], 0.5 + 0.4 * k / len(cx), "truncated")
+        if len(cx) >= SUGGEST_MIN_PREFIX:
+            for canonical in sorted_canonical[bisect_left(sorted_canonical, cx) :]:
+                if not canonical.startswith(cx):
+                    break
+                if canonical != cx:
+                    offer(canonical, 0.5 + 0.4 * len(cx) / len(canonical), "truncated")
+        for d, canonical in near.search(cx):
+            if d:
+                offer(canonical, 1 - d / max(len(cx), len(canonical)), f"edit:{d}")
+
+        for canonical, (score, reason) in scored.items():
+            for code, rid in by_canonical[canonical]:
+                candidates.append((score, x, code, rid, reason))
+
+    candidates.sort(key=lambda c: (-c[0], c[1], c[2]))
+    used_xlsx: Set[str] = set()
+    used_supabase: Set[str] = set()
+    suggestions: List[CodeSuggestion] = []
+    for score, x, code, rid, reason in candidates:
+        if x in used_xlsx or code in used_supabase:
+            continue
+        used_xlsx.add(x)
+        used_supabase.add(code)
+        suggestions.append(CodeSuggestion(x, code, rid, round(score, 3), reason))
+    return suggestions
+
+
+PERIOD_FILENAME_RE = re.compile(r"^(\d{4}-\d{2}-\d{2})_(\d{4}-\d{2}-\d{2})")
+
+
+@dataclass(frozen=True)
+class AuditPeriod:
+    xlsx: Path
+    check_in_from: str
+    check_in_to: str
+
+    @property
+    def label(self) -> str:
+        return f"{self.check_in_from}..{self.check_in_to} ({self.xlsx.name})"
+
+
+DEFAULT_PERIOD = AuditPeriod(DEFAULT_AUDIT_DIR / "2025-12-01_2025-12-31_propX_ownerX.xlsx", "2025-12-01", "2025-12-31")
+
+
+@dataclass
+class PeriodResult:
+    period: AuditPeriod
+    xlsx_codes: int
+    supabase_codes: int
+    only_in_supabase: List[Tuple[str, Optional[str]]]
+    only_in_xlsx: List[str]
+    field_mismatches: Dict[str, List[FieldMismatch]] = field(default_factory=dict)
+    # PhaseProfiler.phase_summary() of this period when profiling (it may run in a worker process).
+    timings: Optional[Dict[str, dict]] = None
+    raw_stages: Optional[RawStageDiff] = None
+    suggestions: List[CodeSuggestion] = field(default_factory=list)
+
+    @property
+    def clean(self) -> bool:
+        return (
+            not self.only_in_supabase
+            and not self.only_in_xlsx
+            and not any(self.field_mismatches.values())
+        )
+
+
+def period_from_filename(xlsx: Path) -> Optional[AuditPeriod]:
+    """Stays exports are named `<from>_<to>_...xlsx` (e.g. 2025-12-01_2025-12-31_propX_ownerX.xlsx)."""
+    m = PERIOD_FILENAME_RE.match(xlsx.name)
+    if not m:
+        return None
+    return AuditPeriod(xlsx, m.group(1), m.group(2))
+
+
+def discover_audit_periods(directory: Path) -> List[AuditPeriod]:
+    periods = [period_from_filename(p) for p in sorted(directory.glob("*.xlsx")) if not p.name.startswith("~$")]
+    return [p for p in periods if p]
+
+
+DIFF_COLUMNS = (
+    "organization_id",
+    "period_from",
+    "period_to",
+    "xlsx",
+    "side",
+    "code",
+    "reservation_id",
+    "issue_type",
+    "field",
+    "xlsx_value",
+    "supabase_value",
+    "raw_value",
+    "score",
+)
+OUTPUT_FORMATS = ("jsonl", "csv", "parquet")
+
+
+def iter_difference_rows(result: PeriodResult, organization_id: Optional[str] = None) -> Iterator[dict]:
+    """Every difference of a period as flat DIFF_COLUMNS rows.
+
+    side is only_in_supabase, only_in_xlsx, suggested_match or field_mismatch, plus raw:<stage>
+    and raw_mismatch with --raw-objects. issue_type follows the reconciliation_items check constraint: a code
+    missing from the Stays export is 'deleted'.
+    """
+    base = {
+        "organization_id": organization_id,
+        "period_from": result.period.check_in_from,
+        "period_to": result.period.check_in_to,
+        "xlsx": result.period.xlsx.name,
+    }
+    for code, rid in result.only_in_supabase:
+        yield {**base, "side": "only_in_supabase", "code": code, "reservation_id": rid, "issue_type": "deleted"}
+    for code in result.only_in_xlsx:
+        yield {**base, "side": "only_in_xlsx", "code": code}
+    for mismatches in result.field_mismatches.values():
+        for m in mismatches:
+            yield {
+                **base,
+                "side": "field_mismatch",
+                "code": m.code,
+                "reservation_id": m.reservation_id,
+                "issue_type": m.issue_type,
+                "field": m.field,
+                "xlsx_value": m.xlsx_value,
+                "supabase_value": m.supabase_value,
+            }
+    for sg in result.suggestions:
+        yield {
+            **base,
+            "side": "suggested_match",
+            "code": sg.xlsx_code,
+            "reservation_id": sg.reservation_id,
+            "field": sg.reason,
+            "xlsx_value": sg.xlsx_code,
+            "supabase_value": sg.supabase_code,
+            "score": sg.score,
+        }
+    if result.raw_stages:
+        for stage, codes in result.raw_stages.stages.items():
+            for code, rid in codes:
+                yield {**base, "side": f"raw:{stage}", "code": code, "reservation_id": rid}
+        for rm in result.raw_stages.mismatches:
+            yield {
+                **base,
+                "side": "raw_mismatch",
+                "code": rm.code,
+                "reservation_id": rm.reservation_id,
+                "issue_type": "dates_changed",
+                "field": rm.field,
+                "supabase_value": rm.supabase_value,
+                "raw_value": rm.raw_value,
+            }
+
+
+def _cell_text(value: object) -> Optional[str]:
+    if value is None:
+        return None
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+class ResultSink(abc.ABC):
+    """Writes difference rows as they are produced; nothing is buffered beyond one batch."""
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.rows_written = 0
+
+    @abc.abstractmethod
+    def write(self, row: dict) -> None:
+        """Write one DIFF_COLUMNS row."""
+
+    def write_all(self, rows: Iterable[dict]) -> None:
+        for row in rows:
+            self.write(row)
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> "ResultSink":
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
+
+
+class JsonlSink(ResultSink):
+    def __init__(self, path: Path):
+        super().__init__(path)
+        self._fh = path.open("w", encoding="utf-8")
+
+    def write(self, row: dict) -> None:
+        record = {col: row.get(col) for col in DIFF_COLUMNS}
+        self._fh.write(json.dumps(record, ensure_ascii=False, default=_cell_text) + "\n")
+        self.rows_written += 1
+
+    def close(self) -> None:
+        self._fh.close()
+
+
+class CsvSink(ResultSink):
+    def __init__(self, path: Path):
+        super().__init__(path)
+        self._fh = path.open("w", encoding="utf-8", newline="")
+        self._writer = csv.writer(self._fh)
+        self._writer.writerow(DIFF_COLUMNS)
+
+    def write(self, row: dict) -> None:
+        self._writer.writerow([_cell_text(row.get(col)) for col in DIFF_COLUMNS])
+        self.rows_written += 1
+
+    def close(self) -> None:
+        self._fh.close()
+
+
+class ParquetSink(ResultSink):
+    """Row groups of `batch_size` string columns; needs pyarrow (pip install pyarrow)."""
+
+    def __init__(self, path: Path, batch_size: int = 50_000):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise RuntimeError("Parquet output needs pyarrow: pip install pyarrow") from e
+        super().__init__(path)
+        self._pa = pa
+        self._schema = pa.schema([(col, pa.string()) for col in DIFF_COLUMNS])
+        self._writer = pq.ParquetWriter(str(path), self._schema)
+        self._batch: Dict[str, List[Optional[str]]] = {col: [] for col in DIFF_COLUMNS}
+        self._batch_size = batch_size
+
+    def write(self, row: dict) -> None:
+        for col in DIFF_COLUMNS:
+            self._batch[col].append(_cell_text(row.get(col)))
+        self.rows_written += 1
+        if len(self._batch["code"]) >= self._batch_size:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self._batch["code"]:
+            self._writer.write_table(self._pa.table(self._batch, schema=self._schema))
+            self._batch = {col: [] for col in DIFF_COLUMNS}
+
+    def close(self) -> None:
+        self._flush()
+        self._writer.close()
+
+
+def open_sink(path: Path, fmt: Optional[str] = None) -> ResultSink:
+    """Sink for `path`; the format defaults to the file suffix (.jsonl, .csv, .parquet)."""
+    fmt = fmt or path.suffix.lstrip(".").lower()
+    if fmt == "jsonl":
+        return JsonlSink(path)
+    if fmt == "csv":
+        return CsvSink(path)
+    if fmt == "parquet":
+        return ParquetSink(path)
+    raise ValueError(f"Unknown output format {fmt!r}; use one of {OUTPUT_FORMATS}")
+
+
+def partition_rows_by_period(
+    rows: List[ReservationRow], periods: Sequence[AuditPeriod]
+) -> List[List[ReservationRow]]:
+    """Slice check_in-ordered rows into each period's inclusive window (periods may overlap)."""
+    check_ins = [row.check_in for row in rows]
+    out: List[List[ReservationRow]] = []
+    for period in periods:
+        lo = bisect_left(check_ins, period.check_in_from)
+        hi = bisect_right(check_ins, period.check_in_to)
+        out.append(rows[lo:hi])
+    return out
+
+
+def reconcile_period(
+    period: AuditPeriod,
+    rows: List[ReservationRow],
+    rules: Sequence[FieldRule] = (),
+    profile: bool = False,
+    raw: Optional[List[RawReservation]] = None,
+    index: Optional[WorkbookIndex] = None,
+    sheet_workers: int = 1,
+) -> PeriodResult:
+    prof = PhaseProfiler(enabled=profile)
+    with prof.phase("workbook_scan"):
+        if index is None:
+            index = build_workbook_index(period.xlsx, sheet_workers, rules)
+        xlsx_reserva = index.reserva_codes()
+    with prof.phase("diff_codes"):
+        mapping, supa_reserva = reserve_codes_from_rows(rows)
+        only_in_supabase = [(code, mapping.get(code)) for code in sorted(supa_reserva - xlsx_reserva)]
+        only_in_xlsx = sorted(xlsx_reserva - supa_reserva)
+    with prof.phase("suggest_matches"):
+        suggestions = suggest_code_matches(only_in_xlsx, only_in_supabase)
+    field_mismatches: Dict[str, List[FieldMismatch]] = {}
+    if rules:
+        with prof.phase("diff_fields"):
+            field_mismatches = diff_fields(index, rows, rules)
+    raw_stages = None
+    if raw is not None:
+        with prof.phase("diff_raw"):
+            raw_stages = diff_raw_stages(xlsx_reserva, raw, rows, rules)
+    return PeriodResult(
+        period=period,
+        xlsx_codes=len(xlsx_reserva),
+        supabase_codes=len(supa_reserva),
+        only_in_supabase=only_in_supabase,
+        only_in_xlsx=only_in_xlsx,
+        field_mismatches=field_mismatches,
+        timings=prof.phase_summary() if profile else None,
+        raw_stages=raw_stages,
+        suggestions=suggestions,
+    )
+
+
+def reconcile_periods(
+    periods: Sequence[AuditPeriod],
+    rows: List[ReservationRow],
+    workers: int = 1,
+    rules: Sequence[FieldRule] = (),
+    sink: Optional[ResultSink] = None,
+    organization_id: Optional[str] = None,
+    raw: Optional[List[RawReservation]] = None,
+) -> List[PeriodResult]:
+    """Reconcile every period against its slice of `rows`; workbook parsing runs in a process pool.
+
+    Several periods get one process each; a single period spreads its sheets over `workers` instead.
+
+    With a sink, each period's differences are written as soon as that period finishes. `raw`
+    (check_in ordered, from RawObjectStore) adds the per-period three-way stage diff.
+    """
+    partitions = partition_rows_by_period(rows, periods)
+    rule_args = [tuple(rules)] * len(periods)
+    profile_args = [PROFILER.enabled] * len(periods)
+    raw_args = partition_rows_by_period(raw, periods) if raw is not None else [None] * len(periods)
+    results: List[PeriodResult] = []
+
+    def collect(result: PeriodResult) -> None:
+        results.append(result)
+        if result.timings:
+            PROFILER.merge(result.timings)
+            PROFILER.periods.append({"period": result.period.label, "phases": result.timings})
+        if sink:
+            with PROFILER.phase("write_output"):
+                sink.write_all(iter_difference_rows(result, organization_id))
+
+    if workers <= 1 or len(periods) <= 1:
+        for args in zip(periods, partitions, rule_args, profile_args, raw_args):
+            collect(reconcile_period(*args, sheet_workers=workers))
+        return results
+    with ProcessPoolExecutor(max_workers=min(workers, len(periods))) as pool:
+        for result in pool.map(reconcile_period, periods, partitions, rule_args, profile_args, raw_args):
+            collect(result)
+    return results
+
+
+class ExternalSorter:
+    """Sort an unbounded stream of single-line text records within a memory budget.
+
+    Records are buffered until their estimated footprint reaches `memory_bytes`, then sorted and
+    spilled to a run file. sorted() k-way merges the runs with heapq.merge; when there are more
+    runs than the budget can hold read buffers for, runs are first merged in passes of `fan_in`.
+    """
+
+    def __init__(self, memory_bytes: int, spill_dir: Optional[Path] = None):
+        self.memory_bytes = max(memory_bytes, io.DEFAULT_BUFFER_SIZE)
+        self.fan_in = max(2, self.memory_bytes // io.DEFAULT_BUFFER_SIZE)
+        self._dir = tempfile.TemporaryDirectory(prefix="stays-diff-", dir=spill_dir)
+        self._buffer: List[str] = []
+        self._buffered_bytes = 0
+        self._runs: List[Path] = []
+        self._run_count = 0
+
+    def add(self, record: str) -> None:
+        self._buffer.append(record)
+        # str object plus its list slot; close enough to keep the real peak near the budget.
+        self._buffered_bytes += sys.getsizeof(record) + 8
+        if self._buffered_bytes >= self.memory_bytes:
+            self._spill()
+
+    def _new_run(self) -> Path:
+        run = Path(self._dir.name) / f"run-{self._run_count:06d}.txt"
+        self._run_count += 1
+        self._runs.append(run)
+        return run
+
+    def _spill(self) -> None:
+        if not self._buffer:
+            return
+        self._buffer.sort()
+        with self._new_run().open("w", encoding="utf-8") as f:
+            f.writelines(record + "\n" for record in self._buffer)
+        self._buffer = []
+        self._buffered_bytes = 0
+
+    def sorted(self) -> Iterator[str]:
+        """Every record in order; may be called again (each call re-reads the run files)."""
+        self._spill()
+        while len(self._runs) > self.fan_in:
+            batch, self._runs = self._runs[: self.fan_in], self._runs[self.fan_in :]
+            with ExitStack() as stack:
+                files = [stack.enter_context(run.open(encoding="utf-8")) for run in batch]
+                with self._new_run().open("w", encoding="utf-8") as out:
+                    out.writelines(heapq.merge(*files))
+            for run in batch:
+                run.unlink()
+        with ExitStack() as stack:
+            files = [stack.enter_context(run.open(encoding="utf-8")) for run in self._runs]
+            for line in heapq.merge(*files):
+                yield line[:-1]
+
+    def close(self) -> None:
+        self._dir.cleanup()
+
+    def __enter__(self) -> "ExternalSorter":
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
+
+
+def iter_xlsx_reserva_codes(xlsx_path: Path, header: str = "Reserva") -> Iterator[str]:
+    """Stream the Reserva column without indexing the workbook; same sheet choice and code rules as
+    WorkbookIndex.reserva_codes (first sheet with that header and at least one code)."""
+    wb = load_workbook(filename=str(xlsx_path), read_only=True, data_only=True)
+    try:
+        for sheet_name in wb.sheetnames:
+            rows = wb[sheet_name].iter_rows(values_only=True)
+            headers = [str(h).strip() if h is not None else None for h in next(rows, ())]
+            if header not in headers:
+                continue
+            pos = headers.index(header)
+            found = False
+            for row in rows:
+                code = normalize_reserve_code(row[pos]) if pos < len(row) else None
+                if code:
+                    found = True
+                    yield code
+            if found:
+                return
+    finally:
+        wb.close()
+
+
+def reconcile_period_external(
+    period: AuditPeriod, supabase_sorted: Callable[[], Iterator[str]], memory_bytes: int
+) -> PeriodResult:
+    """Code diff of one period as a streaming merge of two sorted runs; same result as reconcile_period.
+
+    `supabase_sorted` yields `code\tcheck_in\tid` records in order, so the first record of a code
+    inside the window is the one reserve_codes_from_rows would keep.
+    """
+    only_in_supabase: List[Tuple[str, Optional[str]]] = []
+    only_in_xlsx: List[str] = []
+    xlsx_count = supabase_count = 0
+
+    def supabase_codes() -> Iterator[Tuple[str, str]]:
+        last = None
+        for record in supabase_sorted():
+            code, check_in, rid = record.split("\t")
+            if code != last and period.check_in_from <= check_in <= period.check_in_to:
+                last = code
+                yield code, rid
+
+    def xlsx_codes(sorter: ExternalSorter) -> Iterator[str]:
+        last = None
+        for code in sorter.sorted():
+            if code != last:
+                last = code
+                yield code
+
+    with ExternalSorter(memory_bytes) as sorter:
+        for code in iter_xlsx_reserva_codes(period.xlsx):
+            sorter.add(code)
+        left, right = xlsx_codes(sorter), supabase_codes()
+        x, su = next(left, None), next(right, None)
+        while x is not None or su is not None:
+            if su is None or (x is not None and x < su[0]):
+                only_in_xlsx.append(x)
+                xlsx_count += 1
+                x = next(left, None)
+            elif x is None or su[0] < x:
+                only_in_supabase.append(su)
+                supabase_count += 1
+                su = next(right, None)
+            else:
+                xlsx_count += 1
+                supabase_count += 1
+                x, su = next(left, None), next(right, None)
+
+    # Only the orphans are held, so the suggestions run on them as in reconcile_period.
+    suggestions = suggest_code_matches(only_in_xlsx, only_in_supabase)
+    return PeriodResult(
+        period, xlsx_count, supabase_count, only_in_supabase, only_in_xlsx, suggestions=suggestions
+    )
+
+
+def reconcile_periods_external(
+    periods: Sequence[AuditPeriod],
+    rows: Iterable[ReservationRow],
+    memory_bytes: int,
+    sink: Optional[ResultSink] = None,
+    organization_id: Optional[str] = None,
+) -> List[PeriodResult]:
+    """reconcile_periods for exports too large for in-memory sets: periods run one after another
+    and peak memory stays near `memory_bytes` (half for each side's sort buffer)."""
+    results: List[PeriodResult] = []
+    with ExternalSorter(memory_bytes // 2) as supabase:
+        with PROFILER.phase("spill_supabase"):
+            for row in rows:
+                if row.reserve_code:
+                    supabase.add(f"{row.reserve_code}\t{row.check_in}\t{row.id}")
+        for period in periods:
+            with PROFILER.phase("merge_diff"):
+                results.append(reconcile_period_external(period, supabase.sorted, memory_bytes // 2))
+            if sink:
+                with PROFILER.phase("write_output"):
+                    sink.write_all(iter_difference_rows(results[-1], organization_id))
+    return results
+
+
+def print_report(results: Sequence[PeriodResult]) -> None:
+    batch = len(results) > 1
+    for result in results:
+        if batch:
+            print(f"\n=== PERIOD {result.period.label} ===")
+        print(f"XLSX_RESERVA_CODES={result.xlsx_codes}")
+        print(f"SUPABASE_RESERVA_CODES={result.supabase_codes}")
+        print(f"ONLY_IN_SUPABASE={len(result.only_in_supabase)}")
+        print(f"ONLY_IN_XLSX={len(result.only_in_xlsx)}")
+
+        if result.only_in_supabase:
+            print("\nEXTRA_IN_SUPABASE (Reserva codes):")
+            for code, rid in result.only_in_supabase[:50]:
+                suffix = f" -> reservationId={rid}" if rid else ""
+                print(f"{code}{suffix}")
+
+        if result.only_in_xlsx:
+            print("\nMISSING_IN_SUPABASE (Reserva codes):")
+            for code in result.only_in_xlsx[:50]:
+                print(code)
+
+        if result.suggestions:
+            print(f"\nSUGGESTED_MATCHES={len(result.suggestions)}")
+            for sg in result.suggestions[:50]:
+                suffix = f" -> reservationId={sg.reservation_id}" if sg.reservation_id else ""
+                print(f"  {sg.xlsx_code} ~ {sg.supabase_code} score={sg.score:.2f} ({sg.reason}){suffix}")
+
+        for column, mismatches in result.field_mismatches.items():
+            print(f"\nFIELD_MISMATCHES[{column}]={len(mismatches)}")
+            for m in mismatches[:20]:
+                print(
+                    f"{m.code} xlsx={m.xlsx_value!r} supabase={m.supabase_value!r} -> reservationId={m.reservation_id}"
+                )
+
+        if result.raw_stages:
+            print(f"\nRAW_PAYLOAD_CODES={result.raw_stages.raw_codes}")
+            for stage, codes in result.raw_stages.stages.items():
+                print(f"RAW_STAGE[{stage}]={len(codes)}")
+                for code, rid in codes[:20]:
+                    print(f"  {code}" + (f" -> reservationId={rid}" if rid else ""))
+            if result.raw_stages.mismatches:
+                print(f"RAW_MISMATCHES={len(result.raw_stages.mismatches)}")
+                for rm in result.raw_stages.mismatches[:20]:
+                    print(
+                        f"  {rm.code} {rm.field} raw={rm.raw_value!r} supabase={rm.supabase_value!r} "
+                        f"-> reservationId={rm.reservation_id}"
+                    )
+
+    if batch:
+        print("\n=== TOTAL ===")
+        print(f"PERIODS={len(results)}")
+        print(f"PERIODS_WITH_DIFFERENCES={sum(1 for r in results if not r.clean)}")
+        print(f"ONLY_IN_SUPABASE={sum(len(r.only_in_supabase) for r in results)}")
+        print(f"ONLY_IN_XLSX={sum(len(r.only_in_xlsx) for r in results)}")
+        print(f"FIELD_MISMATCHES={sum(len(m) for r in results for m in r.field_mismatches.values())}")
+        print(f"SUGGESTED_MATCHES={sum(len(r.suggestions) for r in results)}")
+        if any(r.raw_stages for r in results):
+            print(f"RAW_STAGE_ISSUES={sum(r.raw_stages.issues for r in results if r.raw_stages)}")
+
+
+@dataclass(frozen=True)
+class FetchOptions:
+    workers: int = 1
+    pagination: str = "keyset"
+    snapshot: Optional[Path] = None
+    snapshot_rebuild: bool = False
+    transfer: str = "json"
+    raw_objects: Optional[Path] = None
+    # Bytes for the external-sort code diff (--memory-cap); None keeps the in-memory sets.
+    memory_cap: Optional[int] = None
+    # Record each comparison in reconciliation_runs / reconciliation_items (--persist).
+    persist: bool = False
+    # ETag cache for page reads (HTTP_CACHE, --http-cache); None bypasses it.
+    http_cache: Optional[Path] = None
+    # Ceiling for the adaptive per-service request limiters (--max-concurrency); None keeps theirs.
+    max_concurrency: Optional[int] = None
+
+
+def load_reservation_rows(
+    cfg: SupabaseConfig,
+    check_in_from: str,
+    check_in_to: str,
+    options: FetchOptions,
+    organization_id: Optional[str] = None,
+    extra_columns: Sequence[str] = (),
+    session: Optional[requests.Session] = None,
+) -> Tuple[List[ReservationRow], Optional[int]]:
+    """Rows for the window from the snapshot (refreshed first) or a live fetch.
+
+    Returns (rows, snapshotRowsPulled); the count is None for a live fetch.
+    """
+    if not options.snapshot:
+        rows = fetch_supabase_reservation_rows(
+            cfg,
+            check_in_from,
+            check_in_to,
+            only_imported=True,
+            workers=options.workers,
+            pagination=options.pagination,
+            organization_id=organization_id,
+            extra_columns=extra_columns,
+            session=session,
+            transfer=options.transfer,
+        )
+        return rows, None
+
+    snapshot = ReservationSnapshot(options.snapshot)
+    try:
+        with PROFILER.phase("snapshot_refresh"):
+            pulled = snapshot.refresh(cfg, organization_id, full=options.snapshot_rebuild, session=session)
+        with PROFILER.phase("snapshot_read"):
+            rows = snapshot.reservation_rows(
+                check_in_from,
+                check_in_to,
+                only_imported=True,
+                organization_id=organization_id,
+                extra_columns=extra_columns,
+            )
+    finally:
+        snapshot.close()
+    return rows, pulled
+
+
+def iter_reservation_rows(
+    cfg: SupabaseConfig,
+    check_in_from: str,
+    check_in_to: str,
+    options: FetchOptions,
+    organization_id: Optional[str] = None,
+    session: Optional[requests.Session] = None,
+) -> Iterator[ReservationRow]:
+    """load_reservation_rows as a stream (no field columns), for the memory-capped diff."""
+    if not options.snapshot:
+        yield from iter_supabase_reservation_rows(
+            cfg,
+            check_in_from,
+            check_in_to,
+            pagination=options.pagination,
+            organization_id=organization_id,
+            session=session,
+            transfer=options.transfer,
+        )
+        return
+
+    snapshot = ReservationSnapshot(options.snapshot)
+    try:
+        with PROFILER.phase("snapshot_refresh"):
+            snapshot.refresh(cfg, organization_id, full=options.snapshot_rebuild, session=session)
+        yield from snapshot.iter_reservation_rows(check_in_from, check_in_to, organization_id=organization_id)
+    finally:
+        snapshot.close()
+
+
+def load_raw_reservations(
+    cfg: SupabaseConfig,
+    check_in_from: str,
+    check_in_to: str,
+    options: FetchOptions,
+    organization_id: Optional[str] = None,
+    session: Optional[requests.Session] = None,
+) -> Tuple[Optional[List[RawReservation]], int, int]:
+    """(latest raw payloads in the window, versionsPulled, payloadsDownloaded); None without --raw-objects."""
+    if not options.raw_objects:
+        return None, 0, 0
+    store = RawObjectStore(options.raw_objects)
+    try:
+        with PROFILER.phase("raw_refresh"):
+            pulled, downloaded = store.refresh(
+                cfg, organization_id, full=options.snapshot_rebuild, workers=options.workers, session=session
+            )
+        with PROFILER.phase("raw_read"):
+            raw = store.latest_reservations(check_in_from, check_in_to, organization_id)
+    finally:
+        store.close()
+    return raw, pulled, downloaded
+
+
+RUN_ITEMS_CHUNK = 500
+
+
+def _json_body(payload: object) -> bytes:
+    return json.dumps(payload, default=_cell_text, ensure_ascii=False).encode("utf-8")
+
+
+def reconciliation_items(results: Sequence[PeriodResult], run_id: str) -> Iterator[dict]:
+    """reconciliation_items rows for every difference tied to a reservation.
+
+    The table's reservation_id is a NOT NULL foreign key, so codes only in the export (and raw
+    stages without a reservation) stay in the run summary instead. A suggested match is folded
+    into its Supabase-side 'deleted' item. Ids are generated here so a retried chunk is idempotent.
+    """
+    for result in results:
+        suggested = {sg.supabase_code: sg for sg in result.suggestions}
+        for row in iter_difference_rows(result):
+            if not row.get("reservation_id") or not row.get("issue_type"):
+                continue
+            side, column = row["side"], row.get("field")
+            item = {
+                "id": str(uuid.uuid4()),
+                "run_id": run_id,
+                "reservation_id": row["reservation_id"],
+                "confirmation_code": row["code"],
+                "issue_type": row["issue_type"],
+                "local_status": None,
+                "api_status": None,
+                "local_data": None,
+                "api_data": {"source": side, "xlsx": row["xlsx"], "period": [row["period_from"], row["period_to"]]},
+            }
+            if side == "only_in_supabase":
+                item["local_data"] = {"reserve_code": row["code"]}
+                sg = suggested.get(row["code"])
+                if sg:
+                    item["api_data"]["suggested_code"] = sg.xlsx_code
+                    item["api_data"]["suggestion_score"] = sg.score
+                    item["api_data"]["suggestion_reason"] = sg.reason
+            else:
+                theirs = row["raw_value"] if side == "raw_mismatch" else row["xlsx_value"]
+                item["local_data"] = {column: row["supabase_value"]}
+                item["api_data"][column] = theirs
+                if column == "status":
+                    item["local_status"], item["api_status"] = _cell_text(row["supabase_value"]), _cell_text(theirs)
+            yield item
+
+
+def persist_reconciliation_run(
+    cfg: SupabaseConfig,
+    organization_id: str,
+    results: Sequence[PeriodResult],
+    started_at: datetime,
+    session: Optional[requests.Session] = None,
+    chunk_size: int = RUN_ITEMS_CHUNK,
+    workers: int = 4,
+) -> Tuple[str, int, int]:
+    """Record the comparison as a reconciliation_runs row plus bulk reconciliation_items.
+
+    Items go through SupabaseClient.bulk_upsert (chunks of `chunk_size`, `Prefer: return=minimal`,
+    up to `workers` in flight); on_conflict=id with ignore-duplicates makes a retry after a lost
+    response harmless. The run ends 'completed', or 'partial' if some items still failed.
+    Returns (run_id, itemsWritten, itemsFailed).
+    """
+    # RLS only lets the service role write these tables.
+    client = SupabaseClient(cfg.as_service_role(), session=session, pool_size=max(workers, 1))
+    resp = client.request(
+        "POST",
+        "rest/v1/reconciliation_runs",
+        ["select=id"],
+        headers={"Prefer": "return=representation", "Accept": "application/vnd.pgrst.object+json"},
+        idempotent=False,
+        body=_json_body({"organization_id": organization_id, "status": "running", "started_at": started_at}),
+    )
+    run_id = resp.json()["id"]
+    run_filter = [f"id=eq.{run_id}"]
+    counts: Dict[str, int] = {}
+
+    def counted(items: Iterator[dict]) -> Iterator[dict]:
+        for item in items:
+            counts[item["issue_type"]] = counts.get(item["issue_type"], 0) + 1
+            yield item
+
+    try:
+        outcome = client.bulk_upsert(
+            "reconciliation_items",
+            counted(reconciliation_items(results, run_id)),
+            on_conflict="id",
+            ignore_duplicates=True,
+            chunk_rows=chunk_size,
+            workers=workers,
+            default=_cell_text,
+        )
+    except Exception as e:
+        failure = {
+            "status": "failed",
+            "finished_at": datetime.now(timezone.utc),
+            "error_message": f"{type(e).__name__}: {e}",
+        }
+        client.request("PATCH", "rest/v1/reconciliation_runs", run_filter, body=_json_body(failure))
+        raise
+
+    finished_at = datetime.now(timezone.utc)
+    found_deleted = counts.get("deleted", 0)
+    failed = len(outcome.failures)
+    errors = list(dict.fromkeys(failure.error for failure in outcome.failures))
+    client.request(
+        "PATCH",
+        "rest/v1/reconciliation_runs",
+        run_filter,
+        headers={"Prefer": "return=minimal"},
+        body=_json_body(
+            {
+                "status": "partial" if failed else "completed",
+                "finished_at": finished_at,
+                "duration_ms": int((finished_at - started_at).total_seconds() * 1000),
+                "total_checked": sum(r.supabase_codes for r in results),
+                "found_deleted": found_deleted,
+                "found_modified": sum(counts.values()) - found_deleted,
+                "error_message": "; ".join(errors[:5]) or None,
+                "summary": {
+                    "source": "compare-stays-xlsx-vs-supabase",
+                    "items_written": outcome.written,
+                    "items_failed": failed,
+                    "item_requests": outcome.requests,
+                    "issue_types": counts,
+                    "periods": [
+                        {
+                            "period": r.period.label,
+                            "xlsx_codes": r.xlsx_codes,
+                            "supabase_codes": r.supabase_codes,
+                            "only_in_supabase": len(r.only_in_supabase),
+                            "only_in_xlsx": r.only_in_xlsx[:200],
+                            "suggested_matches": len(r.suggestions),
+                        }
+                        for r in results
+                    ],
+                },
+            }
+        ),
+    )
+    return run_id, outcome.written, failed
+
+
+def report_persisted(
+    cfg: SupabaseConfig,
+    organization_id: str,
+    results: Sequence[PeriodResult],
+    started_at: datetime,
+    session: Optional[requests.Session] = None,
+) -> None:
+    run_id, written, failed = persist_reconciliation_run(cfg, organization_id, results, started_at, session=session)
+    print(f"\nPERSISTED_RUN={run_id} ITEMS={written}" + (f" FAILED_ITEMS={failed}" if failed else ""))
+
+
+@dataclass
+class SheetState:
+    fingerprint: Tuple[int, ...]
+    content_hash: str
+    index: Optional[SheetIndex]
+
+
+@dataclass
+class WatchedWorkbook:
+    stat: Tuple[int, int]  # (st_mtime_ns, st_size)
+    sheets: Dict[str, SheetState]  # workbook order
+    index: WorkbookIndex
+
+    @property
+    def content(self) -> List[Tuple[str, str]]:
+        return [(name, sheet.content_hash) for name, sheet in self.sheets.items()]
+
+
+class AuditFolderWatcher:
+    """Tracks the <from>_<to>_*.xlsx exports of a folder down to per-sheet content hashes.
+
+    A file whose (mtime, size) is unchanged is skipped. Otherwise sheets whose zip parts carry
+    the same CRCs keep their cached SheetIndex; the rest are re-parsed, hashing the cell stream
+    while indexing. A period counts as changed only when some sheet's content hash moved, so a
+    re-saved or re-copied export with the same cells does not trigger a reconcile.
+    """
+
+    def __init__(self, directory: Path, workers: int = 1, rules: Sequence[FieldRule] = ()):
+        self.directory = directory
+        self.workers = workers
+        self.rules = tuple(rules)
+        self.workbooks: Dict[Path, WatchedWorkbook] = {}
+        self.sheets_reparsed = 0
+        self.sheets_reused = 0
+
+    def poll(self) -> Tuple[List[Tuple[AuditPeriod, WorkbookIndex]], List[Path]]:
+        """(periods whose content changed or appeared, with their indexes; exports that disappeared)."""
+        changed: List[Tuple[AuditPeriod, WorkbookIndex]] = []
+        seen: Set[Path] = set()
+        for period in discover_audit_periods(self.directory):
+            path = period.xlsx
+            seen.add(path)
+            try:
+                st = path.stat()
+                known = self.workbooks.get(path)
+                if known and known.stat == (st.st_mtime_ns, st.st_size):
+                    continue
+                updated = self._rescan(path, (st.st_mtime_ns, st.st_size), known)
+            except (OSError, KeyError, zipfile.BadZipFile) as e:
+                # Usually an export still being copied in; the next poll sees a new size/mtime.
+                print(f"WATCH_SKIPPED {path.name} ({type(e).__name__}: {e})")
+                continue
+            self.workbooks[path] = updated
+            if not known or known.content != updated.content:
+                changed.append((period, updated.index))
+
+        removed = [path for path in self.workbooks if path not in seen]
+        for path in removed:
+            del self.workbooks[path]
+        return changed, removed
+
+    def _rescan(self, path: Path, stat: Tuple[int, int], known: Optional[WatchedWorkbook]) -> WatchedWorkbook:
+        fingerprints = sheet_fingerprints(path)
+        cached = known.sheets if known else {}
+        stale = [name for name, fp in fingerprints.items() if name not in cached or cached[name].fingerprint != fp]
+        fresh: Dict[str, SheetState] = {}
+        if stale:
+            sizes = {name: fingerprints[name][1] for name in stale}
+            for name, (index, content_hash) in index_sheets(
+                path, sizes, self.workers, hashed=True, rules=self.rules
+            ).items():
+                old = cached.get(name)
+                if old and old.content_hash == content_hash:
+                    index = old.index
+                fresh[name] = SheetState(fingerprints[name], content_hash, index)
+        self.sheets_reparsed += len(stale)
+        self.sheets_reused += len(fingerprints) - len(stale)
+
+        sheets = {name: fresh.get(name) or cached[name] for name in fingerprints}
+        return WatchedWorkbook(
+            stat, sheets, WorkbookIndex(path=path, sheets=[s.index for s in sheets.values() if s.index])
+        )
+
+
+def run_watch(
+    cfg: SupabaseConfig,
+    directory: Path,
+    options: FetchOptions,
+    rules: Sequence[FieldRule],
+    interval: float,
+    organization_id: Optional[str] = None,
+    sink: Optional[ResultSink] = None,
+    sheet_workers: int = 1,
+) -> int:
+    """Poll `directory` forever; reconcile only the periods whose export content changed."""
+    watcher = AuditFolderWatcher(directory, sheet_workers, rules)
+    session = build_session(pool_size=max(options.workers, 1))
+    print(f"WATCHING {directory} every {interval:g}s (Ctrl+C to stop)")
+    try:
+        while True:
+            reparsed, reused = watcher.sheets_reparsed, watcher.sheets_reused
+            started_at = datetime.now(timezone.utc)
+            changed, removed = watcher.poll()
+            stamp = datetime.now().strftime("%H:%M:%S")
+            for path in removed:
+                print(f"\n=== {stamp} REMOVED {path.name} ===")
+            if changed:
+                periods = [period for period, _ in changed]
+                window = (min(p.check_in_from for p in periods), max(p.check_in_to for p in periods))
+                rows, _ = load_reservation_rows(
+                    cfg,
+                    *window,
+                    options,
+                    organization_id=organization_id,
+                    extra_columns=[rule.column for rule in rules],
+                    session=session,
+                )
+                raw, _, _ = load_raw_reservations(cfg, *window, options, organization_id, session)
+                print_http_stats()
+                partitions = partition_rows_by_period(rows, periods)
+                raw_parts = partition_rows_by_period(raw, periods) if raw is not None else [None] * len(periods)
+                print(
+                    f"\n=== {stamp} CHANGED {len(changed)} export(s); sheets reparsed="
+                    f"{watcher.sheets_reparsed - reparsed} reused={watcher.sheets_reused - reused} ==="
+                )
+                results = []
+                for (period, index), part, raw_part in zip(changed, partitions, raw_parts):
+                    result = reconcile_period(period, part, rules, raw=raw_part, index=index)
+                    results.append(result)
+                    print(f"\n=== PERIOD {period.label} ===")
+                    print_report([result])
+                    if sink:
+                        sink.write_all(iter_difference_rows(result, organization_id))
+                if options.persist:
+                    report_persisted(cfg, organization_id, results, started_at, session)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("\nWATCH_STOPPED")
+        return 0
+
+
+@dataclass(frozen=True)
+class Organization:
+    id: str
+    slug: Optional[str] = None
+    name: Optional[str] = None
+
+    @property
+    def label(self) -> str:
+        return self.slug or self.id
+
+
+@dataclass
+class OrganizationResult:
+    organization: Organization
+    results: List[PeriodResult]
+    error: Optional[str] = None
+    # The worker's PhaseProfiler.summary() for this organization when profiling.
+    timings: Optional[dict] = None
+    page_records: List[dict] = field(default_factory=list)
+    # reconciliation_runs.id when the comparison was persisted.
+    run_id: Optional[str] = None
+
+    @property
+    def clean(self) -> bool:
+        return not self.error and all(r.clean for r in self.results)
+
+    def summary(self) -> dict:
+        return {
+            "organization_id": self.organization.id,
+            "slug": self.organization.slug,
+            "error": self.error,
+            "run_id": self.run_id,
+            "periods": [
+                {
+                    "period": r.period.label,
+                    "xlsx_codes": r.xlsx_codes,
+                    "supabase_codes": r.supabase_codes,
+                    "only_in_supabase": len(r.only_in_supabase),
+                    "only_in_xlsx": len(r.only_in_xlsx),
+                    "field_mismatches": {col: len(m) for col, m in r.field_mismatches.items()},
+                    "suggested_matches": len(r.suggestions),
+                    **(
+                        {
+                            "raw_stages": {stage: len(codes) for stage, codes in r.raw_stages.stages.items()},
+                            "raw_mismatches": len(r.raw_stages.mismatches),
+                        }
+                        if r.raw_stages
+                        else {}
+                    ),
+                }
+                for r in self.results
+            ],
+        }
+
+
+def fetch_stays_organizations(
+    cfg: SupabaseConfig, cache: ReferenceCache, session: Optional[requests.Session] = None
+) -> List[Organization]:
+    """Organizations with an enabled staysnet_config row; a 'global' config covers every organization.
+
+    Both tables are read through `cache`, so a fleet run repeated within its TTL costs no request,
+    and a later one only the version probes unless a tenant was added or changed.
+    """
+    client = SupabaseClient(cfg, session=session or build_session(pool_size=1))
+    configs = cache.select(client, "staysnet_config", "id,organization_id", ["enabled=is.true"], order="id")
+    organizations = cache.select(client, "organizations", "id,slug,name", order="id")
+
+    org_ids = {str(row["organization_id"]) for row in configs if row.get("organization_id")}
+    covers_all = "global" in org_ids
+    return [
+        Organization(str(row["id"]), row.get("slug"), row.get("name"))
+        for row in organizations
+        if covers_all or str(row["id"]) in org_ids
+    ]
+
+
+def organization_export_dir(audit_root: Path, org: Organization) -> Optional[Path]:
+    """Each tenant's exports live in <audit_root>/<slug> or <audit_root>/<organization id>."""
+    for name in (org.slug, org.id):
+        if name and (audit_root / name).is_dir():
+            return audit_root / name
+    return None
+
+
+_worker_session: Optional[requests.Session] = None
+
+
+def _init_fleet_worker(
+    pool_size: int,
+    profile: bool = False,
+    http_cache: Optional[Path] = None,
+    max_concurrency: Optional[int] = None,
+) -> None:
+    global _worker_session
+    _worker_session = build_session(pool_size=pool_size)
+    PROFILER.enabled = profile
+    PROGRESS.quiet = True
+    if http_cache:
+        HTTP_CACHE.open(http_cache)
+    if max_concurrency:
+        configure_limiters(max_concurrency)
+
+
+def reconcile_organization(
+    cfg: SupabaseConfig,
+    org: Organization,
+    export_dir: Path,
+    options: FetchOptions,
+    rules: Sequence[FieldRule] = (),
+) -> OrganizationResult:
+    """Fleet worker: one fetch for the tenant's union window, then every period in-process."""
+    PROFILER.reset()
+    started_at = datetime.now(timezone.utc)
+    try:
+        periods = discover_audit_periods(export_dir)
+        if not periods:
+            return OrganizationResult(org, [], error=f"no <from>_<to>_*.xlsx exports in {export_dir}")
+        window = (min(p.check_in_from for p in periods), max(p.check_in_to for p in periods))
+        if options.memory_cap:
+            stream = iter_reservation_rows(cfg, *window, options, organization_id=org.id, session=_worker_session)
+            period_results = reconcile_periods_external(periods, stream, options.memory_cap)
+        else:
+            rows, _ = load_reservation_rows(
+                cfg,
+                *window,
+                options,
+                organization_id=org.id,
+                extra_columns=[rule.column for rule in rules],
+                session=_worker_session,
+            )
+            raw, _, _ = load_raw_reservations(cfg, *window, options, organization_id=org.id, session=_worker_session)
+            period_results = reconcile_periods(periods, rows, workers=1, rules=rules, raw=raw)
+        result = OrganizationResult(org, period_results)
+        if options.persist:
+            result.run_id, _, failed = persist_reconciliation_run(
+                cfg, org.id, period_results, started_at, session=_worker_session
+            )
+            if failed:
+                result.error = f"{failed} reconciliation_items could not be written (run {result.run_id})"
+    except Exception as e:
+        result = OrganizationResult(org, [], error=f"{type(e).__name__}: {e}")
+    if PROFILER.enabled:
+        result.timings = PROFILER.summary()
+        result.page_records = PROFILER.pages
+    return result
+
+
+def run_fleet(
+    cfg: SupabaseConfig,
+    audit_root: Path,
+    options: FetchOptions,
+    rules: Sequence[FieldRule],
+    processes: int,
+    report_path: Path,
+    sink: Optional[ResultSink] = None,
+    reference_ttl: float = REFERENCE_TTL,
+) -> int:
+    """Shard Stays-enabled tenants across a process pool; stream each result into a JSONL report.
+
+    The tenant list comes through a ReferenceCache (see fetch_stays_organizations) whose entries
+    are trusted for `reference_ttl` seconds before their version is checked again.
+    """
+    cfg = cfg.as_service_role()
+    cache = ReferenceCache(ttl=reference_ttl)
+    try:
+        orgs = fetch_stays_organizations(cfg, cache)
+    finally:
+        cache.close()
+    print(f"FLEET_ORGANIZATIONS={len(orgs)}")
+
+    jobs: List[Tuple[Organization, Path]] = []
+    for org in orgs:
+        export_dir = organization_export_dir(audit_root, org)
+        if export_dir:
+            jobs.append((org, export_dir))
+        else:
+            print(f"ORG {org.label} SKIPPED (no export folder in {audit_root})")
+
+    dirty = 0
+    processes = max(1, processes)
+    # Limiters are per process, so each worker gets its share of the ceiling.
+    max_concurrency = max(options.max_concurrency // processes, 1) if options.max_concurrency else None
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    with report_path.open("w", encoding="utf-8") as report, ProcessPoolExecutor(
+        max_workers=processes,
+        initializer=_init_fleet_worker,
+        initargs=(max(options.workers, 1), PROFILER.enabled, options.http_cache, max_concurrency),
+    ) as pool:
+        futures = [pool.submit(reconcile_organization, cfg, org, d, options, tuple(rules)) for org, d in jobs]
+        for future in as_completed(futures):
+            result = future.result()
+            report.write(json.dumps(result.summary(), ensure_ascii=False) + "\n")
+            report.flush()
+            if result.timings:
+                PROFILER.merge(result.timings["phases"], result.page_records)
+                PROFILER.organizations.append({"organization_id": result.organization.id, **result.timings})
+            if sink:
+                with PROFILER.phase("write_output"):
+                    for period_result in result.results:
+                        sink.write_all(iter_difference_rows(period_result, result.organization.id))
+            if result.error:
+                print(f"ORG {result.organization.label} ERROR {result.error}")
+            else:
+                print(
+                    f"ORG {result.organization.label} periods={len(result.results)} "
+                    f"only_in_supabase={sum(len(r.only_in_supabase) for r in result.results)} "
+                    f"only_in_xlsx={sum(len(r.only_in_xlsx) for r in result.results)} "
+                    f"field_mismatches={sum(len(m) for r in result.results for m in r.field_mismatches.values())}"
+                    + (f" run_id={result.run_id}" if result.run_id else "")
+                )
+            dirty += 0 if result.clean else 1
+
+    print(f"\nFLEET_RECONCILED={len(jobs)}")
+    print(f"FLEET_WITH_DIFFERENCES={dirty}")
+    print(f"FLEET_REPORT={report_path}")
+    return 0 if not dirty else 1
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Compare Stays XLSX reserve codes against Supabase reservations.")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Concurrent page fetches against /rest/v1/reservations (1 = serial walk).",
+    )
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        metavar="N",
+        help="Most requests in flight per Supabase service; below it an AIMD limiter backs off on 429/5xx, "
+        "timeouts and latency spikes and honors Retry-After (fleet mode splits N across processes).",
+    )
+    parser.add_argument(
+        "--pagination",
+        choices=PAGINATION_MODES,
+        default="keyset",
+        help="keyset (default) resumes after the last (check_in, id); offset is the limit/offset fallback.",
+    )
+    parser.add_argument(
+        "--transfer",
+        choices=TRANSFER_FORMATS,
+        default="json",
+        help="Wire format for the reservations fetch: csv streams text/csv through a CSV reader "
+        "(smaller pages, no per-row dicts); json is the default.",
+    )
+    parser.add_argument("--organization-id", help="Only compare reservations of this organization.")
+    parser.add_argument(
+        "--snapshot",
+        nargs="?",
+        type=Path,
+        const=DEFAULT_SNAPSHOT_PATH,
+        help=f"Diff against a local SQLite snapshot refreshed incrementally (default path: {DEFAULT_SNAPSHOT_PATH}).",
+    )
+    parser.add_argument(
+        "--snapshot-rebuild",
+        action="store_true",
+        help="Drop and re-pull the snapshot (and --raw-objects) partition (picks up hard-deleted rows).",
+    )
+    parser.add_argument(
+        "--http-cache",
+        nargs="?",
+        type=Path,
+        const=DEFAULT_HTTP_CACHE_PATH,
+        metavar="PATH",
+        help="Keep Supabase page bodies with their ETag and revalidate them with If-None-Match "
+        f"(default PATH: {DEFAULT_HTTP_CACHE_PATH}). Only pays off behind a proxy that adds ETags and "
+        "answers 304: stock PostgREST sends none. Pages are then buffered whole, even with --transfer csv.",
+    )
+    parser.add_argument(
+        "--raw-objects",
+        nargs="?",
+        type=Path,
+        const=RAW_OBJECTS_PATH,
+        help="Also diff against the latest staysnet_raw_objects payloads, cached locally by payload_hash, to "
+        f"show which import stage lost or changed a reservation (default cache: {RAW_OBJECTS_PATH}).",
+    )
+    parser.add_argument(
+        "--period",
+        nargs=3,
+        action="append",
+        metavar=("FROM", "TO", "XLSX"),
+        help="Reconcile XLSX against check_in FROM..TO (repeatable; all periods share one Supabase fetch).",
+    )
+    parser.add_argument(
+        "--audit-dir",
+        type=Path,
+        help="Reconcile every <from>_<to>_*.xlsx export in this directory.",
+    )
+    parser.add_argument(
+        "--watch",
+        nargs="?",
+        type=float,
+        const=5.0,
+        metavar="SECONDS",
+        help="Poll --audit-dir (default: the audit folder) every SECONDS (default 5) and re-reconcile only the "
+        "exports whose sheet contents changed; unchanged sheets keep their cached index.",
+    )
+    parser.add_argument(
+        "--fields",
+        nargs="?",
+        const="all",
+        help="Also diff field values for codes on both sides: 'all' or a comma list of "
+        + ", ".join(rule.column for rule in FIELD_RULES),
+    )
+    parser.add_argument(
+        "--period-workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Processes used to parse and reconcile periods in parallel (a single period, or --watch, "
+        "spreads a large workbook's sheets over them instead).",
+    )
+    parser.add_argument(
+        "--output",
+        type=Path,
+        help="Stream every difference row (not just the first 50 printed) to this file.",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=OUTPUT_FORMATS,
+        help="Format for --output (default: taken from the file suffix).",
+    )
+    parser.add_argument(
+        "--memory-cap",
+        type=int,
+        metavar="MB",
+        help="Diff reserve codes with an external sort whose buffers stay within about MB megabytes (per fleet "
+        "process): sorted runs spill to $TMPDIR and are merge-diffed. Periods run serially; no --fields or "
+        "--raw-objects.",
+    )
+    parser.add_argument(
+        "--persist",
+        action="store_true",
+        help="Record the comparison as a reconciliation_runs row with bulk-inserted reconciliation_items "
+        "(needs SUPABASE_SERVICE_ROLE_KEY, and --organization-id outside --fleet).",
+    )
+    parser.add_argument(
+        "--fleet",
+        action="store_true",
+        help="Reconcile every Stays-enabled organization (needs SUPABASE_SERVICE_ROLE_KEY); "
+        "exports are read from <audit-dir>/<org slug or id>/.",
+    )
+    parser.add_argument(
+        "--fleet-processes",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Processes the fleet mode shards organizations across.",
+    )
+    parser.add_argument(
+        "--fleet-report",
+        type=Path,
+        help="JSONL report written by the fleet mode (default: <audit-dir>/fleet-report-<timestamp>.jsonl).",
+    )
+    parser.add_argument(
+        "--reference-ttl",
+        type=float,
+        default=REFERENCE_TTL,
+        metavar="SECONDS",
+        help="How long the fleet mode reuses its cached tenant list (staysnet_config, organizations) before "
+        "checking row count and max(updated_at) again; 0 checks on every run.",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        type=Path,
+        const=True,
+        help="Record wall/CPU time and peak RSS per phase and per page fetch; write a JSON summary to PATH "
+        f"(default: next to --output or the fleet report, else {DEFAULT_PROFILE_DIR}).",
+    )
+    parser.add_argument(
+        "--profile-pstats",
+        type=Path,
+        metavar="PATH",
+        help="Also run the main process under cProfile and dump pstats here (worker processes are not included; "
+        "use --period-workers 1 to keep period parsing in-process).",
+    )
+    return parser.parse_args(argv)
+
+
+def _open_output(args: argparse.Namespace) -> ContextManager[Optional[ResultSink]]:
+    return open_sink(args.output, args.output_format) if args.output else nullcontext()
+
+
+def _profile_path(args: argparse.Namespace, stamp: str) -> Path:
+    if args.profile is not True:
+        return args.profile
+    base = args.output or (args.fleet_report if args.fleet else None)
+    if base:
+        return base.with_name(base.name + ".timings.json")
+    return DEFAULT_PROFILE_DIR / f"compare-{stamp}.timings.json"
+
+
+def write_profile_summary(path: Path, argv: Sequence[str], wall_s: float, cpu_s: float, exit_code: int) -> None:
+    summary = {
+        "argv": list(argv),
+        "exit_code": exit_code,
+        "wall_s": round(wall_s, 4),
+        "cpu_s": round(cpu_s, 4),
+        # Worker processes are reaped by the time the run ends, so this covers the pools.
+        "children_cpu_s": (
+            round(sum(resource.getrusage(resource.RUSAGE_CHILDREN)[:2]), 4) if resource is not None else None
+        ),
+        "peak_rss_bytes": peak_rss_bytes(),
+        **PROFILER.summary(),
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(summary, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+
+
+def print_profile(path: Path) -> None:
+    print(f"\nPROFILE={path}")
+    for name, t in PROFILER.phase_summary().items():
+        rss = f" peak_rss={t['peak_rss_bytes'] / 2**20:.0f}MiB" if t["peak_rss_bytes"] is not None else ""
+        print(f"PROFILE[{name}] calls={t['calls']} wall={t['wall_s']:.3f}s cpu={t['cpu_s']:.3f}s{rss}")
+    for table, p in PROFILER.page_summary().items():
+        print(
+            f"PROFILE_PAGES[{table}] pages={p['pages']} rows={p['rows']} bytes={p['bytes']} "
+            f"p50={p['page_wall_s_p50']:.3f}s p95={p['page_wall_s_p95']:.3f}s max={p['page_wall_s_max']:.3f}s"
+        )
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    if args.fleet and not args.fleet_report:
+        args.fleet_report = (args.audit_dir or DEFAULT_AUDIT_DIR) / f"fleet-report-{stamp}.jsonl"
+    if not args.profile and not args.profile_pstats:
+        return run(args)
+
+    PROFILER.enabled = bool(args.profile)
+    pstats_profiler = cProfile.Profile() if args.profile_pstats else None
+    wall0, cpu0 = time.perf_counter(), time.process_time()
+    exit_code = 2
+    if pstats_profiler:
+        pstats_profiler.enable()
+    try:
+        exit_code = run(args)
+    finally:
+        if pstats_profiler:
+            pstats_profiler.disable()
+            args.profile_pstats.parent.mkdir(parents=True, exist_ok=True)
+            pstats_profiler.dump_stats(str(args.profile_pstats))
+        if args.profile:
+            path = _profile_path(args, stamp)
+            write_profile_summary(
+                path,
+                sys.argv[1:] if argv is None else argv,
+                time.perf_counter() - wall0,
+                time.process_time() - cpu0,
+                exit_code,
+            )
+            print_profile(path)
+        if pstats_profiler:
+            print(f"PROFILE_PSTATS={args.profile_pstats}")
+    return exit_code
+
+
+def run(args: argparse.Namespace) -> int:
+    repo_root = Path(__file__).resolve().parent
+    started_at = datetime.now(timezone.utc)
+
+    try:
+        rules = select_field_rules(args.fields)
+    except ValueError as e:
+        print(f"ERROR: {e}")
+        return 2
+    if args.output and (args.output_format or args.output.suffix.lstrip(".").lower()) not in OUTPUT_FORMATS:
+        print(f"ERROR: cannot infer the output format of {args.output}; pass --output-format")
+        return 2
+    options = FetchOptions(
+        workers=args.workers,
+        pagination=args.pagination,
+        snapshot=args.snapshot,
+        snapshot_rebuild=args.snapshot_rebuild,
+        transfer=args.transfer,
+        raw_objects=args.raw_objects,
+        memory_cap=args.memory_cap * 2**20 if args.memory_cap else None,
+        persist=args.persist,
+        http_cache=args.http_cache,
+        max_concurrency=args.max_concurrency,
+    )
+    if options.memory_cap and (rules or options.raw_objects):
+        print("ERROR: --memory-cap only diffs reserve codes; drop --fields / --raw-objects")
+        return 2
+    if options.persist and not (args.fleet or args.organization_id):
+        print("ERROR: --persist needs --organization-id (reconciliation_runs belong to one organization)")
+        return 2
+
+    if options.http_cache and not args.fleet:
+        HTTP_CACHE.open(options.http_cache)
+    if options.max_concurrency and not args.fleet:
+        configure_limiters(options.max_concurrency)
+
+    if args.fleet:
+        audit_root = args.audit_dir or DEFAULT_AUDIT_DIR
+        cfg = load_supabase_config(repo_root)
+        with _open_output(args) as sink:
+            return run_fleet(
+                cfg, audit_root, options, rules, args.fleet_processes, args.fleet_report, sink, args.reference_ttl
+            )
+
+    if args.watch is not None:
+        if args.period or options.memory_cap:
+            print("ERROR: --watch polls a whole folder; drop --period / --memory-cap")
+            return 2
+        watch_dir = args.audit_dir or DEFAULT_AUDIT_DIR
+        if not watch_dir.is_dir():
+            print(f"ERROR: audit folder not found: {watch_dir}")
+            return 2
+        cfg = load_supabase_config(repo_root)
+        with _open_output(args) as sink:
+            return run_watch(
+                cfg, watch_dir, options, rules, args.watch, args.organization_id, sink, args.period_workers
+            )
+
+    periods = [AuditPeriod(Path(xlsx), start, end) for start, end, xlsx in args.period or []]
+    if args.audit_dir:
+        found = discover_audit_periods(args.audit_dir)
+        if not found:
+            print(f"ERROR: no <from>_<to>_*.xlsx exports found in {args.audit_dir}")
+            return 2
+        periods.extend(found)
+    if not periods:
+        periods = [DEFAULT_PERIOD]
+
+    for period in periods:
+        if not period.xlsx.exists():
+            print(f"ERROR: XLSX not found: {period.xlsx}")
+            return 2
+
+    cfg = load_supabase_config(repo_root)
 
-    print(f"XLSX_RESERVA_CODES={len(xlsx_reserva)}")
-    print(f"SUPABASE_RESERVA_CODES={len(supa_reserva)}")
-    print(f"ONLY_IN_SUPABASE={len(only_in_supabase)}")
-    print(f"ONLY_IN_XLSX={len(only_in_xlsx)}")
+    window = (min(p.check_in_from for p in periods), max(p.check_in_to for p in periods))
+    if options.memory_cap:
+        stream = iter_reservation_rows(cfg, *window, options, organization_id=args.organization_id)
+        with _open_output(args) as sink:
+            results = reconcile_periods_external(periods, stream, options.memory_cap, sink, args.organization_id)
+        print_report(results)
+        print_http_stats()
+        if sink:
+            print(f"\nOUTPUT={args.output} ROWS={sink.rows_written}")
+        if options.persist:
+            report_persisted(cfg, args.organization_id, results, started_at)
+        return 0 if all(r.clean for r in results) else 1
 
-    if only_in_supabase:
-        print("\nEXTRA_IN_SUPABASE (Reserva codes):")
-        for code in only_in_supabase[:50]:
-            rid = mapping.get(code)
-            suffix = f" -> reservationId={rid}" if rid else ""
-            print(f"{code}{suffix}")
+    # One fetch covers every period; reconcile_periods partitions it by check_in.
+    rows, pulled = load_reservation_rows(
+        cfg,
+        *window,
+        options,
+        organization_id=args.organization_id,
+        extra_columns=[rule.column for rule in rules],
+    )
+    if pulled is not None:
+        print(f"SNAPSHOT_REFRESHED_ROWS={pulled}")
+    raw, raw_pulled, raw_downloaded = load_raw_reservations(cfg, *window, options, organization_id=args.organization_id)
+    if raw is not None:
+        print(f"RAW_OBJECTS_REFRESHED={raw_pulled} RAW_PAYLOADS_DOWNLOADED={raw_downloaded}")
+    print_http_stats()
 
-    if only_in_xlsx:
-        print("\nMISSING_IN_SUPABASE (Reserva codes):")
-        for code in only_in_xlsx[:50]:
-            print(code)
+    with _open_output(args) as sink:
+        results = reconcile_periods(
+            periods,
+            rows,
+            workers=args.period_workers,
+            rules=rules,
+            sink=sink,
+            organization_id=args.organization_id,
+            raw=raw,
+        )
+    print_report(results)
+    if sink:
+        print(f"\nOUTPUT={args.output} ROWS={sink.rows_written}")
+    if options.persist:
+        report_persisted(cfg, args.organization_id, results, started_at)
 
-    return 0 if (not only_in_supabase and not only_in_xlsx) else 1
+    return 0 if all(r.clean for r in results) else 1
 
 
 if __name__ == "__main__":
@@ -3,24 +3,26 @@
 """
 Script para configurar o Gemini no banco de dados
 Atualiza ou cria a configuração do provedor de IA Gemini
+
+Uso:
+    python configurar_gemini_banco.py                       # primeira organização
+    python configurar_gemini_banco.py --todas-organizacoes  # todas, em upserts em lote
 """
 
 import os
 import sys
-import json
-from urllib.request import Request, urlopen
-from urllib.error import HTTPError, URLError
+import uuid
 import base64
 
-# Configurações do Supabase (via env vars)
-SUPABASE_URL = os.environ.get("SUPABASE_URL") or os.environ.get("VITE_SUPABASE_URL")
-SUPABASE_ANON_KEY = os.environ.get("SUPABASE_ANON_KEY") or os.environ.get("VITE_SUPABASE_ANON_KEY")
+import requests
 
-if not SUPABASE_URL:
-    raise SystemExit("Missing env var SUPABASE_URL")
+from supabase_client import SupabaseClient, load_supabase_config
 
-if not SUPABASE_ANON_KEY:
-    raise SystemExit("Missing env var SUPABASE_ANON_KEY")
+# Configurações do Supabase (.env.local ou env vars)
+try:
+    client = SupabaseClient(load_supabase_config())
+except RuntimeError as e:
+    raise SystemExit(str(e))
 
 # API Key do Gemini (via env vars)
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_GEMINI_API_KEY")
@@ -42,51 +44,31 @@ def encrypt_api_key(api_key: str) -> str:
 
 def get_organization_id():
     """Obtém o organization_id do banco de dados"""
-    url = f"{SUPABASE_URL}/rest/v1/organizations?select=id&limit=1"
-    
-    headers = {
-        "apikey": SUPABASE_ANON_KEY,
-        "Authorization": f"Bearer {SUPABASE_ANON_KEY}",
-        "Content-Type": "application/json",
-    }
-    
     try:
-        req = Request(url, headers=headers)
-        with urlopen(req) as response:
-            data = json.loads(response.read().decode())
-            if data and len(data) > 0:
-                return data[0]["id"]
-            return None
+        data = client.select("organizations", "id", limit=1)
+        if data and len(data) > 0:
+            return data[0]["id"]
+        return None
     except Exception as e:
         print(f"❌ Erro ao buscar organization_id: {e}")
         return None
 
 def check_existing_config(organization_id: str):
     """Verifica se já existe configuração de IA para a organização"""
-    url = f"{SUPABASE_URL}/rest/v1/ai_provider_configs?organization_id=eq.{organization_id}&select=*"
-    
-    headers = {
-        "apikey": SUPABASE_ANON_KEY,
-        "Authorization": f"Bearer {SUPABASE_ANON_KEY}",
-        "Content-Type": "application/json",
-    }
-    
     try:
-        req = Request(url, headers=headers)
-        with urlopen(req) as response:
-            data = json.loads(response.read().decode())
-            return data[0] if data and len(data) > 0 else None
+        data = client.select("ai_provider_configs", "*", {"organization_id": f"eq.{organization_id}"})
+        return data[0] if data and len(data) > 0 else None
     except Exception as e:
         print(f"⚠️  Erro ao verificar configuração existente: {e}")
         return None
 
-def create_or_update_config(organization_id: str, existing_config=None):
-    """Cria ou atualiza a configuração do Gemini"""
+def build_config_data(organization_id: str) -> dict:
+    """Linha de ai_provider_configs do Gemini para a organização"""
     
     # Criptografar API key (simulado)
     encrypted_key = encrypt_api_key(GEMINI_API_KEY)
     
-    config_data = {
+    return {
         "organization_id": organization_id,
         "provider": "google-gemini",
         "base_url": GEMINI_BASE_URL,
@@ -99,48 +81,75 @@ def create_or_update_config(organization_id: str, existing_config=None):
         "api_key_encrypted": encrypted_key,
         "notes": "Configurado automaticamente via script - modelo testado: gemini-2.5-flash"
     }
+
+def create_or_update_config(organization_id: str, existing_config=None):
+    """Cria ou atualiza a configuração do Gemini"""
     
-    if existing_config:
-        # Atualizar configuração existente
-        config_id = existing_config["id"]
-        url = f"{SUPABASE_URL}/rest/v1/ai_provider_configs?id=eq.{config_id}"
-        method = "PATCH"
-        print(f"🔄 Atualizando configuração existente (ID: {config_id})...")
-    else:
-        # Criar nova configuração
-        url = f"{SUPABASE_URL}/rest/v1/ai_provider_configs"
-        method = "POST"
-        print(f"➕ Criando nova configuração...")
-    
-    headers = {
-        "apikey": SUPABASE_ANON_KEY,
-        "Authorization": f"Bearer {SUPABASE_ANON_KEY}",
-        "Content-Type": "application/json",
-        "Prefer": "return=representation"
-    }
+    config_data = build_config_data(organization_id)
     
     try:
-        req = Request(url, data=json.dumps(config_data).encode(), headers=headers, method=method)
-        with urlopen(req) as response:
-            result = json.loads(response.read().decode())
-            if isinstance(result, list) and len(result) > 0:
-                result = result[0]
-            
-            print(f"✅ Configuração {'atualizada' if existing_config else 'criada'} com sucesso!")
-            print(f"   Provider: {result.get('provider')}")
-            print(f"   Modelo: {result.get('default_model')}")
-            print(f"   Base URL: {result.get('base_url')}")
-            print(f"   Habilitado: {result.get('enabled')}")
-            return result
-    except HTTPError as e:
-        error_body = e.read().decode() if e.fp else "Sem detalhes"
-        print(f"❌ Erro HTTP {e.code}: {error_body}")
+        if existing_config:
+            # Atualizar configuração existente
+            config_id = existing_config["id"]
+            print(f"🔄 Atualizando configuração existente (ID: {config_id})...")
+            result = client.update("ai_provider_configs", config_data, {"id": f"eq.{config_id}"}, returning=True)
+        else:
+            # Criar nova configuração
+            print(f"➕ Criando nova configuração...")
+            result = client.insert("ai_provider_configs", config_data, returning=True)
+        if isinstance(result, list) and len(result) > 0:
+            result = result[0]
+
+        print(f"✅ Configuração {'atualizada' if existing_config else 'criada'} com sucesso!")
+        print(f"   Provider: {result.get('provider')}")
+        print(f"   Modelo: {result.get('default_model')}")
+        print(f"   Base URL: {result.get('base_url')}")
+        print(f"   Habilitado: {result.get('enabled')}")
+        return result
+    except requests.HTTPError as e:
+        error_body = e.response.text or "Sem detalhes"
+        print(f"❌ Erro HTTP {e.response.status_code}: {error_body}")
         return None
     except Exception as e:
         print(f"❌ Erro ao {'atualizar' if existing_config else 'criar'} configuração: {e}")
         return None
 
+def configure_all_organizations():
+    """Cria ou atualiza a configuração do Gemini de todas as organizações em upserts em lote"""
+    print("=" * 60)
+    print("🔧 CONFIGURADOR DE GEMINI - TODAS AS ORGANIZAÇÕES")
+    print("=" * 60)
+    print()
+    
+    try:
+        organizations = client.select("organizations", "id", order="id")
+        existing = client.select("ai_provider_configs", "id,organization_id", order="created_at")
+    except requests.HTTPError as e:
+        print(f"❌ Erro HTTP {e.response.status_code}: {e.response.text or 'Sem detalhes'}")
+        return 1
+    
+    # organization_id não é único na tabela: reaproveita a primeira configuração de cada organização
+    # e gera o id das novas, para o upsert em lote poder usar on_conflict=id.
+    config_ids = {}
+    for config in existing:
+        config_ids.setdefault(config["organization_id"], config["id"])
+    rows = [
+        {"id": config_ids.get(org["id"]) or str(uuid.uuid4()), **build_config_data(org["id"])}
+        for org in organizations
+    ]
+    updates = sum(1 for org in organizations if org["id"] in config_ids)
+    print(f"📋 {len(rows)} organizações: {updates} para atualizar, {len(rows) - updates} para criar")
+    
+    result = client.bulk_upsert("ai_provider_configs", rows, on_conflict="id")
+    print(f"✅ {result.written} configurações gravadas em {result.requests} requisições")
+    for failure in result.failures:
+        print(f"❌ Organização {failure.row['organization_id']}: {failure.error}")
+    return 0 if result.ok else 1
+
 def main():
+    if "--todas-organizacoes" in sys.argv[1:]:
+        return configure_all_organizations()
+    
     print("=" * 60)
     print("🔧 CONFIGURADOR DE GEMINI NO BANCO DE DADOS")
     print("=" * 60)
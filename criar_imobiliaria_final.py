@@ -1,24 +1,12 @@
-import os
-import requests
 import json
 import sys
 
-SUPABASE_URL = os.environ.get("SUPABASE_URL") or os.environ.get("VITE_SUPABASE_URL")
-SUPABASE_ANON_KEY = os.environ.get("SUPABASE_ANON_KEY") or os.environ.get("VITE_SUPABASE_ANON_KEY")
+from supabase_client import SupabaseClient, load_supabase_config
 
-if not SUPABASE_URL:
-    raise SystemExit("Missing env var SUPABASE_URL")
-
-if not SUPABASE_ANON_KEY:
-    raise SystemExit("Missing env var SUPABASE_ANON_KEY")
-
-url = f"{SUPABASE_URL.rstrip('/')}/functions/v1/rendizy-server/organizations"
-
-headers = {
-    "Content-Type": "application/json",
-    "Authorization": f"Bearer {SUPABASE_ANON_KEY}",
-    "apikey": SUPABASE_ANON_KEY,
-}
+try:
+    client = SupabaseClient(load_supabase_config(), timeout=30)
+except RuntimeError as e:
+    raise SystemExit(str(e))
 
 payload = {
     "name": "Sua Casa Mobiliada",
@@ -38,7 +26,7 @@ result_text.append(f"Plano: {payload['plan']}")
 result_text.append("")
 
 try:
-    response = requests.post(url, headers=headers, json=payload, timeout=30)
+    response = client.function("rendizy-server/organizations", json_body=payload)
     
     result_text.append(f"Status Code: {response.status_code}")
     result_text.append("")
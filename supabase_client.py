@@ -0,0 +1,879 @@
+"""Pooled Supabase (PostgREST + Edge Functions) access shared by the repo's Python scripts.
+
+    from supabase_client import SupabaseClient, load_supabase_config
+
+    client = SupabaseClient(load_supabase_config())
+    orgs = client.select("organizations", "id,name", {"status": "eq.active"}, limit=10)
+
+Every client keeps one keep-alive requests.Session, so repeated calls reuse connections, and
+every request goes through send_with_retry (timeouts plus jittered backoff on 429/5xx) and
+the AdaptiveLimiter of its host and service, which caps how many are in flight process-wide.
+ReferenceCache keeps lookup tables on disk between runs, and iter_json_array / select_stream
+decode large responses one row at a time.
+"""
+
+import codecs
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Set, Tuple, Union
+from urllib.parse import quote, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+REPO_ROOT = Path(__file__).resolve().parent
+DEFAULT_TIMEOUT = 60.0
+DEFAULT_ATTEMPTS = 5
+
+# Worth another try for a request that is safe to repeat.
+RETRY_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+# The server rejected the request before doing any work, so even a plain insert can be repeated.
+UNPROCESSED_STATUSES = frozenset({429, 503})
+
+# Signs of an overloaded server: the limiter halves its concurrency on these (and on timeouts).
+THROTTLE_STATUSES = frozenset({429, 502, 503, 504})
+# AdaptiveLimiter defaults: starting and maximum requests in flight per host and service.
+LIMIT_INITIAL = 8
+LIMIT_MAX = 32
+# A response this many times slower than the limiter's latency baseline counts as congestion,
+# once the baseline has this many samples (a run's first requests are often unlike the rest).
+LATENCY_TOLERANCE = 3.0
+LATENCY_WARMUP = 20
+# Longest Retry-After honored; a larger value is treated as this.
+MAX_RETRY_AFTER = 120.0
+
+# bulk_upsert chunk limits: rows per request, and request body size (well under PostgREST's limits).
+BULK_CHUNK_ROWS = 500
+BULK_CHUNK_BYTES = 1 * 2**20
+# Rejections caused by some rows' content (conflicts, and Postgres data exceptions / integrity
+# violations, SQLSTATE classes 22 and 23), which bisecting a chunk can isolate. Any other error
+# (unknown table or column, schema cache, auth) fails every row alike.
+ROW_LEVEL_STATUSES = frozenset({409, 422})
+ROW_LEVEL_SQLSTATE_CLASSES = ("22", "23")
+
+# iter_json_array reads the socket in blocks of this many bytes.
+JSON_STREAM_CHUNK = 64 * 2**10
+_JSON_SPACE = " \t\r\n"
+# What may still follow a number the decoder stopped at, if the rest has not been read yet.
+_NUMBER_TAIL_RE = re.compile(r"[0-9eE+\-.]*")
+
+# ReferenceCache: where it lives, how long an entry is served without asking the server, and
+# how much it may hold before least-recently-used entries are evicted.
+DEFAULT_REFERENCE_CACHE_PATH = REPO_ROOT / ".cache" / "reference-tables.sqlite"
+REFERENCE_TTL = 15 * 60.0
+REFERENCE_MAX_BYTES = 64 * 2**20
+REFERENCE_PAGE_ROWS = 1000
+REFERENCE_CACHE_VERSION = 1
+REFERENCE_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    cache_key TEXT PRIMARY KEY,  -- sha256 of project URL, API key and the table's query
+    table_name TEXT NOT NULL,
+    version TEXT NOT NULL,       -- '<row count>:<max(version column)>' when the rows were fetched
+    checked_at REAL NOT NULL,    -- last time the version was confirmed (or the rows fetched)
+    used_at REAL NOT NULL,       -- LRU clock
+    size INTEGER NOT NULL,
+    body BLOB NOT NULL           -- zlib-compressed JSON rows
+);
+CREATE INDEX IF NOT EXISTS entries_used_at ON entries (used_at);
+"""
+
+Filters = Union[Mapping[str, str], Sequence[str]]
+
+
+@dataclass(frozen=True)
+class SupabaseConfig:
+    url: str
+    anon_key: str
+    service_role_key: Optional[str] = None
+
+    def as_service_role(self) -> "SupabaseConfig":
+        """Config whose request key is the service role key (cross-tenant reads bypass RLS)."""
+        if not self.service_role_key:
+            raise RuntimeError("Missing SUPABASE_SERVICE_ROLE_KEY in .env.local")
+        return SupabaseConfig(url=self.url, anon_key=self.service_role_key, service_role_key=self.service_role_key)
+
+
+def read_env_value(env_path: Path, key: str) -> Optional[str]:
+    if not env_path.exists():
+        return None
+    for line in env_path.read_text(encoding="utf-8", errors="ignore").splitlines():
+        if not line or line.lstrip().startswith("#"):
+            continue
+        if not line.startswith(key + "="):
+            continue
+        val = line.split("=", 1)[1].strip()
+        if (val.startswith('"') and val.endswith('"')) or (val.startswith("'") and val.endswith("'")):
+            val = val[1:-1]
+        return val.strip()
+    return None
+
+
+def _setting(env_path: Path, *keys: str) -> Optional[str]:
+    """First of `keys` set in the process environment, then in .env.local (an exported value wins)."""
+    for key in keys:
+        val = os.environ.get(key)
+        if val:
+            return val
+    for key in keys:
+        val = read_env_value(env_path, key)
+        if val:
+            return val
+    return None
+
+
+def load_supabase_config(repo_root: Path = REPO_ROOT) -> SupabaseConfig:
+    env_path = repo_root / ".env.local"
+    supabase_url = _setting(env_path, "VITE_SUPABASE_URL", "SUPABASE_URL")
+    anon_key = _setting(env_path, "VITE_SUPABASE_ANON_KEY", "SUPABASE_ANON_KEY")
+
+    if not supabase_url or not anon_key:
+        raise RuntimeError(f"Missing VITE_SUPABASE_URL/VITE_SUPABASE_ANON_KEY in the environment or {env_path}")
+
+    service_role_key = _setting(env_path, "SUPABASE_SERVICE_ROLE_KEY")
+    return SupabaseConfig(url=supabase_url.rstrip("/"), anon_key=anon_key, service_role_key=service_role_key)
+
+
+def supabase_headers(cfg: SupabaseConfig) -> Dict[str, str]:
+    return {
+        "apikey": cfg.anon_key,
+        "Authorization": f"Bearer {cfg.anon_key}",
+    }
+
+
+def build_session(pool_size: int = LIMIT_MAX) -> requests.Session:
+    """Keep-alive session whose connection pool can serve `pool_size` concurrent requests."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def retry_after_seconds(resp: requests.Response) -> Optional[float]:
+    """The response's Retry-After (delta-seconds or HTTP-date) in seconds, capped at MAX_RETRY_AFTER."""
+    value = resp.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER)
+
+
+class AdaptiveLimiter:
+    """AIMD cap on concurrent requests, tuned by the latencies and statuses the requests see.
+
+    Each clean response raises the limit by 1/limit (about +1 per window of requests); a
+    throttling status or a dropped connection halves it, and a response LATENCY_TOLERANCE times
+    slower than the baseline (a moving average of recent latencies) cuts it by a quarter.
+    Decreases are at most one per baseline round trip, since the other requests in flight saw
+    the same congestion. A Retry-After holds back every new request until it has passed.
+    """
+
+    def __init__(self, initial: int = LIMIT_INITIAL, max_limit: int = LIMIT_MAX, min_limit: int = 1):
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.limit = float(min(max(initial, min_limit), self.max_limit))
+        self.in_flight = 0
+        self.baseline: Optional[float] = None
+        self.samples = 0
+        self.paused_until = 0.0
+        self.throttled = 0
+        self.decreases = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self) -> None:
+        with self._cond:
+            while True:
+                paused = self.paused_until - time.monotonic()
+                if paused > 0:
+                    self._cond.wait(paused)
+                elif self.in_flight < int(self.limit):
+                    break
+                else:
+                    self._cond.wait()
+            self.in_flight += 1
+
+    def release(
+        self,
+        latency: Optional[float] = None,
+        status: Optional[int] = None,
+        retry_after: Optional[float] = None,
+        failed: bool = False,
+    ) -> None:
+        """Return a slot. `failed` marks a timeout or dropped connection; no latency and no status
+        (the call was interrupted locally) leaves the limit alone."""
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            if failed or status in THROTTLE_STATUSES:
+                self.throttled += 1
+                self._decrease(now, 0.5)
+            elif latency is not None:
+                baseline = latency if self.baseline is None else self.baseline
+                self.baseline = baseline + (latency - baseline) * 0.05
+                self.samples += 1
+                if self.samples > LATENCY_WARMUP and latency > baseline * LATENCY_TOLERANCE:
+                    self._decrease(now, 0.75)
+                else:
+                    self.limit = min(self.limit + 1 / self.limit, float(self.max_limit))
+            self._cond.notify_all()
+
+    def set_max(self, max_limit: int) -> None:
+        with self._cond:
+            self.max_limit = max(max_limit, self.min_limit)
+            self.limit = min(self.limit, float(self.max_limit))
+            self._cond.notify_all()
+
+    def _decrease(self, now: float, factor: float) -> None:
+        if now - self._last_decrease < (self.baseline or 0.0):
+            return
+        self._last_decrease = now
+        self.decreases += 1
+        self.limit = max(self.limit * factor, float(self.min_limit))
+
+
+_limiters: Dict[Tuple[str, str], AdaptiveLimiter] = {}
+_limiters_lock = threading.Lock()
+_limit_max = LIMIT_MAX
+
+
+def limiter_for(uri: str) -> AdaptiveLimiter:
+    """The process-wide limiter of `uri`'s host and service (rest, functions, storage, ...)."""
+    parts = urlsplit(uri)
+    key = (parts.netloc, parts.path.lstrip("/").split("/", 1)[0])
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = AdaptiveLimiter(min(LIMIT_INITIAL, _limit_max), _limit_max)
+        return limiter
+
+
+def configure_limiters(max_concurrency: int) -> None:
+    """Cap every limiter, current and future, at `max_concurrency` requests in flight."""
+    global _limit_max
+    with _limiters_lock:
+        _limit_max = max(max_concurrency, 1)
+        for limiter in _limiters.values():
+            limiter.set_max(_limit_max)
+
+
+def limiter_stats() -> Dict[str, AdaptiveLimiter]:
+    """Limiters created so far, keyed '<service>@<host>'."""
+    with _limiters_lock:
+        return {f"{service}@{host}": limiter for (host, service), limiter in _limiters.items()}
+
+
+def send_with_retry(
+    session: requests.Session,
+    method: str,
+    uri: str,
+    headers: Mapping[str, str],
+    body: Optional[bytes] = None,
+    attempts: int = DEFAULT_ATTEMPTS,
+    base_delay: float = 0.5,
+    timeout: float = DEFAULT_TIMEOUT,
+    idempotent: bool = True,
+    raise_for_status: bool = True,
+    limiter: Optional[AdaptiveLimiter] = None,
+    **kwargs: object,
+) -> requests.Response:
+    """One HTTP request; transient failures back off exponentially (with jitter) and are retried.
+
+    An idempotent request retries connection errors, timeouts and 408/429/5xx. Anything else (a
+    plain insert, an Edge Function call) retries only what never reached the server: connect
+    timeouts and 429/503. A Retry-After stretches the backoff to at least that long. Each attempt
+    holds a slot of `limiter` (default: limiter_for(uri)) until its response headers arrive.
+    The last response is returned (or raised, with `raise_for_status`).
+    """
+    statuses = RETRY_STATUSES if idempotent else UNPROCESSED_STATUSES
+    retryable = (requests.ConnectionError, requests.Timeout) if idempotent else (requests.ConnectTimeout,)
+    limiter = limiter or limiter_for(uri)
+    for attempt in range(attempts):
+        last = attempt == attempts - 1
+        retry_after = None
+        limiter.acquire()
+        started = time.monotonic()
+        try:
+            resp = session.request(method, uri, headers=headers, data=body, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            limiter.release(failed=True)
+            if last or not isinstance(e, retryable):
+                raise
+        except BaseException:
+            limiter.release()
+            raise
+        else:
+            retry_after = retry_after_seconds(resp) if resp.status_code in THROTTLE_STATUSES else None
+            limiter.release(time.monotonic() - started, resp.status_code, retry_after)
+            if last or resp.status_code not in statuses:
+                if raise_for_status:
+                    resp.raise_for_status()
+                return resp
+            resp.close()
+        time.sleep(max(base_delay * 2**attempt * random.uniform(0.5, 1.5), retry_after or 0.0))
+    raise AssertionError("unreachable")
+
+
+def iter_json_array(
+    stream: BinaryIO,
+    columns: Optional[Sequence[str]] = None,
+    chunk_size: int = JSON_STREAM_CHUNK,
+) -> Iterator[object]:
+    """Yield the elements of a top-level JSON array read incrementally from `stream`.
+
+    Only the undecoded tail and the element being decoded are held, so memory follows the widest
+    row rather than the response. With `columns`, each object is cut down to those keys as soon
+    as it is decoded. An element split across reads is retried once the buffer has doubled, so
+    a single huge row still decodes in linear time.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    pos = 0
+    eof = False
+
+    def fill(min_chars: int) -> bool:
+        nonlocal buf, pos, eof
+        buf = buf[pos:]
+        pos = 0
+        target = len(buf) + min_chars
+        while not eof and len(buf) < target:
+            block = stream.read(max(chunk_size, min_chars))
+            eof = not block
+            buf += utf8.decode(block or b"", final=eof)
+        return len(buf) > 0
+
+    def skip(chars: str) -> None:
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in chars:
+                pos += 1
+            if pos < len(buf) or not fill(1):
+                return
+
+    skip(_JSON_SPACE)
+    if buf[pos : pos + 1] != "[":
+        raise ValueError(f"Expected a JSON array, got {buf[pos : pos + 20]!r}")
+    pos += 1
+    skip(_JSON_SPACE)
+    if buf[pos : pos + 1] == "]":
+        return
+    while True:
+        # pos is at the start of an element; exactly one separator ends each one.
+        if pos >= len(buf):
+            raise ValueError("Truncated JSON array")
+        if buf[pos] in ",]":
+            raise json.JSONDecodeError("Expected a value", buf, pos)
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                after = end
+                while after < len(buf) and buf[after] in _JSON_SPACE:
+                    after += 1
+                if after < len(buf) and buf[after] in ",]":
+                    break
+                # Nothing after the element yet, or a number cut by the read boundary (`1.` + `5e3`).
+                if eof or (after < len(buf) and not _NUMBER_TAIL_RE.fullmatch(buf, end)):
+                    raise json.JSONDecodeError("Expected ',' or ']'", buf, after)
+            fill(max(len(buf) - pos, chunk_size))
+        pos = after + 1
+        if columns is not None and isinstance(value, dict):
+            value = {col: value.get(col) for col in columns}
+        yield value
+        if buf[after] == "]":
+            return
+        skip(_JSON_SPACE)
+
+
+@dataclass
+class RowFailure:
+    index: int  # position of the row in the iterable given to bulk_upsert
+    row: dict
+    error: str
+
+
+@dataclass
+class BulkResult:
+    written: int = 0
+    requests: int = 0
+    failures: List[RowFailure] = field(default_factory=list)
+    rows: List[dict] = field(default_factory=list)  # server representation, with returning=True
+
+    @property
+    def ok(self) -> bool:
+        return not self.failures
+
+
+# (input index, row, its JSON encoding)
+_BulkRow = Tuple[int, dict, bytes]
+
+
+def _row_level_error(resp: requests.Response) -> bool:
+    if resp.status_code in ROW_LEVEL_STATUSES:
+        return True
+    try:
+        payload = resp.json()
+    except ValueError:
+        return False
+    code = payload.get("code") if isinstance(payload, dict) else None
+    return isinstance(code, str) and code.startswith(ROW_LEVEL_SQLSTATE_CLASSES)
+
+
+def _upsert_idempotent(rows: Iterable[dict], on_conflict: Optional[str]) -> bool:
+    """Whether repeating an upsert of `rows` is harmless: only when each row carries the values of
+    its `on_conflict` key. Without it the server's conflict target is unknown here, and a row that
+    leaves it to a column default would be inserted again."""
+    if not on_conflict:
+        return False
+    columns = [col.strip() for col in on_conflict.split(",")]
+    return all(row.get(col) is not None for row in rows for col in columns)
+
+
+def _query(filters: Filters) -> List[str]:
+    if isinstance(filters, Mapping):
+        return [f"{key}={quote(str(val), safe=',.()*:')}" for key, val in filters.items()]
+    return list(filters)
+
+
+class SupabaseClient:
+    """PostgREST and Edge Function helpers over one pooled session.
+
+    Filters are either a mapping of PostgREST operators ({"id": "eq.42"}, values URL-encoded here)
+    or already-encoded `key=value` strings, the form the comparer builds its keyset filters in.
+    """
+
+    def __init__(
+        self,
+        cfg: SupabaseConfig,
+        session: Optional[requests.Session] = None,
+        pool_size: int = LIMIT_MAX,
+        timeout: float = DEFAULT_TIMEOUT,
+        attempts: int = DEFAULT_ATTEMPTS,
+    ):
+        self.cfg = cfg
+        self.session = session or build_session(pool_size)
+        self.timeout = timeout
+        self.attempts = attempts
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        query: Sequence[str] = (),
+        json_body: object = None,
+        headers: Optional[Mapping[str, str]] = None,
+        idempotent: Optional[bool] = None,
+        raise_for_status: bool = True,
+        body: Optional[bytes] = None,
+        stream: bool = False,
+    ) -> requests.Response:
+        """`method` on `<url>/<path>?<query>`; idempotent defaults to True for everything but POST.
+
+        The payload is `json_body` serialized here, or `body` when it is already encoded JSON.
+        With `stream` the response body is left unread on the socket for the caller.
+        """
+        uri = f"{self.cfg.url}/{path.lstrip('/')}" + ("?" + "&".join(query) if query else "")
+        all_headers = {**supabase_headers(self.cfg), **(headers or {})}
+        if body is None and json_body is not None:
+            body = json.dumps(json_body, ensure_ascii=False).encode("utf-8")
+        if body is not None:
+            all_headers.setdefault("Content-Type", "application/json")
+        return send_with_retry(
+            self.session,
+            method,
+            uri,
+            all_headers,
+            body,
+            attempts=self.attempts,
+            timeout=self.timeout,
+            idempotent=method.upper() != "POST" if idempotent is None else idempotent,
+            raise_for_status=raise_for_status,
+            stream=stream,
+        )
+
+    def select(
+        self,
+        table: str,
+        columns: str = "*",
+        filters: Filters = (),
+        order: Optional[str] = None,
+        limit: Optional[int] = None,
+        offset: Optional[int] = None,
+    ) -> List[dict]:
+        query = [f"select={columns}", *_query(filters)]
+        if order:
+            query.append(f"order={order}")
+        if limit is not None:
+            query.append(f"limit={limit}")
+        if offset is not None:
+            query.append(f"offset={offset}")
+        return self.request("GET", f"rest/v1/{table}", query).json()
+
+    def select_stream(
+        self,
+        table: str,
+        columns: str = "*",
+        filters: Filters = (),
+        order: Optional[str] = None,
+        limit: Optional[int] = None,
+        offset: Optional[int] = None,
+        keep: Optional[Sequence[str]] = None,
+    ) -> Iterator[dict]:
+        """select() yielding rows as they are decoded off the socket (see iter_json_array).
+
+        `columns` is the server-side projection; `keep` trims each decoded row to those keys
+        before it is yielded.
+        """
+        query = [f"select={columns}", *_query(filters)]
+        if order:
+            query.append(f"order={order}")
+        if limit is not None:
+            query.append(f"limit={limit}")
+        if offset is not None:
+            query.append(f"offset={offset}")
+        with self.request("GET", f"rest/v1/{table}", query, stream=True) as resp:
+            resp.raw.decode_content = True
+            yield from iter_json_array(resp.raw, keep)
+
+    def insert(self, table: str, rows: Union[dict, Sequence[dict]], returning: bool = False) -> List[dict]:
+        """POST one row or a multi-row batch; [] unless `returning`. Not retried once it reached the server."""
+        return self._write("POST", table, rows, [], returning, idempotent=False)
+
+    def upsert(
+        self,
+        table: str,
+        rows: Union[dict, Sequence[dict]],
+        on_conflict: Optional[str] = None,
+        returning: bool = False,
+        ignore_duplicates: bool = False,
+    ) -> List[dict]:
+        """INSERT ... ON CONFLICT: merge (or, with ignore_duplicates, keep) rows colliding on `on_conflict`.
+
+        Retried like an idempotent request only when every row carries its `on_conflict` values.
+        """
+        query = [f"on_conflict={on_conflict}"] if on_conflict else []
+        resolution = "resolution=ignore-duplicates" if ignore_duplicates else "resolution=merge-duplicates"
+        idempotent = _upsert_idempotent([rows] if isinstance(rows, dict) else rows, on_conflict)
+        return self._write("POST", table, rows, query, returning, idempotent=idempotent, prefer=resolution)
+
+    def bulk_upsert(
+        self,
+        table: str,
+        rows: Iterable[dict],
+        on_conflict: Optional[str] = None,
+        ignore_duplicates: bool = False,
+        returning: bool = False,
+        chunk_rows: int = BULK_CHUNK_ROWS,
+        chunk_bytes: int = BULK_CHUNK_BYTES,
+        workers: Optional[int] = None,
+        default: Callable[[object], object] = str,
+    ) -> BulkResult:
+        """Upsert an iterable of rows as concurrent multi-row POSTs; failures are reported per row.
+
+        Rows are grouped by key set (PostgREST takes a batch's columns from its first object, so a
+        mixed batch would write NULL over omitted columns) and cut into chunks of at most
+        `chunk_rows` rows and `chunk_bytes` of JSON. Up to `workers` chunks are in flight (default:
+        as many as the REST limiter may ever allow, leaving the actual concurrency to it). A chunk
+        is retried as idempotent only when its rows all carry their `on_conflict` values.
+
+        A chunk rejected for its rows' content (409, 422 or a SQLSTATE 22/23 error) is split in
+        halves until the offending rows are isolated, stopping early when both halves fail with
+        the same error. Any other failure, after send_with_retry, fails the whole chunk. `default`
+        encodes values json cannot (dates, Decimals).
+        """
+        workers = max(workers or limiter_for(f"{self.cfg.url}/rest/v1/{table}").max_limit, 1)
+        query = [f"on_conflict={on_conflict}"] if on_conflict else []
+        resolution = "resolution=ignore-duplicates" if ignore_duplicates else "resolution=merge-duplicates"
+        prefer = f"{resolution},{'return=representation' if returning else 'return=minimal'}"
+        result = BulkResult()
+        open_chunks: Dict[Tuple[str, ...], Tuple[List[_BulkRow], List[int]]] = {}
+        pending: Dict[Future, int] = {}
+
+        def settle(done: Iterable[Future]) -> None:
+            for future in done:
+                pending.pop(future)
+                written, requests_made, failures, returned = future.result()
+                result.written += written
+                result.requests += requests_made
+                result.failures.extend(failures)
+                result.rows.extend(returned)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+
+            def submit(chunk: List[_BulkRow]) -> None:
+                if len(pending) >= 2 * workers:  # bound the chunks held in memory
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    settle(done)
+                idempotent = _upsert_idempotent((row for _, row, _ in chunk), on_conflict)
+                pending[pool.submit(self._upsert_chunk, table, query, prefer, chunk, idempotent)] = len(chunk)
+
+            for index, row in enumerate(rows):
+                encoded = json.dumps(row, ensure_ascii=False, default=default).encode("utf-8")
+                key = tuple(sorted(row))
+                chunk, size = open_chunks.setdefault(key, ([], [0]))
+                if chunk and (len(chunk) >= chunk_rows or size[0] + len(encoded) + 1 > chunk_bytes):
+                    submit(chunk)
+                    chunk, size = open_chunks[key] = ([], [0])
+                chunk.append((index, row, encoded))
+                size[0] += len(encoded) + 1
+            for chunk, _ in open_chunks.values():
+                if chunk:
+                    submit(chunk)
+            settle(list(pending))
+
+        result.failures.sort(key=lambda failure: failure.index)
+        return result
+
+    def _post_chunk(
+        self, table: str, query: List[str], prefer: str, chunk: List[_BulkRow], idempotent: bool
+    ) -> Tuple[Optional[requests.Response], str, bool]:
+        """(response, "", False) when the chunk was written, else (None, error, rowLevel)."""
+        body = b"[" + b",".join(encoded for _, _, encoded in chunk) + b"]"
+        try:
+            resp = self.request(
+                "POST", f"rest/v1/{table}", query, headers={"Prefer": prefer}, idempotent=idempotent, body=body
+            )
+        except requests.HTTPError as e:
+            return None, f"HTTP {e.response.status_code}: {e.response.text[:500]}", _row_level_error(e.response)
+        except requests.RequestException as e:
+            return None, f"{type(e).__name__}: {e}", False
+        return resp, "", False
+
+    def _upsert_chunk(
+        self,
+        table: str,
+        query: List[str],
+        prefer: str,
+        chunk: List[_BulkRow],
+        idempotent: bool,
+        sent: Optional[Tuple[Optional[requests.Response], str, bool]] = None,
+    ) -> Tuple[int, int, List[RowFailure], List[dict]]:
+        """(rowsWritten, requestsMade, failures, returnedRows) for one chunk, bisecting row-level
+        rejections. `sent` is the outcome of a POST of this chunk the caller already made."""
+        requests_made = 0 if sent else 1
+        resp, error, row_level = sent or self._post_chunk(table, query, prefer, chunk, idempotent)
+        if resp is not None:
+            returned = resp.json() if "return=representation" in prefer and resp.content else []
+            return len(chunk), requests_made, [], returned
+        if len(chunk) > 1 and row_level:
+            mid = len(chunk) // 2
+            halves = (chunk[:mid], chunk[mid:])
+            outcomes = [self._post_chunk(table, query, prefer, half, idempotent) for half in halves]
+            requests_made += 2
+            if all(r is None for r, _, _ in outcomes) and outcomes[0][1] == outcomes[1][1]:
+                error = outcomes[0][1]  # not about particular rows after all
+            else:
+                parts = [
+                    self._upsert_chunk(table, query, prefer, half, idempotent, outcome)
+                    for half, outcome in zip(halves, outcomes)
+                ]
+                return (
+                    sum(p[0] for p in parts),
+                    requests_made + sum(p[1] for p in parts),
+                    [f for p in parts for f in p[2]],
+                    [r for p in parts for r in p[3]],
+                )
+        return 0, requests_made, [RowFailure(index, row, error) for index, row, _ in chunk], []
+
+    def update(self, table: str, values: dict, filters: Filters, returning: bool = False) -> List[dict]:
+        """PATCH the rows matching `filters`; refuses to run without a filter (it would hit every row)."""
+        query = _query(filters)
+        if not query:
+            raise ValueError("update() needs at least one filter")
+        return self._write("PATCH", table, values, query, returning, idempotent=True)
+
+    def rpc(self, function: str, args: Optional[dict] = None, idempotent: bool = False) -> object:
+        """Call a Postgres function; pass idempotent=True for read-only ones so 5xx are retried."""
+        resp = self.request("POST", f"rest/v1/rpc/{function}", json_body=args or {}, idempotent=idempotent)
+        return resp.json() if resp.content else None
+
+    def function(
+        self,
+        path: str,
+        method: str = "POST",
+        json_body: object = None,
+        headers: Optional[Mapping[str, str]] = None,
+    ) -> requests.Response:
+        """Call an Edge Function (`functions/v1/<path>`); the response is returned whatever its status."""
+        uri_path = f"functions/v1/{path.lstrip('/')}"
+        return self.request(method, uri_path, json_body=json_body, headers=headers, raise_for_status=False)
+
+    def _write(
+        self,
+        method: str,
+        table: str,
+        rows: object,
+        query: List[str],
+        returning: bool,
+        idempotent: bool,
+        prefer: Optional[str] = None,
+    ) -> List[dict]:
+        prefs = [p for p in (prefer, "return=representation" if returning else "return=minimal") if p]
+        resp = self.request(
+            method,
+            f"rest/v1/{table}",
+            query,
+            json_body=rows,
+            headers={"Prefer": ",".join(prefs)},
+            idempotent=idempotent,
+        )
+        return resp.json() if returning and resp.content else []
+
+
+class ReferenceCache:
+    """Disk cache for slowly-changing lookup tables (canonical_*, ota_*_mappings, country_iso_codes, ...).
+
+    Entries are keyed by table, columns, filters and order. Within `ttl` of its last check an
+    entry is served without any request; after that one `limit=1` probe of the row count and
+    max(`version_column`) decides between reusing it and refetching the rows. Tables without
+    the column are versioned by row count alone, so their in-place edits only show after a
+    refetch forced by invalidate(). The file is capped at `max_bytes`, evicting the least
+    recently used entries.
+
+        cache = ReferenceCache()
+        amenities = cache.select(client, "ota_amenity_mappings", "canonical_id,ota,ota_id", {"ota": "eq.airbnb"})
+    """
+
+    def __init__(
+        self,
+        path: Path = DEFAULT_REFERENCE_CACHE_PATH,
+        ttl: float = REFERENCE_TTL,
+        max_bytes: int = REFERENCE_MAX_BYTES,
+    ):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.revalidated = 0
+        self.fetched = 0
+        self._unversioned: Set[Tuple[str, str]] = set()  # (table, column) the server has no column for
+        self._lock = threading.Lock()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(path), timeout=60, check_same_thread=False, isolation_level=None)
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != REFERENCE_CACHE_VERSION:
+            self.conn.executescript("DROP TABLE IF EXISTS entries;")
+            self.conn.execute(f"PRAGMA user_version = {REFERENCE_CACHE_VERSION}")
+        self.conn.executescript(REFERENCE_CACHE_SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def select(
+        self,
+        client: SupabaseClient,
+        table: str,
+        columns: str = "*",
+        filters: Filters = (),
+        order: Optional[str] = None,
+        version_column: str = "updated_at",
+    ) -> List[dict]:
+        """All rows of `table` matching `filters`, from the cache when it is still current.
+
+        Tables larger than REFERENCE_PAGE_ROWS are read in pages; pass an `order` on a unique
+        column for those so the pages cannot overlap.
+        """
+        query = [f"select={columns}", *_query(filters)] + ([f"order={order}"] if order else [])
+        identity = "\n".join((client.cfg.url, supabase_headers(client.cfg)["Authorization"], table, *query))
+        key = hashlib.sha256(identity.encode("utf-8")).hexdigest()
+        now = time.time()
+        with self._lock:
+            entry = self.conn.execute(
+                "SELECT version, checked_at, body FROM entries WHERE cache_key = ?", (key,)
+            ).fetchone()
+        if entry and now - entry[1] < self.ttl:
+            self._touch(key, now)
+            with self._lock:
+                self.hits += 1
+            return json.loads(zlib.decompress(entry[2]))
+
+        count, version = self._version(client, table, _query(filters), version_column)
+        if entry and entry[0] == version:
+            self._touch(key, now, checked=True)
+            with self._lock:
+                self.revalidated += 1
+            return json.loads(zlib.decompress(entry[2]))
+
+        rows: List[dict] = []
+        while True:
+            page = client.request(
+                "GET", f"rest/v1/{table}", [*query, f"limit={REFERENCE_PAGE_ROWS}", f"offset={len(rows)}"]
+            ).json()
+            rows.extend(page)
+            if len(page) < REFERENCE_PAGE_ROWS or len(rows) >= count:
+                break
+        body = zlib.compress(json.dumps(rows, ensure_ascii=False).encode("utf-8"))
+        with self._lock:
+            self.fetched += 1
+            self.conn.execute(
+                "INSERT OR REPLACE INTO entries (cache_key, table_name, version, checked_at, used_at, size, body) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, table, version, now, now, len(body), body),
+            )
+            self._evict(keep=key)
+        return rows
+
+    def invalidate(self, table: Optional[str] = None) -> None:
+        """Drop the entries of `table` (every entry when None); the next select refetches."""
+        with self._lock:
+            if table is None:
+                self.conn.execute("DELETE FROM entries")
+            else:
+                self.conn.execute("DELETE FROM entries WHERE table_name = ?", (table,))
+
+    def _version(self, client: SupabaseClient, table: str, filters: List[str], column: str) -> Tuple[int, str]:
+        """(rowCount, '<rowCount>:<max(column)>') from one row of `table` plus its exact count."""
+        probe = [f"select={column}", *filters, f"order={column}.desc.nullslast", "limit=1"]
+        if (table, column) in self._unversioned:
+            probe = ["select=*", *filters, "limit=1"]
+        try:
+            resp = client.request("GET", f"rest/v1/{table}", probe, headers={"Prefer": "count=exact"})
+        except requests.HTTPError as e:
+            if '"42703"' not in e.response.text or (table, column) in self._unversioned:
+                raise
+            self._unversioned.add((table, column))  # undefined_column: fall back to the row count
+            return self._version(client, table, filters, column)
+        count = int(resp.headers.get("Content-Range", "*/0").rsplit("/", 1)[1])
+        rows = resp.json()
+        latest = rows[0].get(column) if rows and (table, column) not in self._unversioned else None
+        return count, f"{count}:{latest}"
+
+    def _touch(self, key: str, now: float, checked: bool = False) -> None:
+        with self._lock:
+            if checked:
+                self.conn.execute("UPDATE entries SET used_at = ?, checked_at = ? WHERE cache_key = ?", (now, now, key))
+            else:
+                self.conn.execute("UPDATE entries SET used_at = ? WHERE cache_key = ?", (now, key))
+
+    def _evict(self, keep: str) -> None:
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.conn.execute(
+            "SELECT cache_key, size FROM entries WHERE cache_key != ? ORDER BY used_at", (keep,)
+        ).fetchall():
+            self.conn.execute("DELETE FROM entries WHERE cache_key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
@@ -0,0 +1,873 @@
+"""Tests for compare-stays-xlsx-vs-supabase.py (python -m pytest test_compare_stays_xlsx_vs_supabase.py)."""
+
+import csv
+import hashlib
+import importlib.util
+import io
+import json
+import math
+import os
+import random
+import string
+import sys
+from datetime import date, timedelta
+from pathlib import Path
+from typing import List
+from urllib.parse import unquote
+
+import pytest
+from openpyxl import Workbook
+
+from supabase_client import ReferenceCache
+from test_supabase_client import FakeTables
+
+_spec = importlib.util.spec_from_file_location(
+    "compare_stays_xlsx_vs_supabase", Path(__file__).resolve().parent / "compare-stays-xlsx-vs-supabase.py"
+)
+compare = importlib.util.module_from_spec(_spec)
+sys.modules[_spec.name] = compare  # dataclasses look their module up while the file executes
+_spec.loader.exec_module(compare)
+
+
+def _split_top(inner: str) -> List[str]:
+    parts, depth, start = [], 0, 0
+    for i, ch in enumerate(inner):
+        depth += {"(": 1, ")": -1}.get(ch, 0)
+        if ch == "," and depth == 0:
+            parts.append(inner[start:i])
+            start = i + 1
+    return parts + [inner[start:]]
+
+
+def _value(encoded: str) -> str:
+    value = unquote(encoded)
+    if value.startswith('"'):
+        value = value[1:-1].replace('\\"', '"').replace("\\\\", "\\")
+    return value
+
+
+def _condition(row: dict, column: str, op: str, encoded: str) -> bool:
+    if op == "not" and encoded == "is.null":
+        return row.get(column) is not None
+    if row.get(column) is None:
+        return False
+    if op == "in":
+        return str(row[column]) in encoded[1:-1].split(",")
+    value, cell = _value(encoded), str(row[column])
+    return {"eq": cell == value, "gt": cell > value, "gte": cell >= value, "lt": cell < value, "lte": cell <= value}[op]
+
+
+def _tree(row: dict, expr: str) -> bool:
+    if expr.startswith(("or(", "and(")):
+        op, inner = expr.split("(", 1)
+        results = [_tree(row, part) for part in _split_top(inner[:-1])]
+        return any(results) if op == "or" else all(results)
+    column, op, encoded = expr.split(".", 2)
+    return _condition(row, column, op, encoded)
+
+
+def postgrest_filter(row: dict, query_filter: str) -> bool:
+    """Evaluate one `key=value` filter of the forms the comparer sends (col=op.val, col=in.(...), or=(...))."""
+    key, expr = query_filter.split("=", 1)
+    if key in ("or", "and"):
+        return _tree(row, key + expr)
+    op, encoded = expr.split(".", 1)
+    return _condition(row, key, op, encoded)
+
+
+def csv_page(columns: List[str], rows: List[dict]) -> "compare.CsvPage":
+    """`rows` as PostgREST's text/csv writes them (NULL as an empty cell), read back like _fetch_page."""
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(columns)
+    writer.writerows([["" if row[col] is None else row[col] for col in columns] for row in rows])
+    reader = csv.reader(io.StringIO(out.getvalue(), newline=""))
+    return compare.CsvPage(next(reader), list(reader))
+
+
+class FakeReservations:
+    """compare._fetch_page over an in-memory table, honouring select, order, filters, limit, offset and transfer."""
+
+    def __init__(self, rows: List[dict]):
+        self.rows = rows
+        self.pages: List[List[dict]] = []
+
+    def __call__(self, session, cfg, table, select, order, filters, page_size, offset=None, transfer="json"):
+        keys = [part.split(".")[0] for part in order.split(",")]
+        rows = sorted(
+            (row for row in self.rows if all(postgrest_filter(row, flt) for flt in filters)),
+            key=lambda row: tuple((row[k] is None, str(row[k])) for k in keys),
+        )
+        page = [{col: row.get(col) for col in select.split(",")} for row in rows[offset or 0 :][:page_size]]
+        if transfer == "csv":
+            page = csv_page(select.split(","), page)
+        self.pages.append(page)
+        return page
+
+
+def write_workbook(path: Path, codes, header: str = "Reserva", extra=None) -> Path:
+    """One sheet: Imóvel, `header` (the codes), then any `extra` columns ({header: cells})."""
+    extra = extra or {}
+    wb = Workbook()
+    ws = wb.active
+    ws.append(["Imóvel", header, *extra])
+    for i, code in enumerate(codes):
+        ws.append([f"P{i}", code, *(cells[i] for cells in extra.values())])
+    wb.save(path)
+    return path
+
+
+@pytest.fixture
+def reference_cache(tmp_path):
+    cache = ReferenceCache(tmp_path / "reference.sqlite", ttl=3600)
+    yield cache
+    cache.close()
+
+
+def test_fetch_stays_organizations_reads_enabled_tenants_through_the_cache(reference_cache, monkeypatch):
+    tables = FakeTables(
+        staysnet_config=[
+            {"id": 1, "organization_id": "org-b", "enabled": True, "updated_at": "2026-01-01"},
+            {"id": 2, "organization_id": "org-c", "enabled": False, "updated_at": "2026-01-01"},
+        ],
+        organizations=[
+            {"id": "org-a", "slug": "a", "name": "A", "updated_at": "2026-01-01"},
+            {"id": "org-b", "slug": "b", "name": "B", "updated_at": "2026-01-01"},
+            {"id": "org-c", "slug": "c", "name": "C", "updated_at": "2026-01-01"},
+        ],
+    )
+    monkeypatch.setattr(compare.SupabaseClient, "request", lambda self, *a, **kw: tables.request(*a, **kw))
+    cfg = compare.SupabaseConfig("https://project.supabase.co", "service")
+
+    assert compare.fetch_stays_organizations(cfg, reference_cache) == [compare.Organization("org-b", "b", "B")]
+    requests_made = len(tables.calls)
+    assert compare.fetch_stays_organizations(cfg, reference_cache) == [compare.Organization("org-b", "b", "B")]
+    assert len(tables.calls) == requests_made
+
+    tables.tables["staysnet_config"][1].update(organization_id="global", enabled=True, updated_at="2026-02-01")
+    reference_cache.ttl = 0
+    assert [org.id for org in compare.fetch_stays_organizations(cfg, reference_cache)] == ["org-a", "org-b", "org-c"]
+
+
+def test_external_diff_suggests_the_same_matches(tmp_path):
+    period = compare.AuditPeriod(
+        write_workbook(tmp_path / "2025-12-01_2025-12-31.xlsx", ["EU26J", "DQ52J", "AB0CD", "HMX4ZQ"]),
+        "2025-12-01",
+        "2025-12-31",
+    )
+    rows = [
+        compare.ReservationRow("r1", "2025-12-02", "EU26J"),
+        compare.ReservationRow("r2", "2025-12-03", "ABOCD"),
+        compare.ReservationRow("r3", "2025-12-04", "HMX4Z"),
+        compare.ReservationRow("r4", "2025-12-05", "QQ99Z"),
+    ]
+    in_memory = compare.reconcile_period(period, rows)
+    external = compare.reconcile_periods_external([period], rows, 1 << 20)[0]
+    assert in_memory.suggestions
+    assert external.suggestions == in_memory.suggestions
+
+
+def random_code(rng: random.Random) -> str:
+    return "".join(rng.choice(string.ascii_uppercase + string.digits) for _ in range(rng.randint(4, 7)))
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_external_diff_matches_the_in_memory_diff(tmp_path, seed):
+    """Same synthetic export and rows through reconcile_period and the --memory-cap path."""
+    rng = random.Random(seed)
+    shared = {random_code(rng) for _ in range(1500)}
+    xlsx_only = {random_code(rng) for _ in range(150)} - shared
+    xlsx_cells = [*shared, *xlsx_only, *rng.sample(sorted(shared), 100)]  # repeated rows
+    xlsx_cells += [None, "", "nan", "x", "TOO-LONG-CODE", " eu26j "]
+    # One near-miss per confusable, truncated and edit-distance pair, so there are suggestions.
+    xlsx_cells += ["OK0OK9", "TRUNCA7ED", "EDITED1"]
+    rng.shuffle(xlsx_cells)
+
+    supabase_codes = [*shared, *({random_code(rng) for _ in range(150)} - shared), "OKO0K9", "TRUNCA", "EDITEDX"]
+    days = [f"2025-{month:02d}-{day:02d}" for month in (11, 12) for day in range(1, 29)] + ["2026-01-02"]
+    rows = []
+    for i, code in enumerate(supabase_codes * 2):  # every code twice, often on other days
+        rows.append(compare.ReservationRow(f"r{i:05d}", rng.choice(days), code))
+    rows += [compare.ReservationRow(f"n{i:05d}", rng.choice(days), None) for i in range(20)]
+    rows.sort(key=lambda row: (row.check_in, row.id))
+
+    workbook = write_workbook(tmp_path / "2025-12-01_2025-12-31.xlsx", xlsx_cells)
+    periods = [
+        compare.AuditPeriod(workbook, "2025-12-01", "2025-12-31"),
+        compare.AuditPeriod(workbook, "2025-11-15", "2025-12-15"),
+        compare.AuditPeriod(workbook, "2026-02-01", "2026-02-28"),
+    ]
+    # The smallest budget ExternalSorter allows: many spilled runs and multi-pass merges.
+    external = compare.reconcile_periods_external(periods, rows, 2 * 8192)
+    for period, partition, ext in zip(periods, compare.partition_rows_by_period(rows, periods), external):
+        in_memory = compare.reconcile_period(period, partition)
+        assert (ext.xlsx_codes, ext.supabase_codes) == (in_memory.xlsx_codes, in_memory.supabase_codes)
+        assert ext.only_in_xlsx == in_memory.only_in_xlsx
+        assert ext.only_in_supabase == in_memory.only_in_supabase
+        assert ext.suggestions == in_memory.suggestions
+    assert external[0].suggestions and external[0].only_in_supabase and external[0].only_in_xlsx
+
+
+def test_external_id_walk_breaks_ties_on_id(monkeypatch):
+    # 2500 rows over 40 external ids: every page boundary falls inside a run of duplicates.
+    rows = [
+        {"id": f"{i:06d}", "check_in": "2025-12-10", "external_id": f"{i % 40:024x}"} for i in range(2500)
+    ] + [{"id": f"n{i}", "check_in": "2025-12-10", "external_id": None} for i in range(30)]
+    fake = FakeReservations(rows)
+    monkeypatch.setattr(compare, "_fetch_page", fake)
+    cfg = compare.SupabaseConfig("https://project.supabase.co", "anon")
+
+    expected = sorted(f"{i:024x}" for i in range(40))
+    assert compare.fetch_supabase_external_ids(cfg, "2025-12-01", "2025-12-31", session=object()) == expected
+    walked = [row["id"] for page in fake.pages for row in page]
+    assert sorted(walked) == sorted(row["id"] for row in rows if row["external_id"])
+
+    fake.pages.clear()
+    assert compare.fetch_supabase_external_ids(cfg, "2025-12-01", "2025-12-31", False, session=object()) == expected
+    assert len([row for page in fake.pages for row in page]) == len(rows)
+
+
+def test_field_columns_come_from_the_index_pass(tmp_path, monkeypatch):
+    workbook = write_workbook(
+        tmp_path / "export.xlsx",
+        ["AAA11", "BBB22", "AAA11", "CCC33", None],
+        extra={
+            "Valor total": ["R$ 1.234,56", 99, "R$ 5,00", "10", "1"],
+            "Situação": ["Confirmada", "cancelada", "x", "Reservada", "y"],
+            "Data de saída": ["2025-12-05", "05/12/2025", None, "2025-12-09", None],
+        },
+    )
+    rules = compare.select_field_rules("check_out,pricing_total,status,guests_total")
+    index = compare.build_workbook_index(workbook, rules=rules)
+    fields = index.reserva_sheet().fields
+    assert fields.codes == ["AAA11", "BBB22", "CCC33"]  # first row of a repeated code wins
+    assert fields.values["pricing_total"] == ["R$ 1.234,56", 99, "10"]
+    assert "guests_total" not in fields.values  # no such export column
+
+    def no_second_read(*args, **kwargs):
+        raise AssertionError("the workbook was read again")
+
+    monkeypatch.setattr(compare, "load_workbook", no_second_read)
+    rows = [
+        compare.ReservationRow("r1", "2025-12-01", "AAA11", ("2025-12-05", 1234.56, "confirmed", 2)),
+        compare.ReservationRow("r2", "2025-12-01", "BBB22", ("2025-12-06", 99, "cancelled", 2)),
+        compare.ReservationRow("r3", "2025-12-01", "CCC33", ("2025-12-09", 10.5, "confirmed", 2)),
+    ]
+    mismatches = compare.diff_fields(index, rows, rules)
+    assert [(m.code, m.xlsx_value, m.supabase_value) for m in mismatches["check_out"]] == [
+        ("BBB22", "05/12/2025", "2025-12-06")
+    ]
+    assert [(m.code, m.reservation_id) for m in mismatches["pricing_total"]] == [("CCC33", "r3")]
+    assert mismatches["status"] == []
+
+
+def test_diff_fields_needs_an_index_built_with_its_rules(tmp_path):
+    workbook = write_workbook(tmp_path / "export.xlsx", ["AAA11"], extra={"Status": ["confirmada"]})
+    rules = compare.select_field_rules("status")
+    with pytest.raises(ValueError):
+        compare.diff_fields(compare.build_workbook_index(workbook), [], rules)
+
+
+@pytest.mark.parametrize(
+    "kind, values",
+    [
+        ("number", ["R$ 1.234,56", "R$ 1.234,56", 7, 7.5, True, None, "", "abc", "1.234.567", "12.5", "-3,2"]),
+        ("date", ["2025-12-01", "01/12/2025", "1/2/2025", None, "soon", "2025-12-01T10:00:00"]),
+        ("text", ["Confirmada", " confirmed ", None, "No-Show", "confirmada"]),
+    ],
+)
+def test_typed_column_matches_per_cell_conversion(kind, values):
+    convert = {"number": compare.to_number, "date": compare.to_day_number, "text": compare.to_text}[kind]
+    typed = list(compare.typed_column(values, kind))
+    expected = [convert(v) for v in values]
+    assert [str(v) for v in typed] == [str(v) for v in expected]  # str() so NaN compares equal
+
+
+def test_result_sinks(tmp_path):
+    with pytest.raises(TypeError):
+        compare.ResultSink(tmp_path / "out.jsonl")
+    row = {"side": "only_in_xlsx", "code": "AAA11", "score": 0.9, "unknown": "dropped"}
+    for fmt in ("jsonl", "csv"):
+        with compare.open_sink(tmp_path / f"out.{fmt}") as sink:
+            sink.write_all([row, row])
+        assert sink.rows_written == 2
+    assert json.loads((tmp_path / "out.jsonl").read_text(encoding="utf-8").splitlines()[0]) == {
+        col: row.get(col) for col in compare.DIFF_COLUMNS
+    }
+    header, first, _ = (tmp_path / "out.csv").read_text(encoding="utf-8").splitlines()
+    assert header.split(",") == list(compare.DIFF_COLUMNS)
+
+
+def reservation_table(n: int, seed: int = 0) -> List[dict]:
+    rng = random.Random(seed)
+    days = [f"2025-12-{day:02d}" for day in range(1, 32)]
+    return [
+        {
+            "id": f"{rng.getrandbits(64):016x}",
+            "check_in": rng.choice(days),
+            "external_id": f"{i:024x}",
+            "external_url": f"https://stays.net/i/reservation?reserve={random_code(rng)}" if i % 9 else None,
+        }
+        for i in range(n)
+    ]
+
+
+@pytest.fixture
+def fake_reservations(monkeypatch):
+    fake = FakeReservations(reservation_table(240))
+    monkeypatch.setattr(compare, "_fetch_page", fake)
+
+    def count(session, cfg, table, filters, count="exact"):
+        return sum(all(postgrest_filter(row, flt) for flt in filters) for row in fake.rows)
+
+    monkeypatch.setattr(compare, "count_supabase_rows", count)
+    return fake
+
+
+@pytest.mark.parametrize("pagination", ["keyset", "offset"])
+@pytest.mark.parametrize("workers", [2, 4, 16])
+def test_concurrent_fetch_matches_the_serial_walk(fake_reservations, pagination, workers):
+    cfg = compare.SupabaseConfig("https://project.supabase.co", "anon")
+
+    def fetch(workers):
+        return compare.fetch_supabase_reservation_rows(
+            cfg, "2025-12-03", "2025-12-28", workers=workers, page_size=7, pagination=pagination, session=object()
+        )
+
+    serial = fetch(workers=1)
+    assert serial == sorted(serial, key=lambda row: (row.check_in, row.id))
+    assert len(serial) == sum("2025-12-03" <= row["check_in"] <= "2025-12-28" for row in fake_reservations.rows)
+    assert fetch(workers=workers) == serial
+
+
+def test_concurrent_offset_fetch_walks_past_a_low_estimate(fake_reservations, monkeypatch):
+    monkeypatch.setattr(compare, "count_supabase_rows", lambda *args, **kwargs: 20)
+    cfg = compare.SupabaseConfig("https://project.supabase.co", "anon")
+    rows = compare.fetch_supabase_reservation_rows(
+        cfg, "2025-12-01", "2025-12-31", workers=4, page_size=7, pagination="offset", session=object()
+    )
+    assert [row.id for row in rows] == [
+        row["id"] for row in sorted(fake_reservations.rows, key=lambda row: (row["check_in"], row["id"]))
+    ]
+
+
+@pytest.mark.parametrize("parts", [1, 3, 7, 31, 100])
+def test_check_in_slices_cover_the_window_once(parts):
+    slices = compare._split_check_in_range("2025-12-01", "2025-12-31", parts)
+    assert len(slices) == min(parts, 31)
+    assert slices[0][0] == "2025-12-01" and slices[-1][1] == "2025-12-31"
+    for (_, hi), (lo, _) in zip(slices, slices[1:]):
+        assert date.fromisoformat(lo) - date.fromisoformat(hi) == timedelta(days=1)
+
+
+def test_keyset_filter_strings():
+    assert compare._keyset_filter(["id"], {"id": "a b/c"}) == "id=gt.a%20b%2Fc"
+    assert compare._keyset_filter(["check_in", "id"], {"check_in": "2025-12-01", "id": "x1"}) == (
+        "or=(check_in.gt.%222025-12-01%22,and(check_in.eq.%222025-12-01%22,id.gt.%22x1%22))"
+    )
+    three = compare._keyset_filter(["a", "b", "c"], {"a": 1, "b": 2, "c": 3})
+    assert three == "or=(a.gt.%221%22,and(a.eq.%221%22,or(b.gt.%222%22,and(b.eq.%222%22,c.gt.%223%22))))"
+
+
+@pytest.mark.parametrize(
+    "last",
+    [
+        {"check_in": "2025-12-10", "id": "m"},
+        {"check_in": "2025-12-10", "id": 'q"uo,te(d)\\'},  # PostgREST reserved characters in a value
+        {"check_in": "2025-12-01", "id": ""},
+        {"check_in": "2025-12-31", "id": "zzz"},
+    ],
+)
+def test_keyset_filter_selects_rows_after_the_cursor(last):
+    rows = [
+        {"check_in": day, "id": rid}
+        for day in ("2025-12-01", "2025-12-10", "2025-12-31")
+        for rid in ("", "a", "m", 'q"uo,te(d)\\', "z", "zzz")
+    ]
+    flt = compare._keyset_filter(["check_in", "id"], last)
+    after = [row for row in rows if postgrest_filter(row, flt)]
+    assert after == [row for row in rows if (row["check_in"], row["id"]) > (last["check_in"], last["id"])]
+
+
+@pytest.mark.parametrize("page_size", [1, 5, 1000])
+def test_keyset_and_offset_walks_agree(monkeypatch, page_size):
+    fake = FakeReservations(reservation_table(60, seed=4))
+    monkeypatch.setattr(compare, "_fetch_page", fake)
+    cfg = compare.SupabaseConfig("https://project.supabase.co", "anon")
+
+    def walk(pagination):
+        pages = compare.iter_supabase_pages(
+            object(), cfg, "reservations", "id,check_in", ("check_in", "id"), [], page_size, pagination
+        )
+        return [row for page in pages for row in page]
+
+    keyset = walk("keyset")
+    assert keyset == walk("offset")
+    assert len(keyset) == 60 and keyset == sorted(keyset, key=lambda row: (row["check_in"], row["id"]))
+    with pytest.raises(ValueError):
+        walk("cursor")
+
+
+def hex_id(rng: random.Random) -> str:
+    return "".join(rng.choice("0123456789abcdef") for _ in range(24))
+
+
+def test_index_sheet_keeps_codes_counts_and_id_columns():
+    rows = iter([
+        ("Reserva", "ID da reserva", "ID do imóvel", None),
+        ("ab12", "6751A2B3C4D5E6F708192A3B", "https://x/6751a2b3c4d5e6f708192a3c", "  "),
+        ("NULL", None, None, "nota"),
+        ("XY", "-", None, None),
+        ("ABCDEFGHIJKLM", None, None, None),
+        (" cd34 ", None, None, None),
+    ])
+    sheet = compare.index_sheet("Reservas", rows)
+
+    assert sheet.headers == ["Reserva", "ID da reserva", "ID do imóvel", "col_4"]
+    assert sheet.rows == 5
+    reserva, own_id, listing_id, notes = sheet.columns
+    assert reserva.codes == {"AB12", "CD34"}
+    assert [col.non_empty for col in sheet.columns] == [5, 2, 1, 1]
+    assert own_id.hex_ids == {"6751a2b3c4d5e6f708192a3b"} and own_id.hex_cells == 1
+    assert listing_id.hex_ids is None and listing_id.hex_sample == ["6751a2b3c4d5e6f708192a3c"]
+    assert compare.index_sheet("Vazia", iter([])) is None
+
+
+def test_index_sheet_hex_sample_is_capped_and_repeatable():
+    rng = random.Random(3)
+    ids = [hex_id(rng) for _ in range(compare.HEX_SAMPLE_SIZE * 3)]
+
+    def index():
+        return compare.index_sheet("Reservas", iter([("Reserva ID",), *((i,) for i in ids)])).columns[0]
+
+    col = index()
+    assert col.hex_cells == len(ids) and col.hex_ids == set(ids)
+    assert len(col.hex_sample) == compare.HEX_SAMPLE_SIZE and set(col.hex_sample) <= set(ids)
+    assert col.hex_sample == index().hex_sample
+
+
+def test_workbook_index_reads_other_id_columns_on_demand(tmp_path):
+    rng = random.Random(5)
+    listing_ids = [hex_id(rng) for _ in range(4)]
+    path = tmp_path / "stays.xlsx"
+    wb = Workbook()
+    wb.active.title = "Resumo"
+    wb.active.append(["Reserva"])
+    ws = wb.create_sheet("Reservas")
+    ws.append(["Reserva", "ID do imóvel"])
+    for i, listing in enumerate(listing_ids):
+        ws.append([f"AB{i}00", listing.upper()])
+    wb.save(path)
+
+    index = compare.build_workbook_index(path)
+    assert [sheet.name for sheet in index.sheets] == ["Resumo", "Reservas"]
+    assert index.reserva_sheet().name == "Reservas"
+    assert index.reserva_codes() == {"AB000", "AB100", "AB200", "AB300"}
+    column = index.column("Reservas", "ID do imóvel")
+    assert column.hex_ids is None
+    assert index.hex_ids(column) == set(listing_ids)
+    assert index.ids_by_column() == {("Reservas", "ID do imóvel"): set(listing_ids)}
+
+
+@pytest.mark.parametrize(
+    "header, score",
+    [("ID da reserva", 2), ("Reservation ID", 2), ("ID", 1), ("ID do imóvel", -1), ("Guest id", -1), ("Notas", 0)],
+)
+def test_header_id_score(header, score):
+    assert compare.header_id_score(header) == score
+
+
+def test_rank_id_columns_breaks_statistical_ties_on_the_header(tmp_path):
+    rng = random.Random(9)
+    known = [hex_id(rng) for _ in range(40)]
+    unknown = [hex_id(rng) for _ in range(40)]
+    # Both leading columns hold only known ids; the header decides. The listing column barely overlaps.
+    extra = {"Notas": known, "ID da reserva": known, "ID do imóvel": known[:4] + unknown[4:]}
+    index = compare.build_workbook_index(write_workbook(tmp_path / "stays.xlsx", ["AB12"] * 40, extra=extra))
+
+    ranked = compare.rank_id_columns(index, set(known))
+    assert [c.column.header for c in ranked] == ["ID da reserva", "Notas", "ID do imóvel"]
+    assert ranked[0].estimated_overlap == 40 and ranked[0].margin == 0
+    assert ranked[2].sample_hits == 4
+
+    ids, description = compare.pick_best_column(index, set(known))
+    assert ids == set(known)
+    assert description == "Sheet::ID da reserva (overlapWithSupabase=40, idsInColumn=40, sampled=40/40, candidates=3)"
+    assert compare.pick_best_column(index, set())[0] == set(known)
+    assert compare.rank_id_columns(compare.WorkbookIndex(tmp_path, []), set(known)) == []
+
+
+def test_rank_id_columns_prefers_a_clearly_larger_overlap():
+    rng = random.Random(11)
+    known = [hex_id(rng) for _ in range(30)]
+    rows = [("ID da reserva", "Notas")] + [(known[i] if i < 3 else hex_id(rng), known[i]) for i in range(30)]
+    index = compare.WorkbookIndex(Path("unused.xlsx"), [compare.index_sheet("Reservas", iter(rows))])
+
+    assert [c.column.header for c in compare.rank_id_columns(index, set(known))] == ["Notas", "ID da reserva"]
+
+
+def write_two_sheets(path: Path, first, second) -> Path:
+    wb = Workbook()
+    wb.active.title = "Reservas"
+    for row in [("Reserva",), *((code,) for code in first)]:
+        wb.active.append(row)
+    ws = wb.create_sheet("Canceladas")
+    for row in [("Reserva",), *((code,) for code in second)]:
+        ws.append(row)
+    wb.save(path)
+    return path
+
+
+def test_sheet_fingerprints_move_only_with_the_edited_sheet(tmp_path):
+    before = compare.sheet_fingerprints(write_two_sheets(tmp_path / "a.xlsx", ["AB12", "CD34"], ["EF56"]))
+    after = compare.sheet_fingerprints(write_two_sheets(tmp_path / "b.xlsx", ["AB12", "CD34"], ["EF56", "GH78"]))
+
+    assert list(before) == ["Reservas", "Canceladas"]
+    assert all(len(fp) == 4 and fp[1] > 0 for fp in before.values())
+    assert before["Reservas"][:2] == after["Reservas"][:2]
+    assert before["Canceladas"][:2] != after["Canceladas"][:2]
+
+
+def test_audit_folder_watcher_reparses_only_changed_sheets(tmp_path):
+    path = write_two_sheets(tmp_path / "2025-12-01_2025-12-31_prop.xlsx", ["AB12"], ["EF56"])
+    watcher = compare.AuditFolderWatcher(tmp_path)
+
+    changed, removed = watcher.poll()
+    assert [(p.check_in_from, p.check_in_to) for p, _ in changed] == [("2025-12-01", "2025-12-31")] and removed == []
+    assert changed[0][1].reserva_codes() == {"AB12"}
+    assert (watcher.sheets_reparsed, watcher.sheets_reused) == (2, 0)
+    assert watcher.poll() == ([], [])
+
+    # Re-saved with the same cells: the stat moves, every sheet part keeps its CRC.
+    write_two_sheets(path, ["AB12"], ["EF56"])
+    os.utime(path, ns=(path.stat().st_atime_ns, path.stat().st_mtime_ns + 10**9))
+    assert watcher.poll() == ([], [])
+    assert (watcher.sheets_reparsed, watcher.sheets_reused) == (2, 2)
+
+    write_two_sheets(path, ["AB12"], ["EF56", "GH78"])
+    os.utime(path, ns=(path.stat().st_atime_ns, path.stat().st_mtime_ns + 2 * 10**9))
+    changed, _ = watcher.poll()
+    assert len(changed) == 1 and (watcher.sheets_reparsed, watcher.sheets_reused) == (3, 3)
+    assert changed[0][1].column("Canceladas", "Reserva").codes == {"EF56", "GH78"}
+
+    path.unlink()
+    assert watcher.poll() == ([], [path])
+
+
+@pytest.mark.parametrize(
+    "a, b, distance",
+    [("", "", 0), ("ABC", "", 3), ("ABC", "ABC", 0), ("ABC", "ABD", 1), ("ABCD", "ACD", 1), ("KITTEN", "SITTING", 3)],
+)
+def test_edit_distance(a, b, distance):
+    assert compare.edit_distance(a, b) == distance == compare.edit_distance(b, a)
+
+
+@pytest.mark.parametrize("max_distance", [1, 2])
+def test_deletion_index_search_matches_a_brute_force_scan(max_distance):
+    rng = random.Random(max_distance)
+    alphabet = "ABC12"  # a small alphabet so plenty of codes sit within reach of each other
+    words = sorted({"".join(rng.choice(alphabet) for _ in range(rng.randint(3, 7))) for _ in range(300)})
+    index = compare.DeletionIndex(words, max_distance)
+
+    for query in words[:40] + ["".join(rng.choice(alphabet) for _ in range(5)) for _ in range(40)]:
+        expected = {(compare.edit_distance(query, w), w) for w in words}
+        assert set(index.search(query)) == {(d, w) for d, w in expected if d <= max_distance}
+
+
+def test_suggest_code_matches_reasons_and_one_to_one_assignment():
+    suggestions = compare.suggest_code_matches(
+        ["ABC0DE12", "HMABCD12", "QWERTY12", "QWERTY13", "ZZZZ9999"],
+        [("ABCODE12", "r1"), ("HMABCD", "r2"), ("QWERXY12", "r3"), ("NOMATCH1", "r4")],
+    )
+
+    assert [(s.xlsx_code, s.supabase_code, s.reservation_id, s.score, s.reason) for s in suggestions] == [
+        ("ABC0DE12", "ABCODE12", "r1", 0.95, "confusable"),
+        ("QWERTY12", "QWERXY12", "r3", 0.875, "edit:1"),
+        ("HMABCD12", "HMABCD", "r2", 0.8, "truncated"),
+    ]
+    assert compare.suggest_code_matches([], [("ABCODE12", "r1")]) == []
+    assert compare.suggest_code_matches(["ZZZZ9999"], [("AAAA1111", None)]) == []
+
+
+@pytest.mark.parametrize(
+    "value, number",
+    [
+        ("R$ 1.234,56", 1234.56),
+        ("1.234.567", 1234567.0),
+        ("12.5", 12.5),
+        ("-3,2", -3.2),
+        (" 7 ", 7.0),
+        (7, 7.0),
+        (2.5, 2.5),
+        ("", math.nan),
+        ("abc", math.nan),
+        (None, math.nan),
+        (True, math.nan),
+    ],
+)
+def test_to_number(value, number):
+    parsed = compare.to_number(value)
+    assert parsed == number or (math.isnan(parsed) and math.isnan(number))
+
+
+def test_to_day_number_and_to_text():
+    day = float(date(2025, 12, 1).toordinal())
+    assert compare.to_day_number("2025-12-01") == compare.to_day_number("01/12/2025") == day
+    assert compare.to_day_number(date(2025, 12, 1)) == compare.to_day_number("2025-12-01T10:00:00") == day
+    assert math.isnan(compare.to_day_number("soon")) and math.isnan(compare.to_day_number(None))
+    assert compare.to_text(" Reservada ") == "confirmed" and compare.to_text(None) == ""
+
+
+@pytest.mark.parametrize("numpy", [True, False])
+def test_mismatch_positions_tolerance_and_missing_values(numpy, monkeypatch):
+    if not numpy:
+        monkeypatch.setattr(compare, "np", None)
+    elif compare.np is None:
+        pytest.skip("numpy is not installed")
+    rule = compare.FieldRule("pricing_total", ("total",), "number", tolerance=0.01)
+    left = compare.typed_column([10, 10, None, None, 5, "R$ 1,00"], "number")
+    right = compare.typed_column([10.005, 10.02, None, 3, None, 1], "number")
+
+    assert compare.mismatch_positions(left, right, rule) == [1, 3, 4]
+    status = compare.FieldRule("status", ("status",), "text")
+    assert compare.mismatch_positions(["confirmed", "x"], ["confirmed", "y"], status) == [1]
+
+
+def snapshot_row(i: int, updated_at: str, organization_id: str = "org-1", **fields) -> dict:
+    return {
+        "id": f"r{i}",
+        "organization_id": organization_id,
+        "check_in": f"2025-12-{i + 1:02d}",
+        "external_id": f"{i:024x}" if i % 4 else None,
+        "external_url": f"https://stays.net/i/reservation?reserve=AB{i:03d}",
+        "updated_at": f"2025-12-20T10:00:{updated_at}+00:00",
+        **fields,
+    }
+
+
+def test_reservation_snapshot_refreshes_from_the_high_water_mark(tmp_path, monkeypatch):
+    fake = FakeReservations([snapshot_row(i, f"{i:02d}") for i in range(6)] + [snapshot_row(9, "00", "org-2")])
+    monkeypatch.setattr(compare, "_fetch_page", fake)
+    cfg = compare.SupabaseConfig("https://project.supabase.co", "anon")
+    snapshot = compare.ReservationSnapshot(tmp_path / "snapshot.sqlite")
+    try:
+        assert snapshot.refresh(cfg, "org-1", page_size=4, session=object()) == 6
+        assert snapshot.high_water("org-1") == "2025-12-20T10:00:05+00:00"
+        assert snapshot.high_water("org-2") is None
+
+        # One row edited, one added at the high-water timestamp; the row at the mark is pulled again.
+        fake.rows[1] = snapshot_row(1, "07", status="cancelled")
+        fake.rows.append(snapshot_row(6, "05"))
+        assert snapshot.refresh(cfg, "org-1", session=object()) == 3
+        assert snapshot.high_water("org-1") == "2025-12-20T10:00:07+00:00"
+        assert snapshot.refresh(cfg, "org-1", session=object()) == 1
+        assert snapshot.high_water("org-1") == "2025-12-20T10:00:07+00:00"
+
+        rows = snapshot.reservation_rows("2025-12-01", "2025-12-31", False, "org-1", ["status"])
+        assert [row.id for row in rows] == [f"r{i}" for i in range(7)]
+        assert rows[1] == compare.ReservationRow("r1", "2025-12-02", "AB001", ("cancelled",))
+        assert [row.id for row in snapshot.reservation_rows("2025-12-01", "2025-12-31", True, "org-1")] == [
+            "r1", "r2", "r3", "r5", "r6"
+        ]
+        with pytest.raises(ValueError):
+            snapshot.reservation_rows("2025-12-01", "2025-12-31", organization_id="org-1", extra_columns=["notes"])
+
+        # Hard deletes survive an incremental refresh; a full one rebuilds the partition.
+        del fake.rows[0]
+        snapshot.refresh(cfg, "org-1", session=object())
+        assert len(snapshot.reservation_rows("2025-12-01", "2025-12-31", False, "org-1")) == 7
+        assert snapshot.refresh(cfg, "org-1", full=True, session=object()) == 6
+        assert len(snapshot.reservation_rows("2025-12-01", "2025-12-31", False, "org-1")) == 6
+        assert snapshot.reservation_rows("2025-12-01", "2025-12-31", False, "org-2") == []
+    finally:
+        snapshot.close()
+
+
+def raw_object(i: int, external_id: str, fetched_at: str, payload: dict, organization_id: str = "org-1") -> dict:
+    return {
+        "id": i,
+        "organization_id": organization_id,
+        "domain": "reservations",
+        "external_id": external_id,
+        "external_code": payload.get("id"),
+        "payload_hash": hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest(),
+        "fetched_at": f"2025-12-20T10:00:{fetched_at}+00:00",
+        "payload": payload,
+    }
+
+
+def test_raw_object_store_downloads_each_payload_once(tmp_path, monkeypatch):
+    first = {"id": "ab12", "checkInDate": "2025-12-02", "checkOutDate": "2025-12-05T11:00:00"}
+    moved = {**first, "checkInDate": "2025-12-03"}
+    twin = {"id": "CD34", "checkInDate": "2025-12-10"}
+    fake = FakeReservations(
+        [
+            raw_object(1, "e1", "01", first),
+            raw_object(2, "e1", "02", moved),
+            raw_object(3, "e2", "01", twin),
+            raw_object(4, "e3", "03", twin),  # an identical payload under another _id shares its hash
+            raw_object(5, "e9", "01", {"id": "ZZ99", "checkInDate": "2025-12-04"}, organization_id="org-2"),
+        ]
+    )
+    monkeypatch.setattr(compare, "_fetch_page", fake)
+    streamed: List[str] = []
+
+    def rows_streamed(session, cfg, table, select, keys, filters, page_size=1000):
+        for page in compare.iter_supabase_pages(session, cfg, table, select, keys, filters, page_size):
+            streamed.extend(row["payload_hash"] for row in page)
+            yield from page
+
+    monkeypatch.setattr(compare, "iter_supabase_rows_streamed", rows_streamed)
+    cfg = compare.SupabaseConfig("https://project.supabase.co", "anon")
+    store = compare.RawObjectStore(tmp_path / "raw.sqlite")
+    try:
+        assert store.refresh(cfg, "org-1", page_size=2, workers=2, session=object()) == (4, 3)
+        assert store.payload(fake.rows[1]["payload_hash"]) == moved
+        assert store.payload("0" * 64) is None
+
+        latest = store.latest_reservations("2025-12-01", "2025-12-31", "org-1")
+        assert [(r.external_id, r.code, r.check_in, r.check_out) for r in latest] == [
+            ("e1", "AB12", "2025-12-03", "2025-12-05"),
+            ("e2", "CD34", "2025-12-10", None),
+            ("e3", "CD34", "2025-12-10", None),
+        ]
+        assert store.latest_reservations("2025-12-01", "2025-12-02", "org-1") == []
+
+        # A re-import bumps fetched_at of a known payload: metadata is pulled, nothing is downloaded.
+        fake.rows[0] = raw_object(1, "e1", "04", first)
+        streamed.clear()
+        assert store.refresh(cfg, "org-1", session=object()) == (2, 0)
+        assert streamed == []
+        assert store.latest_reservations("2025-12-01", "2025-12-31", "org-1")[0].check_in == "2025-12-02"
+    finally:
+        store.close()
+
+
+def test_phase_profiler_disabled_records_nothing():
+    profiler = compare.PhaseProfiler()
+    with profiler.phase("index"):
+        pass
+    profiler.record_page("reservations", 10, 100, 0.1, 0.01)
+    assert profiler.summary() == {"phases": {}, "pages": {}}
+
+
+def test_phase_profiler_aggregates_phases_pages_and_merged_workers():
+    profiler = compare.PhaseProfiler(enabled=True)
+    for _ in range(2):
+        with profiler.phase("index"):
+            pass
+    with pytest.raises(RuntimeError):
+        with profiler.phase("fetch"):
+            raise RuntimeError("a failed phase is still timed")
+    for i in range(20):
+        profiler.record_page("reservations", 1000, 5000, (i + 1) / 100, 0.001)
+    profiler.merge(
+        {"fetch": {"wall_s": 2.0, "cpu_s": 1.0, "calls": 3, "peak_rss_bytes": 2**50}},
+        [{"table": "staysnet_raw_objects", "rows": 7, "bytes": 70, "wall_s": 0.5, "cpu_s": 0.0}],
+    )
+
+    summary = profiler.summary()
+    assert summary["phases"]["index"]["calls"] == 2
+    assert summary["phases"]["fetch"]["calls"] == 4 and summary["phases"]["fetch"]["wall_s"] >= 2.0
+    assert summary["phases"]["fetch"]["peak_rss_bytes"] == 2**50
+    assert summary["pages"]["reservations"] == {
+        "pages": 20,
+        "rows": 20000,
+        "bytes": 100000,
+        "wall_s": 2.1,
+        "cpu_s": 0.02,
+        "page_wall_s_p50": 0.11,
+        "page_wall_s_p95": 0.2,
+        "page_wall_s_max": 0.2,
+    }
+    assert summary["pages"]["staysnet_raw_objects"]["pages"] == 1
+    profiler.reset()
+    assert profiler.summary() == {"phases": {}, "pages": {}}
+
+
+def test_csv_page_reads_empty_cells_as_null():
+    page = csv_page(["id", "external_url", "pricing_total"], [{"id": "r1", "external_url": None, "pricing_total": 9.5}])
+    assert len(page) == 1 and page.position("pricing_total") == 2
+    assert page[-1] == {"id": "r1", "external_url": None, "pricing_total": "9.5"}
+
+
+@pytest.mark.parametrize("pagination", ["keyset", "offset"])
+def test_csv_transfer_matches_json(monkeypatch, pagination):
+    rng = random.Random(6)
+    table = reservation_table(50, seed=6)
+    for i, row in enumerate(table):
+        row["pricing_total"] = None if i % 7 == 0 else round(rng.uniform(-50, 5000), 2)
+        row["guests_total"] = rng.choice([None, 1, 2, 12])
+        row["status"] = rng.choice([None, "confirmed", "cancelled, by guest"])
+    monkeypatch.setattr(compare, "_fetch_page", FakeReservations(table))
+    cfg = compare.SupabaseConfig("https://project.supabase.co", "anon")
+
+    def fetch(transfer):
+        return compare.fetch_supabase_reservation_rows(
+            cfg,
+            "2025-12-01",
+            "2025-12-31",
+            page_size=8,
+            pagination=pagination,
+            extra_columns=["pricing_total", "guests_total", "status"],
+            session=object(),
+            transfer=transfer,
+        )
+
+    rows = fetch("csv")
+    assert len(rows) == 50 and rows == fetch("json")
+    assert any(isinstance(row.fields[1], int) for row in rows)
+
+
+def test_organization_export_dir_prefers_the_slug(tmp_path):
+    (tmp_path / "org-1").mkdir()
+    org = compare.Organization("org-1", slug="praia")
+    assert compare.organization_export_dir(tmp_path, org) == tmp_path / "org-1"
+    (tmp_path / "praia").mkdir()
+    assert compare.organization_export_dir(tmp_path, org) == tmp_path / "praia"
+    assert compare.organization_export_dir(tmp_path, compare.Organization("org-2")) is None
+
+
+def tenant_row(i: int, code: str, organization_id: str) -> dict:
+    return {
+        "id": f"r{i}",
+        "organization_id": organization_id,
+        "check_in": f"2025-12-{i + 1:02d}",
+        "external_id": f"{i:024x}",
+        "external_url": f"https://stays.net/i/reservation?reserve={code}",
+    }
+
+
+@pytest.mark.parametrize("memory_cap", [None, 2**20])
+def test_reconcile_organization_summarizes_each_period(tmp_path, monkeypatch, memory_cap):
+    table = [tenant_row(i, f"AB10{i}", "org-1") for i in range(5)] + [tenant_row(9, "ZZ999", "org-2")]
+    monkeypatch.setattr(compare, "_fetch_page", FakeReservations(table))
+    export_dir = tmp_path / "praia"
+    export_dir.mkdir()
+    write_workbook(export_dir / "2025-12-01_2025-12-31_praia.xlsx", ["AB100", "AB101", "AB102", "AB103", "ZZ999"])
+    cfg = compare.SupabaseConfig("https://project.supabase.co", "anon")
+    org = compare.Organization("org-1", slug="praia")
+
+    result = compare.reconcile_organization(cfg, org, export_dir, compare.FetchOptions(memory_cap=memory_cap))
+    summary = result.summary()
+    assert (summary["organization_id"], summary["slug"], summary["error"]) == ("org-1", "praia", None)
+    assert not result.clean
+    [period] = summary["periods"]
+    assert (period["only_in_supabase"], period["only_in_xlsx"]) == (1, 1)
+    assert json.loads(json.dumps(summary)) == summary  # one line of the fleet's JSONL report
+
+
+def test_reconcile_organization_reports_failures_instead_of_raising(tmp_path, monkeypatch):
+    cfg = compare.SupabaseConfig("https://project.supabase.co", "anon")
+    org = compare.Organization("org-1")
+    empty = compare.reconcile_organization(cfg, org, tmp_path, compare.FetchOptions())
+    assert empty.results == [] and empty.error.startswith("no <from>_<to>_*.xlsx exports")
+
+    def unreachable(*args, **kwargs):
+        raise RuntimeError("HTTP 503")
+
+    monkeypatch.setattr(compare, "_fetch_page", unreachable)
+    write_workbook(tmp_path / "2025-12-01_2025-12-31_x.xlsx", ["AB100"])
+    failed = compare.reconcile_organization(cfg, org, tmp_path, compare.FetchOptions())
+    assert failed.error == "RuntimeError: HTTP 503" and not failed.clean
+    assert failed.summary()["periods"] == []
@@ -0,0 +1,462 @@
+"""Tests for supabase_client (python -m pytest test_supabase_client.py)."""
+
+import io
+import json
+import threading
+from typing import Dict, List, Optional
+
+import pytest
+import requests
+
+import supabase_client
+from supabase_client import (
+    LATENCY_WARMUP,
+    MAX_RETRY_AFTER,
+    AdaptiveLimiter,
+    ReferenceCache,
+    SupabaseClient,
+    SupabaseConfig,
+    configure_limiters,
+    iter_json_array,
+    limiter_for,
+    load_supabase_config,
+    send_with_retry,
+)
+
+SAMPLES = [
+    [],
+    [0],
+    [1.5],
+    [1.5e10, -2.25e-3, 12345678901234567890, -0.0],
+    ["", "a", 'quote " and \\ backslash', "ç✓ 😀"],
+    [True, False, None],
+    [{"id": 1, "payload": {"k": [1, 2.5, {"deep": ["x", None]}]}}, [], {}, [[]]],
+    [{"id": i, "blob": "z" * i, "n": i / 7} for i in range(40)],
+]
+
+
+class TrickleStream(io.BytesIO):
+    """Returns at most `step` bytes per read, so every boundary in the body gets exercised."""
+
+    def __init__(self, data: bytes, step: int):
+        super().__init__(data)
+        self.step = step
+
+    def read(self, size: int = -1) -> bytes:
+        return super().read(self.step if size is None or size < 0 else min(size, self.step))
+
+
+@pytest.mark.parametrize("sample", SAMPLES)
+@pytest.mark.parametrize("indent", [None, 2])
+def test_chunk_size_sweep(sample, indent):
+    body = json.dumps(sample, ensure_ascii=False, indent=indent).encode("utf-8")
+    for chunk_size in range(1, 12):
+        assert list(iter_json_array(io.BytesIO(body), chunk_size=chunk_size)) == sample, chunk_size
+        assert list(iter_json_array(TrickleStream(body, chunk_size), chunk_size=64)) == sample, chunk_size
+
+
+def test_columns_trim_objects():
+    body = b'[{"id": 1, "payload": {"x": 1}, "h": "a"}, {"id": 2}]'
+    assert list(iter_json_array(io.BytesIO(body), ["id", "h"])) == [{"id": 1, "h": "a"}, {"id": 2, "h": None}]
+
+
+@pytest.mark.parametrize(
+    "body",
+    [b"", b'{"a": 1}', b"[1,,2]", b"[,1]", b"[1,]", b"[1 2]", b"[1x]", b'[{"a": 1}', b'[{"a": 1}, {"b":'],
+)
+def test_invalid_input_raises(body):
+    for chunk_size in (1, 3, 64):
+        with pytest.raises(ValueError):
+            list(iter_json_array(io.BytesIO(body), chunk_size=chunk_size))
+
+
+def fake_response(status: int, payload: object, headers: Optional[Dict[str, str]] = None) -> requests.Response:
+    resp = requests.Response()
+    resp.status_code = status
+    resp._content = json.dumps(payload).encode("utf-8")
+    resp._content_consumed = True
+    resp.headers.update(headers or {})
+    resp.url = "https://project.supabase.co/rest/v1/"
+    return resp
+
+
+class FakeTables:
+    """SupabaseClient stand-in for ReferenceCache: select/eq./is./order/limit/offset over in-memory tables."""
+
+    def __init__(self, **tables: List[dict]):
+        self.cfg = SupabaseConfig("https://project.supabase.co", "anon")
+        self.tables = tables
+        self.calls: List[Dict[str, str]] = []
+
+    def request(self, method, path, query=(), headers=None, **kwargs):
+        params = dict(part.split("=", 1) for part in query)
+        self.calls.append(params)
+        rows = self.tables[path.rsplit("/", 1)[1]]
+        for col, op in params.items():
+            if op.startswith(("eq.", "is.")):
+                rows = [row for row in rows if json.dumps(row.get(col)).strip('"') == op[3:]]
+        columns = params["select"].split(",")
+        missing = [col for col in columns if col != "*" and rows and col not in rows[0]]
+        if missing:
+            resp = fake_response(400, {"code": "42703", "message": f"column {missing[0]} does not exist"})
+            raise requests.HTTPError(response=resp)
+        if "order" in params:
+            col, *direction = params["order"].split(".")
+            rows = sorted(rows, key=lambda row: row[col], reverse="desc" in direction)
+        offset = int(params.get("offset", 0))
+        page = rows[offset : offset + int(params.get("limit", len(rows)))]
+        if columns != ["*"]:
+            page = [{col: row[col] for col in columns} for row in page]
+        return fake_response(200, page, {"Content-Range": f"{offset}-{offset + len(page) - 1}/{len(rows)}"})
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ReferenceCache(tmp_path / "reference.sqlite", ttl=3600)
+    yield cache
+    cache.close()
+
+
+def test_reference_cache_serves_fresh_entries_without_requests(cache):
+    client = FakeTables(property_types=[{"id": 1, "name": "house", "updated_at": "2026-01-01"}])
+    first = cache.select(client, "property_types", "id,name", order="id")
+    requests_made = len(client.calls)
+    assert cache.select(client, "property_types", "id,name", order="id") == first == [{"id": 1, "name": "house"}]
+    assert len(client.calls) == requests_made
+    assert (cache.fetched, cache.hits) == (1, 1)
+
+
+def test_reference_cache_revalidates_expired_entries_by_version(cache):
+    rows = [{"id": 1, "name": "house", "updated_at": "2026-01-01"}]
+    client = FakeTables(property_types=rows)
+    cache.select(client, "property_types", "id,name")
+    cache.ttl = 0
+
+    client.calls.clear()
+    assert cache.select(client, "property_types", "id,name") == [{"id": 1, "name": "house"}]
+    assert [call["limit"] for call in client.calls] == ["1"]  # the version probe only
+    assert cache.revalidated == 1
+
+    rows[0].update(name="apartment", updated_at="2026-02-01")
+    assert cache.select(client, "property_types", "id,name") == [{"id": 1, "name": "apartment"}]
+    assert cache.fetched == 2
+
+
+def test_reference_cache_versions_tables_without_updated_at_by_count(cache):
+    rows = [{"code": "BR"}]
+    client = FakeTables(country_iso_codes=rows)
+    cache.ttl = 0
+    assert cache.select(client, "country_iso_codes", "code") == [{"code": "BR"}]
+    assert cache.select(client, "country_iso_codes", "code") == [{"code": "BR"}]
+    assert cache.revalidated == 1
+    rows.append({"code": "PT"})
+    assert cache.select(client, "country_iso_codes", "code") == [{"code": "BR"}, {"code": "PT"}]
+
+
+def test_reference_cache_pages_large_tables(cache, monkeypatch):
+    monkeypatch.setattr(supabase_client, "REFERENCE_PAGE_ROWS", 2)
+    rows = [{"id": i, "updated_at": "2026-01-01"} for i in (5, 3, 1, 4, 2)]
+    assert cache.select(FakeTables(ota_amenity_mappings=rows), "ota_amenity_mappings", "id", order="id") == [
+        {"id": i} for i in range(1, 6)
+    ]
+
+
+def test_reference_cache_evicts_least_recently_used(cache):
+    client = FakeTables(
+        canonical_amenities=[{"id": i, "updated_at": "x"} for i in range(50)],
+        property_types=[{"id": 1, "updated_at": "x"}],
+    )
+    cache.select(client, "canonical_amenities", "id")
+    cache.max_bytes = cache.conn.execute("SELECT SUM(size) FROM entries").fetchone()[0]
+    cache.select(client, "property_types", "id")
+    assert [row[0] for row in cache.conn.execute("SELECT table_name FROM entries")] == ["property_types"]
+
+
+class FakeClock:
+    """Stands in for supabase_client's `time` module: sleeping only advances the clock."""
+
+    def __init__(self):
+        self.now = 1_700_000_000.0
+        self.sleeps: List[float] = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeSession:
+    """requests.Session stand-in; `respond(method, uri, headers, rows)` returns a response or raises."""
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.calls: List[tuple] = []
+
+    def request(self, method, uri, headers=None, data=None, timeout=None, **kwargs):
+        rows = json.loads(data) if data else None
+        self.calls.append((method, uri, dict(headers or {}), rows))
+        return self.respond(method, uri, headers, rows)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(supabase_client, "time", clock)
+    monkeypatch.setattr(supabase_client, "_limiters", {})
+    return clock
+
+
+def fake_client(respond) -> SupabaseClient:
+    return SupabaseClient(SupabaseConfig("https://project.supabase.co", "service"), session=FakeSession(respond))
+
+
+def ok(*args) -> requests.Response:
+    return fake_response(201, [])
+
+
+def test_bulk_upsert_chunks_by_size_and_key_set(clock):
+    client = fake_client(ok)
+    rows = [{"id": i, "v": i} for i in range(7)] + [{"id": 7}]
+    result = client.bulk_upsert("items", rows, on_conflict="id", chunk_rows=3, workers=1)
+    assert (result.written, result.requests, result.ok) == (8, 4, True)
+    assert sorted([row["id"] for row in call[3]] for call in client.session.calls) == [[0, 1, 2], [3, 4, 5], [6], [7]]
+    assert all(call[2]["Prefer"] == "resolution=merge-duplicates,return=minimal" for call in client.session.calls)
+
+    client = fake_client(ok)
+    result = client.bulk_upsert("items", rows[:7], chunk_bytes=len(json.dumps(rows[0])) * 2 + 2, workers=1)
+    assert result.requests == 4
+
+
+def test_bulk_upsert_bisects_row_level_rejections(clock):
+    def respond(method, uri, headers, rows):
+        bad = [row["id"] for row in rows if row["id"] in (3, 6)]
+        if bad:
+            return fake_response(409, {"code": "23505", "details": f"Key (id)=({bad[0]}) already exists."})
+        return ok()
+
+    client = fake_client(respond)
+    result = client.bulk_upsert("items", [{"id": i} for i in range(8)], on_conflict="id", workers=1)
+    assert result.written == 6
+    assert [(f.index, f.row) for f in result.failures] == [(3, {"id": 3}), (6, {"id": 6})]
+    assert "(id)=(6)" in result.failures[1].error
+    assert result.requests == len(client.session.calls)
+
+
+@pytest.mark.parametrize(
+    "status, payload",
+    [
+        (404, {"code": "42P01", "message": 'relation "public.itens" does not exist'}),
+        (400, {"code": "PGRST204", "message": "Could not find the 'vlaue' column of 'items' in the schema cache"}),
+        (401, {"message": "Invalid API key"}),
+    ],
+)
+def test_bulk_upsert_does_not_bisect_request_wide_errors(clock, status, payload):
+    client = fake_client(lambda *args: fake_response(status, payload))
+    result = client.bulk_upsert("items", [{"id": i} for i in range(8)], on_conflict="id", workers=1)
+    assert (result.written, result.requests, len(client.session.calls)) == (0, 1, 1)
+    assert len(result.failures) == 8 and len({f.error for f in result.failures}) == 1
+
+
+def test_bulk_upsert_stops_bisecting_when_both_halves_fail_alike(clock):
+    error = {"code": "23514", "message": 'new row violates check constraint "items_v_check"', "details": None}
+    client = fake_client(lambda *args: fake_response(400, error))
+    result = client.bulk_upsert("items", [{"id": i} for i in range(8)], on_conflict="id", workers=1)
+    assert (result.written, result.requests, len(result.failures)) == (0, 3, 8)
+
+
+@pytest.mark.parametrize(
+    "rows, on_conflict, attempts",
+    [
+        ([{"id": 1}, {"id": 2}], "id", 2),  # the conflict key pins every row: safe to repeat
+        ([{"v": 1}, {"v": 2}], "id", 1),  # ids would come from the column default
+        ([{"id": 1}, {"id": None}], "id", 1),
+        ([{"id": 1}, {"id": 2}], None, 1),  # conflict target unknown here
+    ],
+)
+def test_bulk_upsert_retries_only_idempotent_chunks(clock, rows, on_conflict, attempts):
+    responses = iter([fake_response(500, {"message": "boom"}), ok()])
+    client = fake_client(lambda *args: next(responses))
+    result = client.bulk_upsert("items", rows, on_conflict=on_conflict, chunk_rows=2, workers=1)
+    assert len(client.session.calls) == attempts
+    assert result.ok == (attempts == 2)
+
+
+def test_exported_settings_win_over_env_local(tmp_path, monkeypatch):
+    (tmp_path / ".env.local").write_text(
+        'VITE_SUPABASE_URL="https://file.supabase.co/"\n'
+        "VITE_SUPABASE_ANON_KEY=file-key\n"
+        "SUPABASE_SERVICE_ROLE_KEY=file-role\n",
+        encoding="utf-8",
+    )
+    for key in ("VITE_SUPABASE_URL", "VITE_SUPABASE_ANON_KEY", "SUPABASE_ANON_KEY", "SUPABASE_SERVICE_ROLE_KEY"):
+        monkeypatch.delenv(key, raising=False)
+    monkeypatch.setenv("SUPABASE_URL", "https://env.supabase.co")
+    monkeypatch.setenv("SUPABASE_SERVICE_ROLE_KEY", "env-role")
+    assert load_supabase_config(tmp_path) == SupabaseConfig("https://env.supabase.co", "file-key", "env-role")
+
+
+def send(session, method="GET", **kwargs):
+    return send_with_retry(session, method, "https://project.supabase.co/rest/v1/items", {}, **kwargs)
+
+
+def test_send_with_retry_retries_5xx_and_connection_errors(clock):
+    outcomes = iter([requests.ConnectionError("reset"), fake_response(502, {}), fake_response(200, [1])])
+
+    def respond(*args):
+        outcome = next(outcomes)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    session = FakeSession(respond)
+    assert send(session).json() == [1]
+    assert len(session.calls) == 3 and len(clock.sleeps) == 2
+
+
+def test_send_with_retry_gives_up_after_its_attempts(clock):
+    session = FakeSession(lambda *args: fake_response(503, {}))
+    with pytest.raises(requests.HTTPError):
+        send(session, attempts=3)
+    assert len(session.calls) == 3
+    assert send(session, attempts=2, raise_for_status=False).status_code == 503
+
+
+@pytest.mark.parametrize(
+    "failure",
+    [fake_response(500, {}), fake_response(502, {}), requests.ReadTimeout("read"), requests.ConnectionError("reset")],
+)
+def test_send_with_retry_does_not_repeat_non_idempotent_posts(clock, failure):
+    def respond(*args):
+        if isinstance(failure, Exception):
+            raise failure
+        return failure
+
+    session = FakeSession(respond)
+    with pytest.raises((requests.HTTPError, requests.RequestException)):
+        send(session, "POST", idempotent=False)
+    assert len(session.calls) == 1
+
+
+@pytest.mark.parametrize(
+    "failure", [fake_response(429, {}), fake_response(503, {}), requests.ConnectTimeout("connect")]
+)
+def test_send_with_retry_repeats_posts_the_server_never_processed(clock, failure):
+    outcomes = iter([failure, fake_response(201, [])])
+
+    def respond(*args):
+        outcome = next(outcomes)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    session = FakeSession(respond)
+    assert send(session, "POST", idempotent=False).status_code == 201
+    assert len(session.calls) == 2
+
+
+@pytest.mark.parametrize(
+    "retry_after, wait",
+    [
+        ("7", 7.0),
+        ("Tue, 14 Nov 2023 22:13:40 GMT", 20.0),  # FakeClock starts at 22:13:20 GMT that day
+        ("3600", MAX_RETRY_AFTER),
+    ],
+)
+def test_send_with_retry_waits_out_retry_after(clock, retry_after, wait):
+    responses = iter([fake_response(429, {}, {"Retry-After": retry_after}), fake_response(200, [])])
+    session = FakeSession(lambda *args: next(responses))
+    assert send(session, base_delay=0.01).status_code == 200
+    assert clock.sleeps == [pytest.approx(wait)]
+
+
+def settle(limiter: AdaptiveLimiter, **outcome) -> None:
+    limiter.acquire()
+    limiter.release(**outcome)
+
+
+def test_limiter_increases_additively(clock):
+    limiter = AdaptiveLimiter(initial=4, max_limit=32)
+    expected = 4.0
+    for _ in range(4):
+        settle(limiter, latency=0.1, status=200)
+        expected += 1 / expected
+    assert limiter.limit == pytest.approx(expected)
+    assert int(limiter.limit) == 4  # about +1 per window of requests
+
+
+@pytest.mark.parametrize("outcome", [{"status": 429}, {"status": 503}, {"failed": True}])
+def test_limiter_halves_on_throttling_once_per_round_trip(clock, outcome):
+    limiter = AdaptiveLimiter(initial=16, max_limit=32)
+    settle(limiter, latency=0.5, status=200)
+    limit = limiter.limit
+    settle(limiter, **outcome)
+    assert limiter.limit == pytest.approx(limit / 2)
+    settle(limiter, **outcome)  # same congestion seen by another request in flight
+    assert limiter.limit == pytest.approx(limit / 2)
+    clock.now += 0.5
+    settle(limiter, **outcome)
+    assert limiter.limit == pytest.approx(limit / 4)
+    assert (limiter.throttled, limiter.decreases) == (3, 2)
+
+
+def test_limiter_backs_off_on_latency_after_warmup(clock):
+    limiter = AdaptiveLimiter(initial=8, max_limit=8)
+    for _ in range(LATENCY_WARMUP - 1):
+        settle(limiter, latency=0.1, status=200)
+    settle(limiter, latency=1.0, status=200)
+    assert limiter.limit == 8  # the baseline's first samples never count as congestion
+    clock.now += 1
+    settle(limiter, latency=1.0, status=200)
+    assert limiter.limit == pytest.approx(6)
+
+
+def test_limiter_pauses_for_retry_after(clock):
+    limiter = AdaptiveLimiter(initial=4)
+    settle(limiter, status=429, retry_after=5.0)
+    assert limiter.paused_until == clock.now + 5.0
+    clock.now += 5.0
+    limiter.acquire()  # the pause is over: no wait
+    assert limiter.in_flight == 1
+
+
+def test_limiter_stays_within_its_bounds(clock):
+    limiter = AdaptiveLimiter(initial=100, max_limit=6, min_limit=2)
+    assert limiter.limit == 6
+    for _ in range(10):
+        clock.now += 10
+        settle(limiter, status=503)
+    assert limiter.limit == 2
+    for _ in range(200):
+        settle(limiter, latency=0.1, status=200)
+    assert limiter.limit == 6
+    limiter.set_max(3)
+    assert limiter.limit == 3
+
+
+def test_limiter_blocks_requests_over_its_limit(clock):
+    limiter = AdaptiveLimiter(initial=1, max_limit=1)
+    limiter.acquire()
+    waiter = threading.Thread(target=limiter.acquire)
+    waiter.start()
+    waiter.join(0.05)
+    assert waiter.is_alive()
+    limiter.release(latency=0.1, status=200)
+    waiter.join(1)
+    assert not waiter.is_alive() and limiter.in_flight == 1
+
+
+def test_limiters_are_shared_per_host_and_service(clock, monkeypatch):
+    monkeypatch.setattr(supabase_client, "_limit_max", supabase_client.LIMIT_MAX)
+    rest = limiter_for("https://project.supabase.co/rest/v1/reservations?limit=1")
+    assert limiter_for("https://project.supabase.co/rest/v1/organizations") is rest
+    assert limiter_for("https://project.supabase.co/functions/v1/sync") is not rest
+    assert limiter_for("https://other.supabase.co/rest/v1/reservations") is not rest
+
+    configure_limiters(2)
+    assert rest.max_limit == 2 and rest.limit <= 2
+    assert limiter_for("https://project.supabase.co/storage/v1/object").max_limit == 2
@@ -1,4 +1,3 @@
-import os
 """
 Script de teste para criar imobiliária via API
 
@@ -9,16 +8,14 @@ import requests
 import json
 import sys
 
-SUPABASE_URL = os.environ.get('SUPABASE_URL') or os.environ.get('VITE_SUPABASE_URL')
-PUBLIC_ANON_KEY = os.environ.get('SUPABASE_ANON_KEY') or os.environ.get('VITE_SUPABASE_ANON_KEY')
+from supabase_client import SupabaseClient, load_supabase_config
 
-if not SUPABASE_URL:
-    raise SystemExit('Missing env var SUPABASE_URL')
+try:
+    client = SupabaseClient(load_supabase_config(), timeout=30)
+except RuntimeError as e:
+    raise SystemExit(str(e))
 
-if not PUBLIC_ANON_KEY:
-    raise SystemExit('Missing env var SUPABASE_ANON_KEY')
-
-BASE_URL = f"{SUPABASE_URL.rstrip('/')}/functions/v1/rendizy-server/make-server-67caf26a"
+BASE_PATH = 'rendizy-server/make-server-67caf26a'
 
 def criar_imobiliaria():
     nome = 'Teste Imobiliária'
@@ -36,21 +33,15 @@ def criar_imobiliaria():
     try:
         # 1. Criar organização
         print('📤 Enviando requisição POST /organizations...')
-        response = requests.post(
-            f'{BASE_URL}/organizations',
-            headers={
-                'Content-Type': 'application/json',
-                'Authorization': f'Bearer {PUBLIC_ANON_KEY}',
-                'apikey': PUBLIC_ANON_KEY
-            },
-            json={
+        response = client.function(
+            f'{BASE_PATH}/organizations',
+            json_body={
                 'name': nome,
                 'email': email,
                 'phone': telefone,
                 'plan': plano,
                 'createdBy': 'user_master_rendizy'
             },
-            timeout=30
         )
 
         print(f'📥 Status: {response.status_code} {response.reason}')
@@ -77,14 +68,7 @@ def criar_imobiliaria():
 
         # 2. Verificar se foi criada no banco (buscar por ID)
         print('\n🔍 Verificando se foi criada no banco...')
-        verify_response = requests.get(
-            f'{BASE_URL}/organizations/{org["id"]}',
-            headers={
-                'Authorization': f'Bearer {PUBLIC_ANON_KEY}',
-                'apikey': PUBLIC_ANON_KEY
-            },
-            timeout=30
-        )
+        verify_response = client.function(f'{BASE_PATH}/organizations/{org["id"]}', method='GET')
 
         if verify_response.ok:
             verify_result = verify_response.json()
@@ -98,14 +82,7 @@ def criar_imobiliaria():
 
         # 3. Verificar se slug é único (buscar por slug)
         print('\n🔍 Verificando se slug é único...')
-        slug_response = requests.get(
-            f'{BASE_URL}/organizations/slug/{org["slug"]}',
-            headers={
-                'Authorization': f'Bearer {PUBLIC_ANON_KEY}',
-                'apikey': PUBLIC_ANON_KEY
-            },
-            timeout=30
-        )
+        slug_response = client.function(f'{BASE_PATH}/organizations/slug/{org["slug"]}', method='GET')
 
         if slug_response.ok:
             slug_result = slug_response.json()